@@ -0,0 +1,758 @@
+#
+# array_mesh.py
+#
+# Defines an "array mesh": a triangle mesh stored as flat numpy arrays
+# instead of linked vertex / edge / triangle objects.
+#
+# The winged half-edge mesh in tri_mesh.py is convenient for walking
+# around a surface, but every vertex and edge is a Python object, which
+# gets slow and memory hungry after a few levels of subdivision. The
+# array mesh holds the same information as
+#
+#    verts:  (V,3) float array of vertex positions
+#    faces:  (F,3) int array of vertex indices, one row per triangle
+#    colors: (V,3) float array of per-vertex RGB colors
+#
+# and is what the vectorized code in array_subdivision.py works on.
+#
+# Any number of further per-vertex channels (texture coordinates, skin
+# weights, ...) can be attached with addAttribute. Each is an (V,C)
+# array with a rule saying how subdivision carries it: 'linear' channels
+# are averaged along edges like the colors, 'loop' channels are smoothed
+# with the same stencil as the positions.
+#
+# Positions and colors are float64 by default. Passing dtype=np.float32
+# (or 'float32') keeps them, and everything subdivided or compiled from
+# them, in single precision: half the memory, and the same type the
+# viewer uploads as GL_FLOAT anyway. precision_report.py measures what
+# that costs in accuracy.
+
+import os
+import numpy as np
+from math import sqrt
+from compressed_io import open_file, compression
+
+
+DEFAULT_COLOR = [1.0, 0.0, 1.0] # same bright purple as mesh_geometry.vertex
+
+# one_ring vertex kinds
+INTERIOR = 0 # a single closed fan of triangles
+BOUNDARY = 1 # a single open fan, two boundary edges
+NONMANIFOLD = 2 # several fans, or an edge shared by 3+ triangles
+ISOLATED = 3 # not used by any triangle
+
+ATTRIBUTE_RULES = ('linear', 'loop')
+
+# one triangle of a binary STL file, after its 80 byte header and
+# uint32 triangle count
+STL_HEADER = 84
+STL_RECORD = np.dtype([('normal', '<f4', 3), ('corners', '<f4', (3, 3)),
+                       ('attribute', '<u2')])
+
+
+class array_mesh:
+    # Represents a surface as arrays of vertex positions and triangle
+    # vertex indices.
+
+    def __init__(self, verts, faces, colors=None, dtype=np.float64):
+
+        self.verts = np.asarray(verts, dtype=dtype).reshape(-1, 3)
+        self.faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        if colors is None:
+            colors = np.tile(DEFAULT_COLOR, (len(self.verts), 1))
+        self.colors = np.asarray(colors, dtype=dtype).reshape(-1, 3)
+        self.attributes = {} # name -> (V,C) array, see addAttribute
+        self.attribute_rules = {} # name -> 'linear' or 'loop'
+        self.radius = self.computeRadius()
+
+    def __repr__(self):
+        return("array_mesh: " + str(len(self.verts)) + " vertices, " +
+               str(len(self.faces)) + " triangles")
+
+    def computeRadius(self):
+        """ Returns the distance from the origin to the furthest
+        vertex, matching mesh.radius. """
+
+        if len(self.verts) == 0:
+            return 0.0
+        return sqrt(float((self.verts * self.verts).sum(axis=1).max()))
+
+    def addAttribute(self, name, values, rule='linear'):
+        """ Attaches per-vertex channel NAME, a (V,C) or (V,) array of
+        VALUES, carried through subdivision by RULE: 'linear' (new edge
+        vertices take the mean of the edge's ends) or 'loop' (smoothed
+        like the positions). """
+
+        if rule not in ATTRIBUTE_RULES:
+            raise ValueError('attribute rule must be one of ' +
+                             ', '.join(ATTRIBUTE_RULES))
+        values = np.asarray(values, dtype=self.verts.dtype)
+        values = values.reshape(len(self.verts),
+                                values.shape[-1] if values.ndim > 1 else 1)
+        self.attributes[name] = values
+        self.attribute_rules[name] = rule
+
+    def copyAttributes(self, m, rows=None):
+        """ Attaches the channels of array_mesh M, taking only vertices
+        ROWS of each if given. """
+
+        for name, values in m.attributes.items():
+            if rows is not None:
+                values = values[rows]
+            self.addAttribute(name, values, m.attribute_rules[name])
+
+    def oneRing(self):
+        """ Returns the one_ring adjacency of the mesh. """
+
+        return one_ring(self.faces, len(self.verts))
+
+    def normals(self, ring=None):
+        """ Returns (V,3) unit vertex normals, computed by summing the
+        (area weighted) normals of each vertex's adjacent triangles.
+        RING is the mesh's one_ring, if already built. """
+
+        return vertex_normals(self.verts, self.faces, ring)
+
+    def compile(self):
+        """ Returns compiled vertices, normals, colors for VBO, laid out
+        exactly like mesh.compile (three vertices per triangle, no
+        index buffer), as flat float32 arrays. """
+
+        normals = self.normals()
+        corners = self.faces.reshape(-1)
+        vbuf = self.verts[corners].astype(np.float32).reshape(-1)
+        nbuf = normals[corners].astype(np.float32).reshape(-1)
+        cbuf = self.colors[corners].astype(np.float32).reshape(-1)
+        return vbuf, nbuf, cbuf
+
+    def compileIndexed(self, optimize=False):
+        """ Returns compiled vertices, normals, colors and indices for an
+        indexed draw (glDrawElements): flat float32 arrays with one
+        entry per vertex, and a flat uint32 array of three indices per
+        triangle. With OPTIMIZE, triangles and vertices are first
+        reordered for the GPU's vertex cache (see vertex_cache.py). """
+
+        m = self
+        if optimize:
+            from vertex_cache import optimize as reorder # imports us
+            m = reorder(self)
+        normals = m.normals()
+        vbuf = m.verts.astype(np.float32).reshape(-1)
+        nbuf = normals.astype(np.float32).reshape(-1)
+        cbuf = m.colors.astype(np.float32).reshape(-1)
+        ibuf = m.faces.astype(np.uint32).reshape(-1)
+        return vbuf, nbuf, cbuf, ibuf
+
+
+def from_tri_mesh(m, dtype=np.float64):
+    """ Converts a winged half-edge tri_mesh.mesh M into an array_mesh
+    with positions and colors of type DTYPE. Vertices are matched by
+    identity, so this also works on meshes whose vertex index fields are
+    not unique. """
+
+    position = {}
+    verts = []
+    colors = []
+    for v in m.verts:
+        position[id(v)] = len(verts)
+        verts.append(v.loc.components())
+        colors.append(v.color)
+
+    faces = []
+    for tri in m.triangles:
+        row = []
+        for v in tri.verts:
+            if id(v) not in position:
+                # vertex only reachable through a triangle
+                position[id(v)] = len(verts)
+                verts.append(v.loc.components())
+                colors.append(v.color)
+            row.append(position[id(v)])
+        faces.append(row)
+
+    return array_mesh(verts, faces, colors, dtype)
+
+
+def to_tri_mesh(m):
+    """ Builds a winged half-edge tri_mesh.mesh from array_mesh M. """
+
+    from tri_mesh import mesh # needs OpenGL, only import it when asked
+    surf = mesh()
+    surf.build(m.verts.tolist(), m.faces.tolist())
+    for v, c in zip(surf.verts, m.colors.tolist()):
+        v.color = c
+    return surf
+
+
+def load_obj(filename, dtype=np.float64, weld=None):
+    """ Loads the vertices and faces of .obj file FILENAME into an
+    array_mesh with positions of type DTYPE. Polygons with more than
+    three corners are split into a triangle fan. If WELD is given,
+    vertices closer than that tolerance are merged (see weld_mesh), which
+    triangle soups with a copy of each vertex per triangle need.
+    Compressed files (FILENAME.gz, .xz or .zst, see compressed_io) are
+    decompressed as they are read. """
+
+    obj_file = open_file(filename)
+    m = parse_obj(obj_file, dtype, weld)
+    obj_file.close()
+    return m
+
+
+def parse_obj(lines, dtype=np.float64, weld=None):
+    """ Like load_obj, but reads the .obj text from LINES, any iterable
+    of lines (an open file, or text.splitlines()). """
+
+    verts = []
+    faces = []
+    uvs = []
+    vertex_uv = {} # vertex -> its texture coordinate, if all faces agree
+    seams = False
+    for line in lines:
+        parts = line.split()
+        if len(parts) > 0:
+            if parts[0] == 'v':
+                verts.append((float(parts[1]), float(parts[2]),
+                              float(parts[3])))
+            elif parts[0] == 'vt':
+                uvs.append((float(parts[1]), float(parts[2])))
+            elif parts[0] == 'f':
+                # "f 1/1/1 2/2/2 ..." - position and texture indices
+                corners = [p.split('/') for p in parts[1:]]
+                idx = [int(c[0]) for c in corners]
+                idx = [i - 1 if i > 0 else len(verts) + i for i in idx]
+                for k in range(1, len(idx) - 1):
+                    faces.append((idx[0], idx[k], idx[k+1]))
+                for i, c in zip(idx, corners):
+                    if len(c) > 1 and c[1]:
+                        t = int(c[1])
+                        t = t - 1 if t > 0 else len(uvs) + t
+                        seams |= vertex_uv.setdefault(i, t) != t
+
+    m = array_mesh(verts, faces, dtype=dtype)
+    # A vertex with different texture coordinates in different faces
+    # (a seam) would have to be split; such files keep positions only.
+    if vertex_uv and not seams:
+        uv = np.zeros((len(verts), 2))
+        where = np.array(list(vertex_uv.keys()), dtype=np.int64)
+        uv[where] = np.array(uvs)[list(vertex_uv.values())]
+        m.addAttribute('uv', uv, 'linear')
+    if weld is not None:
+        m = weld_mesh(m, weld)
+    return m
+
+
+def load_stl(filename, dtype=np.float64, weld=0.0):
+    """ Loads binary STL file FILENAME into an array_mesh with positions
+    of type DTYPE. STL stores three corners per triangle, so they are
+    merged with weld_mesh at tolerance WELD (0: exact copies). The file
+    is mapped, not read and parsed: the corners are a view of it until
+    welding copies the vertices out; compressed files (see
+    compressed_io) are decompressed into memory instead. Raises
+    ValueError for files that are not binary STL (such as ASCII STL). """
+
+    compressed = compression(filename) is not None
+    if compressed:
+        with open_file(filename, 'rb') as stl_file:
+            data = stl_file.read()
+        size = len(data)
+        head = data[:STL_HEADER]
+    else:
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as stl_file:
+            head = stl_file.read(STL_HEADER)
+    if len(head) < STL_HEADER:
+        raise ValueError('%s: too short for a binary STL file' % filename)
+    count = int(np.frombuffer(head, dtype='<u4', offset=80)[0])
+    if size != STL_HEADER + count * STL_RECORD.itemsize:
+        raise ValueError('%s: not a binary STL file (%d triangles need %d '
+                         'bytes, the file has %d)' %
+                         (filename, count,
+                          STL_HEADER + count * STL_RECORD.itemsize, size))
+    if count == 0:
+        records = np.zeros(0, dtype=STL_RECORD) # nothing to map
+    elif compressed:
+        records = np.frombuffer(data, dtype=STL_RECORD, count=count,
+                                offset=STL_HEADER)
+    else:
+        records = np.memmap(filename, dtype=STL_RECORD, mode='r',
+                            offset=STL_HEADER, shape=(count,))
+    corners = records['corners'].reshape(-1, 3)
+    keep, remap = weld_vertices(corners, weld)
+    faces = drop_collapsed(remap.reshape(-1, 3))
+    m = array_mesh(corners[keep], faces, dtype=dtype)
+    m.vertex_remap = remap
+    return m
+
+
+def write_obj(filename, m):
+    """ Writes the vertices and faces of array_mesh M to .obj file
+    FILENAME, compressed if its name ends in .gz, .xz or .zst. """
+
+    obj_file = open_file(filename, 'w')
+    for v in m.verts:
+        obj_file.write('v %r %r %r\n' % (float(v[0]), float(v[1]),
+                                          float(v[2])))
+    for f in m.faces + 1:
+        obj_file.write('f %d %d %d\n' % (f[0], f[1], f[2]))
+    obj_file.close()
+
+
+def group_keys(keys):
+    """ Groups the equal values of integer array KEYS. Returns (FIRST,
+    INVERSE): FIRST[g] is the index of the first key of group g, groups
+    numbered in order of first appearance, and INVERSE[i] is the group
+    of key i. """
+
+    n = len(keys)
+    order = np.argsort(keys) # not stable, which is twice as fast
+    ordered = keys[order]
+    start = np.empty(n, dtype=bool)
+    start[:1] = True
+    start[1:] = ordered[1:] != ordered[:-1]
+    first = np.minimum.reduceat(order, np.nonzero(start)[0])
+    inverse = np.empty(n, dtype=np.int64)
+    inverse[order] = np.cumsum(start) - 1
+
+    rank = np.argsort(first)
+    renumber = np.empty(len(first), dtype=np.int64)
+    renumber[rank] = np.arange(len(first), dtype=np.int64)
+    return first[rank], renumber[inverse]
+
+
+def mix_bits(x):
+    """ Returns the splitmix64 finaliser of uint64 array X: every bit of
+    the result depends on every bit of X (float32 values widened to
+    float64, with 29 zero low bits, hash as well as any). """
+
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def group_rows(rows):
+    """ Like group_keys, for the rows of an (N,3) integer array. The rows
+    are hashed to one key each; rows are only compared in full to catch
+    the (very unlikely) colliding hashes. """
+
+    bits = rows.view(np.uint64)
+    keys = mix_bits(bits[:, 0])
+    keys = mix_bits(keys ^ bits[:, 1])
+    keys = mix_bits(keys ^ bits[:, 2])
+    first, inverse = group_keys(keys)
+    if (rows == rows[first[inverse]]).all():
+        return first, inverse
+    _, first, inverse = np.unique(rows, axis=0, return_index=True,
+                                  return_inverse=True)
+    return group_keys(first[inverse.reshape(-1)])
+
+
+# the 13 neighbouring cells that come after a cell, so each pair of
+# neighbours is looked at once
+FORWARD_CELLS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                 for dz in (-1, 0, 1) if (dx, dy, dz) > (0, 0, 0)]
+
+
+def weld_vertices(verts, tolerance=0.0):
+    """ Finds the vertices of (V,3) VERTS that coincide and returns
+    (KEEP, REMAP): KEEP lists the first vertex of each group of
+    coincident ones, in order, and REMAP[v] is the index in KEEP of v's
+    group.
+
+    With TOLERANCE 0 only exact copies coincide. Otherwise positions are
+    quantised to a grid of cells TOLERANCE wide: the vertices of a cell
+    coincide, and so do those of neighbouring cells whose first vertices
+    are at most TOLERANCE apart, which catches copies that rounding put
+    on either side of a cell wall. Grouping is a sort of one integer key
+    per vertex; on grids too fine to number every cell with one int64
+    (more than about 2^20 cells along each axis) the cells are hashed
+    and the neighbour pass is skipped. """
+
+    verts = np.asarray(verts, dtype=np.float64)
+    if len(verts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if tolerance <= 0.0:
+        # + 0.0 turns -0.0 into 0.0, which must weld with it
+        return group_rows(np.ascontiguousarray(verts + 0.0).view(np.int64))
+
+    cells = np.floor(verts / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1 # keep a free cell below the lowest
+    span = cells.max(axis=0) + 2 # ... and above the highest
+    if float(span[0]) * float(span[1]) * float(span[2]) >= 2.0**62:
+        return group_rows(cells)
+
+    keys = (cells[:, 0] * span[1] + cells[:, 1]) * span[2] + cells[:, 2]
+    first, inverse = group_keys(keys)
+
+    # Neighbouring cells whose first vertices are close are joined.
+    # Adding a constant to the sorted cell keys keeps them sorted, so
+    # each neighbour lookup is one pass of searchsorted.
+    order = np.argsort(keys[first])
+    ordered = keys[first][order]
+    a = []
+    b = []
+    for dx, dy, dz in FORWARD_CELLS:
+        wanted = ordered + (dx * span[1] + dy) * span[2] + dz
+        at = np.minimum(np.searchsorted(ordered, wanted), len(ordered) - 1)
+        hit = np.nonzero(ordered[at] == wanted)[0]
+        near = verts[first[order[hit]]] - verts[first[order[at[hit]]]]
+        close = (near * near).sum(axis=1) <= tolerance * tolerance
+        a.append(order[hit[close]])
+        b.append(order[at[hit[close]]])
+    a = np.concatenate(a)
+    b = np.concatenate(b)
+    if len(a) == 0:
+        return first, inverse
+
+    # Each group of joined cells is labelled with its smallest cell,
+    # which also has the group's first vertex: hook labels onto the
+    # smaller one across every joined pair, then jump to the roots,
+    # until nothing changes.
+    label = np.arange(len(first), dtype=np.int64)
+    while True:
+        la = label[a]
+        lb = label[b]
+        if (la == lb).all():
+            break
+        low = np.minimum(la, lb)
+        np.minimum.at(label, la, low)
+        np.minimum.at(label, lb, low)
+        while True:
+            jumped = label[label]
+            if (jumped == label).all():
+                break
+            label = jumped
+
+    roots = np.unique(label)
+    return first[roots], np.searchsorted(roots, label)[inverse]
+
+
+def drop_collapsed(faces):
+    """ Returns the triangles of FACES whose three corners are
+    different vertices. """
+
+    return faces[(faces[:, 0] != faces[:, 1]) &
+                 (faces[:, 1] != faces[:, 2]) &
+                 (faces[:, 2] != faces[:, 0])]
+
+
+def weld_mesh(m, tolerance=0.0):
+    """ Returns a copy of array_mesh M with its coincident vertices (see
+    weld_vertices) merged into one, each keeping the color and
+    attributes of the first. Triangles left with two corners on the
+    same vertex are dropped. The copy's vertex_remap maps each vertex of
+    M to its vertex in the copy. """
+
+    keep, remap = weld_vertices(m.verts, tolerance)
+    faces = drop_collapsed(remap[m.faces])
+    out = array_mesh(m.verts[keep], faces, m.colors[keep], m.verts.dtype)
+    out.copyAttributes(m, keep)
+    out.vertex_remap = remap
+    return out
+
+
+def unique_edges(faces, nverts):
+    """ Finds the undirected edges of triangles FACES over NVERTS
+    vertices. Returns (EDGES, FACE_EDGES, COUNTS):
+
+    EDGES is an (E,2) array of vertex pairs, smaller index first.
+    FACE_EDGES is an (F,3) array; FACE_EDGES[f,i] is the edge running
+    from corner i to corner i+1 of face f.
+    COUNTS[e] is the number of faces using edge e: 2 for an interior
+    edge, 1 for a boundary edge, more for a non-manifold one. """
+
+    faces = np.asarray(faces, dtype=np.int64)
+    a = faces.reshape(-1)
+    b = faces[:, [1, 2, 0]].reshape(-1)
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+
+    # one integer key per edge is much faster than np.unique(axis=0)
+    key = lo * nverts + hi
+    ukey, inverse, counts = np.unique(key, return_inverse=True,
+                                      return_counts=True)
+    edges = np.stack([ukey // nverts, ukey % nverts], axis=1)
+    return edges, inverse.reshape(-1, 3), counts
+
+
+class one_ring:
+    # Per-vertex adjacency of a triangle list, in compressed sparse row
+    # form. The neighbours of vertex v are
+    #
+    #    neighbours[ring_offsets[v]:ring_offsets[v+1]]
+    #
+    # (sorted), and the triangles using it are
+    #
+    #    faces[face_offsets[v]:face_offsets[v+1]]
+    #
+    # (built on demand by incident(), as subdivision does not need it).
+    #
+    # kind[v] is INTERIOR, BOUNDARY, NONMANIFOLD or ISOLATED. It is
+    # computed for all vertices at once: the triangles around a vertex
+    # are joined wherever they share an edge at that vertex, and a
+    # vertex is manifold if that leaves exactly one fan.
+
+    def __init__(self, faces, nverts):
+
+        faces = np.asarray(faces, dtype=np.int64)
+        self.nverts = nverts
+        self.edges, self.face_edges, self.counts = unique_edges(faces,
+                                                                nverts)
+        edges = self.edges
+
+        # slots[first[e]:first[e] + counts[e]] are the positions in
+        # face_edges.reshape(-1) that use edge e
+        self.slots = np.argsort(self.face_edges.reshape(-1), kind='stable')
+        self.first = np.cumsum(self.counts) - self.counts
+        boundary = self.counts == 1
+
+        # neighbours: each edge seen from both ends
+        src = np.concatenate([edges[:, 0], edges[:, 1]])
+        dst = np.concatenate([edges[:, 1], edges[:, 0]])
+        order = np.argsort(src * nverts + dst, kind='stable') # two runs
+        self.neighbours = dst[order]
+        self.ring_edges = np.concatenate([np.arange(len(edges))] * 2)[order]
+        self.valence = np.bincount(src, minlength=nverts)
+        self.ring_offsets = offsets_from_counts(self.valence)
+
+        # incident faces
+        corners = faces.reshape(-1)
+        self.corners = corners
+        self.face_count = np.bincount(corners, minlength=nverts)
+        self.faces = None
+        self.face_offsets = None
+
+        self.boundary_count = np.bincount(
+            np.concatenate([edges[boundary, 0], edges[boundary, 1]]),
+            minlength=nverts)
+        self.kind = self.classify(faces, corners)
+
+    def classify(self, faces, corners):
+        """ Returns the kind of every vertex (see one_ring) for triangles
+        FACES whose flattened corners are CORNERS. """
+
+        nverts = self.nverts
+        fans = np.zeros(nverts, dtype=np.int64)
+        if len(faces):
+            # Join the two corners at each end of every edge shared by
+            # exactly two triangles, then count the groups of corners at
+            # each vertex. Each group is one fan. Corner a has edge e
+            # leaving it, corner b has e coming in.
+            shared = np.nonzero(self.counts == 2)[0]
+            s0 = self.slots[self.first[shared]]
+            s1 = self.slots[self.first[shared] + 1]
+            a0, b0 = s0, s0 - s0 % 3 + (s0 % 3 + 1) % 3
+            a1, b1 = s1, s1 - s1 % 3 + (s1 % 3 + 1) % 3
+            same = corners[a0] == corners[a1] # faces disagree on orientation
+
+            # every corner has at most one partner across its outgoing
+            # edge and one across its incoming edge
+            index = np.int32 if len(corners) < 2**31 else np.int64
+            out_partner = np.arange(len(corners), dtype=index)
+            in_partner = out_partner.copy()
+            out_partner[a0] = np.where(same, a1, b1)
+            out_partner[a1] = np.where(same, a0, b0)
+            in_partner[b0] = np.where(same, b1, a1)
+            in_partner[b1] = np.where(same, b0, a0)
+
+            labels = fan_labels(out_partner, in_partner)
+            roots = labels == np.arange(len(corners), dtype=index)
+            fans = np.bincount(corners[roots], minlength=nverts)
+
+        crowded = np.zeros(nverts, dtype=bool)
+        crowded[self.edges[self.counts > 2].reshape(-1)] = True
+
+        kind = np.full(nverts, NONMANIFOLD, dtype=np.int8)
+        single = (fans == 1) & ~crowded
+        kind[single & (self.boundary_count == 0)] = INTERIOR
+        kind[single & (self.boundary_count == 2)] = BOUNDARY
+        kind[self.face_count == 0] = ISOLATED
+        return kind
+
+    def incident(self):
+        """ Builds faces and face_offsets, the triangles around each
+        vertex. Returns (face_offsets, faces). """
+
+        if self.faces is None:
+            self.faces = np.argsort(self.corners, kind='stable') // 3
+            self.face_offsets = offsets_from_counts(self.face_count)
+        return self.face_offsets, self.faces
+
+    def rows(self):
+        """ Returns the vertex of every entry of neighbours, i.e. the row
+        index matching each column index. """
+
+        return np.repeat(np.arange(self.nverts, dtype=np.int64),
+                         self.valence)
+
+
+def offsets_from_counts(counts):
+    """ Returns the compressed sparse row offsets for rows of COUNTS
+    entries each. """
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def csr_sum(values, offsets):
+    """ Sums the (N,C) VALUES over each compressed sparse row of
+    OFFSETS. Empty rows sum to zero. """
+
+    nrows = len(offsets) - 1
+    totals = np.zeros((nrows,) + values.shape[1:], dtype=values.dtype)
+    full = np.nonzero(offsets[1:] > offsets[:-1])[0]
+    if len(full):
+        totals[full] = np.add.reduceat(values, offsets[full], axis=0)
+    return totals
+
+
+def fan_labels(out_partner, in_partner):
+    """ Labels the nodes of a graph in which node i is joined to
+    OUT_PARTNER[i] and IN_PARTNER[i] (itself for no partner). Returns
+    the smallest node of each node's connected component. """
+
+    labels = np.arange(len(out_partner), dtype=out_partner.dtype)
+    while True:
+        new = np.minimum(labels, np.minimum(labels[out_partner],
+                                            labels[in_partner]))
+        new = new[new] # jump to the label's own label
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def face_neighbours(faces, nverts):
+    """ Finds the triangles across each edge of FACES over NVERTS
+    vertices. Returns (NEIGHBOURS, SAME), two (F,3) arrays:
+
+    NEIGHBOURS[f,i] is the face across the edge from corner i to corner
+    i+1 of face f, or f itself if that edge is a boundary edge or is
+    shared by more than two faces.
+    SAME[f,i] is set where that face runs along the edge in the same
+    direction as f, i.e. the two faces disagree on orientation. """
+
+    faces = np.asarray(faces, dtype=np.int64)
+    edges, face_edges, counts = unique_edges(faces, nverts)
+    slots = np.argsort(face_edges.reshape(-1), kind='stable')
+    first = np.cumsum(counts) - counts
+    shared = np.nonzero(counts == 2)[0]
+    s0 = slots[first[shared]]
+    s1 = slots[first[shared] + 1]
+    apart = s0 // 3 != s1 // 3 # skip degenerate faces that meet themselves
+    s0, s1 = s0[apart], s1[apart]
+
+    corners = faces.reshape(-1)
+    neighbours = np.repeat(np.arange(len(faces), dtype=np.int64), 3)
+    same = np.zeros(3 * len(faces), dtype=bool)
+    neighbours[s0] = s1 // 3
+    neighbours[s1] = s0 // 3
+    same[s0] = same[s1] = corners[s0] == corners[s1]
+    return neighbours.reshape(-1, 3), same.reshape(-1, 3)
+
+
+def orient_faces(faces, nverts):
+    """ Orients every connected piece of triangles FACES (over NVERTS
+    vertices) consistently, keeping the orientation most of its faces
+    already have. Returns (ORIENTED, FLIPPED, COMPONENT, ORIENTABLE):
+
+    ORIENTED is a copy of FACES with the FLIPPED rows reversed.
+    COMPONENT[f] numbers the piece face f belongs to (pieces meet only
+    at edges used by exactly two faces).
+    ORIENTABLE[c] is False for a piece that cannot be oriented (a
+    Moebius strip, say); its faces are left as they came out. """
+
+    faces = np.asarray(faces, dtype=np.int64)
+    neighbours, same = face_neighbours(faces, nverts)
+    nfaces = len(faces)
+    rows = np.arange(nfaces, dtype=np.int64)
+
+    # Union-find with parity, done for all faces at once: every face
+    # points at the smallest face it is known to be connected to (its
+    # root), and PARITY says whether it must be flipped relative to it.
+    # Each round a face takes the smallest root among its neighbours,
+    # then jumps to its root's root.
+    root = rows.copy()
+    parity = np.zeros(nfaces, dtype=bool)
+    while True:
+        candidates = root[neighbours]
+        best = np.argmin(candidates, axis=1)
+        low = candidates[rows, best]
+        lower = low < root
+        new_root = np.where(lower, low, root)
+        new_parity = np.where(lower, (parity[neighbours] ^ same)[rows, best],
+                              parity)
+
+        new_parity = new_parity ^ new_parity[new_root]
+        new_root = new_root[new_root]
+        if np.array_equal(new_root, root):
+            break
+        root, parity = new_root, new_parity
+
+    roots, component = np.unique(root, return_inverse=True)
+    ncomponents = len(roots)
+
+    # every shared edge must now agree
+    wrong = (parity[:, None] ^ parity[neighbours]) != same
+    orientable = np.ones(ncomponents, dtype=bool)
+    orientable[component[wrong.any(axis=1)]] = False
+
+    # flip whichever side of each piece is smaller
+    flips = np.bincount(component, parity, minlength=ncomponents)
+    sizes = np.bincount(component, minlength=ncomponents)
+    flipped = parity ^ (flips > sizes / 2.0)[component]
+
+    oriented = faces.copy()
+    oriented[flipped] = faces[flipped, ::-1]
+    return oriented, flipped, component, orientable
+
+
+def vertex_normals(verts, faces, ring=None):
+    """ Returns (V,3) unit normals for VERTS, the sum of the normals of
+    the FACES around each vertex. RING is the faces' one_ring, if
+    already built. """
+
+    p0 = verts[faces[:, 0]]
+    p1 = verts[faces[:, 1]]
+    p2 = verts[faces[:, 2]]
+    fn = np.cross(p1 - p0, p2 - p0)
+
+    if ring is not None:
+        offsets, incident = ring.incident()
+        normals = csr_sum(fn[incident], offsets)
+    else:
+        corners = faces.reshape(-1)
+        normals = np.stack([np.bincount(corners, np.repeat(fn[:, i], 3),
+                                        minlength=len(verts))
+                            for i in range(3)], axis=1).astype(verts.dtype)
+    length = np.sqrt((normals * normals).sum(axis=1))
+    length[length == 0.0] = 1.0
+    return normals / length[:, None]
+
+
+def csr_positions(offsets, rows):
+    """ Given the OFFSETS array of a compressed sparse row layout,
+    returns (POSITIONS, STARTS): the flat positions of every entry in
+    ROWS, in order, and where each row's entries begin in POSITIONS. """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    first = offsets[rows]
+    counts = offsets[rows + 1] - first
+    starts = np.cumsum(counts) - counts
+    positions = (np.arange(counts.sum(), dtype=np.int64) +
+                 np.repeat(first - starts, counts))
+    return positions, starts
+
+
+def index_ranges(indices):
+    """ Compresses a sorted array of unique INDICES into a list of
+    half-open (start, stop) ranges of consecutive values. """
+
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return []
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    starts = indices[np.concatenate(([0], breaks))]
+    stops = indices[np.concatenate((breaks - 1, [len(indices) - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
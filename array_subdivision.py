@@ -0,0 +1,307 @@
+#
+# array_subdivision.py
+#
+# Vectorized Loop subdivision on array meshes (see array_mesh.py).
+#
+# Each level of subdivision is described by a sparse "stencil": every
+# vertex of the finer mesh is a weighted sum of a few vertices of the
+# coarser mesh. The stencil only depends on connectivity, so it is
+# computed once per level and can then be applied to positions, colors
+# or anything else stored per vertex.
+#
+# The rules are the same ones used in loop_subdivision.py:
+#
+#    even (old) interior vertex:  (1 - n*beta) v + beta * sum(ring)
+#    even boundary vertex:        3/4 v + 1/8 v0 + 1/8 v1
+#    odd (edge) interior vertex:  3/8 (v0 + v1) + 1/8 (f0 + f1)
+#    odd boundary vertex:         1/2 (v0 + v1)
+#
+# limit_stencil gives the positions the surface converges to, with the
+# same kind of rule (see limit_weight).
+#
+# Positions and the attributes smoothed like them (array_mesh's 'loop'
+# channels) go through the stencil as one array, and colors and 'linear'
+# channels through one gather of edge ends, however many channels there
+# are (see stack_channels).
+#
+# Whether an old vertex is interior or on the boundary comes from the
+# one_ring classification in array_mesh.py. There is no separate corner
+# rule: a boundary corner (such as a valence 2 vertex with a single
+# triangle) is a BOUNDARY vertex and moves by the boundary rule, as in
+# loop_subdivision.py. Only non-manifold vertices (several fans, or a
+# fin edge) and isolated ones are left where they are.
+#
+# Vertices of the finer mesh are numbered with the old vertices first,
+# followed by one new vertex per edge of the coarser mesh.
+
+import numpy as np
+from array_mesh import array_mesh, one_ring, csr_positions, \
+     offsets_from_counts, INTERIOR, BOUNDARY
+
+
+class stencil:
+    # Sparse weights mapping coarse vertex data to fine vertex data,
+    # stored in compressed sparse row form: the entries of fine vertex
+    # r are indices[offsets[r]:offsets[r+1]], with matching weights.
+
+    def __init__(self, offsets, indices, weights, ncols):
+        self.offsets = offsets
+        self.indices = indices
+        self.weights = weights
+        self.ncols = ncols # number of coarse vertices
+        self.rows = None # transposed layout, built on demand
+        self.row_offsets = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def apply(self, data):
+        """ Returns the fine vertex values for coarse per-vertex DATA,
+        an (ncols, C) array. """
+
+        values = data[self.indices] * self.weights_for(data)[:, None]
+        return np.add.reduceat(values, self.offsets[:-1], axis=0)
+
+    def apply_rows(self, rows, data):
+        """ Like apply, but only computes the fine vertices listed in
+        ROWS. """
+
+        if len(rows) == 0:
+            return np.zeros((0, data.shape[1]), dtype=data.dtype)
+        positions, starts = csr_positions(self.offsets, rows)
+        values = data[self.indices[positions]] * \
+                 self.weights_for(data)[positions, None]
+        return np.add.reduceat(values, starts, axis=0)
+
+    def weights_for(self, data):
+        """ Returns the weights in the precision of DATA, so float32 data
+        stays float32. """
+
+        if data.dtype == self.weights.dtype or data.dtype.kind != 'f':
+            return self.weights
+        return self.weights.astype(data.dtype)
+
+    def dependents(self, cols):
+        """ Returns the sorted fine vertices whose values depend on any of
+        the coarse vertices COLS. """
+
+        if self.rows is None:
+            self.transpose()
+        positions, starts = csr_positions(self.row_offsets, cols)
+        return np.unique(self.rows[positions])
+
+    def transpose(self):
+        """ Builds the column-major view of the stencil used by
+        dependents(). """
+
+        counts = np.diff(self.offsets)
+        rows = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        order = np.argsort(self.indices, kind='stable')
+        self.rows = rows[order]
+        self.row_offsets = np.zeros(self.ncols + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=self.ncols),
+                  out=self.row_offsets[1:])
+
+
+def beta(n):
+    """ Vectorized version of loop_subdivision.Beta, the weight given to
+    each ring vertex of an interior fan of N vertices. """
+
+    n = np.asarray(n, dtype=np.float64)
+    return (1/n)*((5/8) - ((3/8) + 0.25*np.cos(2*np.pi/n))**2)
+
+
+def limit_weight(n):
+    """ The weight given to each ring vertex of an interior fan of N
+    vertices by the Loop limit position mask. """
+
+    n = np.asarray(n, dtype=np.float64)
+    return 1.0 / (3.0 / (8.0 * beta(n)) + n)
+
+
+def vertex_rule(ring, ring_weight, crease_self, crease_weight):
+    """ Builds the stencil rows of a rule that moves every vertex of
+    one_ring RING: an interior vertex of valence n (at least 3) becomes
+    (1 - n*w) v + w * sum(ring), with w = RING_WEIGHT(n); a boundary
+    vertex, corners of valence 2 included, becomes CREASE_SELF v +
+    CREASE_WEIGHT (v0 + v1), v0 and v1 being its neighbours along the
+    boundary; anything else (non-manifold, isolated, or an interior
+    vertex of valence below 3) stays put. Returns (OFFSETS, COLUMNS,
+    WEIGHTS) in compressed sparse row form, each row starting with the
+    vertex itself. """
+
+    nverts = ring.nverts
+    src = ring.rows()
+    dst = ring.neighbours
+    on_border = ring.counts[ring.ring_edges] == 1
+    valence = ring.valence
+
+    smooth = (ring.kind == INTERIOR) & (valence >= 3)
+    crease = ring.kind == BOUNDARY
+
+    n = np.maximum(valence, 3)
+    w = ring_weight(n)
+    self_w = np.ones(nverts)
+    self_w[smooth] = (1 - n*w)[smooth]
+    self_w[crease] = crease_self
+
+    used = np.nonzero(smooth[src] | (crease[src] & on_border))[0]
+    used_src = src[used]
+    used_count = np.bincount(used_src, minlength=nverts)
+    offsets = offsets_from_counts(used_count + 1)
+    rank = np.arange(len(used)) - offsets_from_counts(used_count)[used_src]
+    at = offsets[used_src] + 1 + rank
+
+    cols = np.empty(offsets[-1], dtype=np.int64)
+    weights = np.empty(offsets[-1])
+    cols[offsets[:-1]] = np.arange(nverts)
+    weights[offsets[:-1]] = self_w
+    cols[at] = dst[used]
+    weights[at] = np.where(smooth[used_src], w[used_src], crease_weight)
+    return offsets, cols, weights
+
+
+def limit_stencil(faces, nverts):
+    """ Returns the stencil taking the vertices of triangles FACES (over
+    NVERTS vertices) to their Loop limit positions: where they end up
+    after infinitely many levels of subdivision. """
+
+    ring = one_ring(faces, nverts)
+    offsets, cols, weights = vertex_rule(ring, limit_weight, 2/3, 1/6)
+    return stencil(offsets, cols, weights, nverts)
+
+
+def limit_positions(m):
+    """ Returns the Loop limit positions of the vertices of array_mesh
+    M, in M's precision. """
+
+    return limit_stencil(m.faces, len(m.verts)).apply(m.verts)
+
+
+def loop_stencil(faces, nverts):
+    """ Computes one level of Loop subdivision for triangles FACES over
+    NVERTS vertices. Returns (STENCIL, NEWFACES, EDGES): the stencil
+    producing the fine vertices, the (4F,3) fine triangles and the (E,2)
+    coarse edges that each odd vertex was split from. """
+
+    faces = np.asarray(faces, dtype=np.int64)
+    ring = one_ring(faces, nverts)
+    edges, face_edges, counts = ring.edges, ring.face_edges, ring.counts
+    interior = counts == 2
+
+    # The stencil rows are filled in place: even vertex v's entries are
+    # itself followed by the ring vertices it uses (see vertex_rule),
+    # and odd vertex e's are its edge's two ends followed by the two
+    # opposite vertices.
+
+    # ---- even vertices, one per old vertex ----
+    even_offsets, even_cols, even_w = vertex_rule(ring, beta, 3/4, 1/8)
+
+    # ---- odd vertices, one per edge ----
+    # The two vertices opposite an interior edge are the third corners
+    # of its two triangles.
+    opposite = faces[:, [2, 0, 1]].reshape(-1)
+    inner = np.nonzero(interior)[0]
+    outer = np.nonzero(~interior)[0]
+    f0 = opposite[ring.slots[ring.first[inner]]]
+    f1 = opposite[ring.slots[ring.first[inner] + 1]]
+
+    odd_offsets = offsets_from_counts(np.where(interior, 4, 2))
+    odd_cols = np.empty(odd_offsets[-1], dtype=np.int64)
+    odd_w = np.empty(odd_offsets[-1])
+    at = odd_offsets[inner]
+    odd_cols[at] = edges[inner, 0]
+    odd_cols[at + 1] = edges[inner, 1]
+    odd_cols[at + 2] = f0
+    odd_cols[at + 3] = f1
+    odd_w[at] = odd_w[at + 1] = 3/8
+    odd_w[at + 2] = odd_w[at + 3] = 1/8
+    at = odd_offsets[outer]
+    odd_cols[at] = edges[outer, 0]
+    odd_cols[at + 1] = edges[outer, 1]
+    odd_w[at] = odd_w[at + 1] = 1/2
+
+    offsets = np.concatenate([even_offsets, odd_offsets[1:] +
+                              even_offsets[-1]])
+    st = stencil(offsets, np.concatenate([even_cols, odd_cols]),
+                 np.concatenate([even_w, odd_w]), nverts)
+
+    # ---- new triangles ----
+    # Each triangle (a, b, c) with edge vertices ab, bc, ca becomes four
+    # triangles, keeping the orientation of the original.
+    a, b_, c = faces[:, 0], faces[:, 1], faces[:, 2]
+    ab = face_edges[:, 0] + nverts
+    bc = face_edges[:, 1] + nverts
+    ca = face_edges[:, 2] + nverts
+    newfaces = np.stack([
+        np.stack([a, ab, ca], axis=1),
+        np.stack([ab, b_, bc], axis=1),
+        np.stack([ca, bc, c], axis=1),
+        np.stack([ab, bc, ca], axis=1)], axis=1).reshape(-1, 3)
+
+    return st, newfaces, edges
+
+
+def stack_channels(m):
+    """ Returns the per-vertex data of array_mesh M as two arrays, so a
+    level of subdivision moves all of it in two passes: (SMOOTH, LINEAR,
+    NAMES). SMOOTH is the positions followed by the columns of every
+    'loop' attribute, LINEAR the colors followed by every 'linear' one,
+    and NAMES lists the attributes (name, in SMOOTH, first column,
+    width) for split_channels. """
+
+    smooth = [m.verts]
+    linear = [m.colors]
+    names = []
+    for name, values in m.attributes.items():
+        in_smooth = m.attribute_rules[name] == 'loop'
+        group = smooth if in_smooth else linear
+        names.append((name, in_smooth, sum(a.shape[1] for a in group),
+                      values.shape[1]))
+        group.append(values)
+    if len(smooth) > 1:
+        smooth = np.concatenate(smooth, axis=1)
+    else:
+        smooth = smooth[0]
+    if len(linear) > 1:
+        linear = np.concatenate(linear, axis=1)
+    else:
+        linear = linear[0]
+    return smooth, linear, names
+
+
+def split_channels(smooth, linear, names, faces, dtype):
+    """ Builds an array_mesh with triangles FACES from the SMOOTH and
+    LINEAR data and attribute NAMES of stack_channels. """
+
+    m = array_mesh(np.ascontiguousarray(smooth[:, :3]), faces,
+                   np.ascontiguousarray(linear[:, :3]), dtype)
+    for name, in_smooth, first, width in names:
+        data = smooth if in_smooth else linear
+        m.addAttribute(name, np.ascontiguousarray(data[:, first:first+width]),
+                       'loop' if in_smooth else 'linear')
+    return m
+
+
+def edge_midpoints(data, edges):
+    """ Returns per-vertex DATA extended with the mean of the two ends
+    of each of the (E,2) EDGES, the linear rule for odd vertices. """
+
+    return np.concatenate([data, 0.5*(data[edges[:, 0]] +
+                                      data[edges[:, 1]])])
+
+
+def loop_subdivide(m, levels=1):
+    """ Performs LEVELS levels of Loop subdivision on array_mesh M and
+    returns the subdivided array_mesh. Colors are copied for old
+    vertices and averaged along edges, as in loop_subdivision; the
+    attributes follow their rules. The result keeps M's precision. """
+
+    smooth, linear, names = stack_channels(m)
+    faces = m.faces
+    for i in range(levels):
+        st, faces, edges = loop_stencil(faces, len(smooth))
+        smooth = st.apply(smooth)
+        linear = edge_midpoints(linear, edges)
+
+    return split_channels(smooth, linear, names, faces, m.verts.dtype)
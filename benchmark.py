@@ -0,0 +1,211 @@
+#
+# benchmark.py
+#
+# Reproducible timings for the main phases of the program:
+#
+#    load:      mesh.load (parsing, edge pairing, shadows and spins)
+#    spin:      mesh.assignSpins on its own (orient_faces for arrays)
+#    subdivide: all levels of subdivision up to the case's level
+#    compile:   building the VBO arrays of the final level
+#
+# Each case (engine, mesh, level) runs in a fresh Python process so the
+# peak resident set size it reports belongs to that case alone. Results
+# are written as JSON and can be compared against a stored baseline:
+#
+#    python3 benchmark.py --levels 3 --output bench.json
+#    python3 benchmark.py --baseline bench.json --threshold 0.15
+#
+# The "object" engine is the winged half-edge code in tri_mesh.py and
+# loop_subdivision.py, the "array" engine is array_subdivision.py.
+# Besides objects/*.obj, larger "generated" meshes from
+# mesh_generators.py are written to a temporary directory.
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+TIMINGS = ['load_s', 'spin_s', 'subdivide_s', 'compile_s']
+GENERATED = [('icosphere', 5000), ('torus', 5000), ('grid', 5000),
+             ('noisy', 5000), ('icosphere', 80000), ('torus', 80000)]
+
+
+def run_case(engine, filename, level, repeat):
+    """ Runs one benchmark case in this process and returns its results.
+    Every phase is run REPEAT times and the fastest time is kept. """
+
+    result = {}
+    best = dict((k, float('inf')) for k in TIMINGS)
+
+    def timed(key, func, *args):
+        start = time.perf_counter()
+        value = func(*args)
+        best[key] = min(best[key], time.perf_counter() - start)
+        return value
+
+    # loop_subdivision prints progress; keep it out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            if engine == 'object':
+                from tri_mesh import mesh
+                from loop_subdivision import subdivide
+                m = mesh()
+                timed('load_s', m.load, filename)
+                for tri in m.triangles:
+                    tri.visited = False
+                timed('spin_s', m.assignSpins)
+                m = timed('subdivide_s', subdivide, m, level)
+                buffers = timed('compile_s', m.compile)
+                result['vertices'] = len(m.verts)
+                result['triangles'] = len(m.triangles)
+                result['edges'] = len(m.edges)
+            else:
+                from array_mesh import load_obj, orient_faces
+                from array_subdivision import loop_subdivide
+                m = timed('load_s', load_obj, filename)
+                timed('spin_s', orient_faces, m.faces, len(m.verts))
+                m = timed('subdivide_s', loop_subdivide, m, level)
+                buffers = timed('compile_s', m.compile)
+                result['vertices'] = len(m.verts)
+                result['triangles'] = len(m.faces)
+
+    result.update(best)
+    result['buffer_floats'] = sum(len(b) for b in buffers)
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def make_generated(directory):
+    """ Writes the generated benchmark meshes into DIRECTORY and returns
+    a list of (name, filename). """
+
+    from array_mesh import write_obj
+    from mesh_generators import GENERATORS
+
+    meshes = []
+    for kind, faces in GENERATED:
+        name = kind + '-' + str(faces)
+        filename = os.path.join(directory, name + '.obj')
+        write_obj(filename, GENERATORS[kind](faces))
+        meshes.append(('generated/' + name, filename))
+    return meshes
+
+
+def run_suite(args):
+    """ Runs every case of the suite, each in its own process. Returns a
+    dictionary of results keyed by "engine/mesh/Llevel". """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    files = args.objects or sorted(glob.glob(os.path.join(here, 'objects',
+                                                          '*.obj')))
+    meshes = [(os.path.relpath(f, here), f) for f in files]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.no_generated:
+            meshes += make_generated(tmp)
+
+        for engine in args.engines:
+            for name, filename in meshes:
+                for level in range(args.levels + 1):
+                    key = engine + '/' + name + '/L' + str(level)
+                    cmd = [sys.executable, os.path.abspath(__file__),
+                           '--case', engine, filename, str(level),
+                           '--repeat', str(args.repeat)]
+                    proc = subprocess.run(cmd, cwd=here, capture_output=True,
+                                          text=True, timeout=args.timeout)
+                    if proc.returncode != 0:
+                        error = (proc.stderr.strip().splitlines() or ['?'])[-1]
+                        print(key + ': FAILED (' + error + ')')
+                        continue
+                    results[key] = json.loads(proc.stdout.splitlines()[-1])
+                    print(format_result(key, results[key]))
+                    sys.stdout.flush()
+
+    return results
+
+
+def format_result(key, r):
+    """ Returns a one line description of result R of case KEY. """
+    return ('%-44s load %8.4f  spin %8.4f  subdiv %8.4f  compile %8.4f s'
+            '  %7d tris  %8d KB' %
+            (key, r['load_s'], r['spin_s'], r['subdivide_s'], r['compile_s'],
+             r['triangles'], r['peak_rss_kb']))
+
+
+def compare(results, baseline, threshold):
+    """ Compares RESULTS to BASELINE, printing every timing or peak RSS
+    that grew by more than THRESHOLD (a fraction). Returns the number of
+    regressions found. """
+
+    regressions = 0
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for metric in TIMINGS + ['peak_rss_kb']:
+            old = baseline[key].get(metric)
+            new = results[key].get(metric)
+            if not old or new is None:
+                continue
+            if new > old * (1.0 + threshold):
+                regressions += 1
+                print('REGRESSION %s %s: %.4g -> %.4g (%+.1f%%)' %
+                      (key, metric, old, new, 100.0 * (new / old - 1.0)))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark load, spin, subdivide and compile.')
+    parser.add_argument('objects', nargs='*',
+                        help='.obj files (default: objects/*.obj)')
+    parser.add_argument('--levels', type=int, default=2,
+                        help='benchmark subdivision levels 0..LEVELS')
+    parser.add_argument('--engines', nargs='+', default=['object', 'array'],
+                        choices=['object', 'array'])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case, the fastest is kept')
+    parser.add_argument('--no-generated', action='store_true',
+                        help='skip the generated meshes')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown before reporting a regression')
+    parser.add_argument('--timeout', type=float, default=3600.0,
+                        help='seconds allowed per case')
+    parser.add_argument('--case', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.case:
+        # child process: run a single case and report it as JSON
+        engine, filename, level = args.case
+        print(json.dumps(run_case(engine, filename, int(level), args.repeat)))
+        return 0
+
+    results = run_suite(args)
+
+    if args.output:
+        out = open(args.output, 'w')
+        json.dump(results, out, indent=1, sort_keys=True)
+        out.close()
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline))
+        regressions = compare(results, baseline, args.threshold)
+        print(str(regressions) + ' regression(s) over ' +
+              str(int(100 * args.threshold)) + '%.')
+        if regressions > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
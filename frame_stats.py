@@ -0,0 +1,62 @@
+#
+# frame_stats.py
+#
+# Collects per-frame timings for the viewer: CPU time spent in draw(),
+# and GPU time of the surface and shadow passes (measured by newview
+# with timer queries). Keeps a rolling window for the on-screen overlay
+# and the periodic log line, and every sample for --bench-frames runs.
+
+from collections import deque
+import numpy as np
+
+
+class frame_stats:
+    # Rolling and total frame time samples, in milliseconds.
+
+    def __init__(self, window=120):
+
+        self.cpu = deque(maxlen=window) # CPU time in draw()
+        self.gpu = deque(maxlen=window) # GPU time, both passes
+        self.shadow = deque(maxlen=window) # GPU time, shadow pass only
+        self.all_cpu = []
+        self.all_gpu = []
+        self.triangles = 0 # triangles drawn in the last frame
+        self.buffer_bytes = 0 # bytes held in vertex buffers
+
+    def addCpu(self, ms):
+        """ Records the CPU time of one frame, MS milliseconds. """
+        self.cpu.append(ms)
+        self.all_cpu.append(ms)
+
+    def addGpu(self, surface_ms, shadow_ms):
+        """ Records the GPU time of one frame's surface and shadow
+        passes. """
+        self.gpu.append(surface_ms + shadow_ms)
+        self.shadow.append(shadow_ms)
+        self.all_gpu.append(surface_ms + shadow_ms)
+
+    def summary(self):
+        """ Returns a one line description of the recent frames. """
+
+        def mean(samples):
+            if len(samples) == 0:
+                return 0.0
+            return sum(samples) / len(samples)
+
+        return ("cpu %.2f ms  gpu %.2f ms (shadow %.2f)  %d tris  %.1f MB" %
+                (mean(self.cpu), mean(self.gpu), mean(self.shadow),
+                 self.triangles, self.buffer_bytes / 2**20))
+
+    def percentiles(self, points=(50, 90, 95, 99, 100)):
+        """ Returns a report of the POINTS percentiles of every CPU and
+        GPU sample recorded, for benchmark runs. """
+
+        lines = []
+        for name, samples in (('cpu', self.all_cpu), ('gpu', self.all_gpu)):
+            if len(samples) == 0:
+                lines.append(name + ': no samples')
+                continue
+            values = np.percentile(samples, points)
+            lines.append(name + ' ms: ' + '  '.join(
+                'p%d %.3f' % (p, v) for p, v in zip(points, values)))
+        return '\n'.join(lines)
@@ -0,0 +1,88 @@
+#
+# incremental_subdivision.py
+#
+# Keeps every level of a Loop subdivision around so that moving a few
+# cage vertices only recomputes the vertices they influence.
+#
+# A vertex at level l+1 only depends on the vertices in its stencil at
+# level l (its one-ring, or the four vertices around an edge), so an
+# edit to a cage vertex spreads to a small neighbourhood at each level.
+# editable_subdivision follows the transposed stencils down the levels
+# and recomputes just those vertices.
+
+import numpy as np
+from array_mesh import index_ranges
+from array_subdivision import loop_stencil, stack_channels, \
+     split_channels, edge_midpoints
+
+
+class editable_subdivision:
+    # All levels of a subdivided array_mesh, with the stencils linking
+    # them. verts[0] is the cage, verts[-1] the finest level.
+
+    def __init__(self, cage, levels):
+
+        self.levels = levels
+        self.verts = [np.array(cage.verts)] # a copy, in the cage's precision
+        self.faces = [cage.faces]
+        self.stencils = []
+
+        # Attributes do not move with the cage, so they are subdivided
+        # once here: the 'loop' ones of every level (after the three
+        # position columns of stack_channels), and the colors and
+        # 'linear' ones of the finest level, which start with those of
+        # every coarser level.
+        smooth, linear, self.names = stack_channels(cage)
+        self.smooth = [smooth[:, 3:]]
+
+        for i in range(levels):
+            st, faces, edges = loop_stencil(self.faces[-1],
+                                            len(self.verts[-1]))
+            st.transpose() # needed by every update, build it now
+            self.stencils.append(st)
+            self.faces.append(faces)
+            self.verts.append(st.apply(self.verts[-1]))
+            if self.smooth[-1].shape[1]:
+                self.smooth.append(st.apply(self.smooth[-1]))
+            else:
+                self.smooth.append(np.zeros((len(self.verts[-1]), 0)))
+            linear = edge_midpoints(linear, edges)
+        self.linear = linear
+        self.colors = linear[:, :3]
+
+    def mesh(self, level=None):
+        """ Returns LEVEL (by default the finest level) as an
+        array_mesh. """
+
+        if level is None:
+            level = self.levels
+        nverts = len(self.verts[level])
+        smooth = np.concatenate([self.verts[level], self.smooth[level]],
+                                axis=1)
+        return split_channels(smooth, self.linear[:nverts], self.names,
+                              self.faces[level], self.verts[level].dtype)
+
+    def move_vertices(self, indices, positions):
+        """ Moves cage vertices INDICES to POSITIONS, and updates the
+        subdivided levels. Returns the changed ranges of the finest
+        level, see update(). """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        self.verts[0][indices] = positions
+        return self.update(indices)
+
+    def update(self, moved):
+        """ Recomputes the subdivided levels after the cage vertices in
+        MOVED have been changed in place. Returns a list of half-open
+        (start, stop) ranges of finest level vertex indices that were
+        rewritten, so the caller can upload just those parts of a vertex
+        buffer. Normals of the triangles touching these vertices change
+        too. """
+
+        dirty = np.unique(np.asarray(list(moved), dtype=np.int64))
+        for i in range(self.levels):
+            st = self.stencils[i]
+            dirty = st.dependents(dirty)
+            self.verts[i+1][dirty] = st.apply_rows(dirty, self.verts[i])
+
+        return index_ranges(dirty)
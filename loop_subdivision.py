@@ -12,6 +12,8 @@ from tri_mesh import *
 from mesh_geometry import *
 from geometry import vector, point, ORIGIN
 from math import sin, cos, pi
+from mesh_stats import mesh_stats
+from progress import progress_meter, cancelled
 import sys
 
 
@@ -25,22 +27,80 @@ edges = {} # Dictionary of edges
 vertices = [] # list of vertex objects
 tindex = 0 # Current maximum triangle index
 vindex = 0 # current maximum vertex index
+current_stats = mesh_stats() # stats of the subdivision in progress
+current_meter = progress_meter(0, 0) # progress of the level in progress
     
     
-def subdivide(oldmesh):
+def subdivide(oldmesh, levels=1, stats=None, trace=None, progress=None,
+              cancel=None):
     """ Wrapper function that initiates loop subdivision on triangle
-    mesh MESH. Returns subdivided mesh (or None if subdivision could
-    not be performed). """
+    mesh MESH, LEVELS times. Returns subdivided mesh (or None if
+    subdivision could not be performed). Each intermediate level is
+    released as soon as the next one exists, and OLDMESH's links into
+    the first level are dropped, so at most two levels are alive at
+    once. Timings and counters are recorded in STATS (a new mesh_stats
+    if not given), kept as the new mesh's stats. If TRACE is given, a
+    Chrome trace is written to that file. PROGRESS and CANCEL are a
+    progress callback and a cancel_token (see progress.py); when
+    cancelled, every level made so far is released, OLDMESH is left as
+    it was, and cancelled is raised. """
+
+    if stats is None:
+        stats = mesh_stats()
+
+    newmesh = oldmesh
+    for level in range(levels):
+        previous = newmesh
+        try:
+            newmesh = subdivideLevel(previous, stats, level + 1, progress,
+                                     cancel)
+        except cancelled:
+            if previous is not oldmesh:
+                releaseMesh(previous)
+            raise
+
+        with stats.phase('release', level=level):
+            dropBackLinks(previous)
+            if previous is not oldmesh:
+                releaseMesh(previous)
+        previous = None
+
+    if trace != None:
+        stats.write_trace(trace)
 
-    global tris, edges, vertices, tindex, vindex
+    return newmesh
+
+def subdivideLevel(oldmesh, stats, level=1, progress=None, cancel=None):
+    """ Performs one level of loop subdivision on OLDMESH, recording into
+    STATS, and returns the new mesh. Progress is reported to PROGRESS as
+    LEVEL; if CANCEL is cancelled, the half-built new mesh is released,
+    OLDMESH's links into it are dropped, and cancelled is raised. """
+
+    global tris, edges, vertices, tindex, vindex, current_stats, \
+           current_meter
 
     newmesh = mesh() # This is the subdivided mesh object, will be
     # populated and returned
 
+    current_stats = stats
+    current_meter = progress_meter(level, len(oldmesh.triangles), progress,
+                                   cancel)
+    newmesh.stats = stats
 
     newmesh.radius = oldmesh.radius
     # Start the triangle subdivision on newmesh.
-    subdivideTriangles(newmesh, oldmesh)
+    try:
+        with stats.phase('subdivide', triangles=len(oldmesh.triangles)):
+            subdivideTriangles(newmesh, oldmesh)
+            current_meter.finish()
+    except cancelled:
+        with stats.phase('cancel', level=level):
+            dropBackLinks(oldmesh)
+            releaseMesh(newmesh)
+        stats.count('cancelled')
+        raise
+
+    stats.count('triangles_created', len(newmesh.triangles))
 
     # Fix triangle adjacencies in the mesh. This should be disabled
     # in the future, when I get the mesh to import this information
@@ -53,6 +113,40 @@ def subdivide(oldmesh):
 
     
     return newmesh
+
+def dropBackLinks(oldmesh):
+    """ Clears the edge and vertex subdivision links from OLDMESH into
+    the mesh subdivided from it. They are only needed while the walk runs, and
+    would otherwise keep the finer mesh alive as long as OLDMESH. """
+
+    for tri in oldmesh.triangles:
+        for e in tri.edge:
+            if e != None:
+                e.subdivision = [None, None]
+    for v in oldmesh.verts:
+        v.subdivision = None
+
+def releaseMesh(oldmesh):
+    """ Breaks the reference cycles (edge pairs, next edges, vertex /
+    triangle adjacency) of a mesh level that is no longer needed, so
+    its objects are freed right away instead of waiting for the cycle
+    collector, and empties OLDMESH. """
+
+    for tri in oldmesh.triangles:
+        for e in tri.edge:
+            if e != None:
+                e.pair = None
+                e.nextEdge = None
+                e.triangle = None
+        tri.edge = [None, None, None]
+        tri.verts = []
+    for v in oldmesh.verts:
+        v.adj_tris = []
+
+    oldmesh.triangles = []
+    oldmesh.verts = []
+    oldmesh.edges = {}
+    oldmesh.shadows = []
     
 def subdivideTriangles(newmesh, oldmesh):
     """ Wrapper function, starts triangle subdivision on NEWMESH. and
@@ -60,8 +154,9 @@ def subdivideTriangles(newmesh, oldmesh):
     are linked appropriately and added to NEWMESH. """
     
     # First, reset the visited status of the mesh
-    for tri in oldmesh.triangles:
-        tri.visited = False
+    with current_stats.phase('reset'):
+        for tri in oldmesh.triangles:
+            tri.visited = False
 
 
     # Subidivide the first triangle. This will be a "seed" to start recursive
@@ -69,6 +164,7 @@ def subdivideTriangles(newmesh, oldmesh):
     print("Subdividing " + str(len(oldmesh.triangles)) + " triangles.")
     tri = oldmesh.triangles[0]
     tri.visited = True
+    current_meter.step()
     new_v = list(range(6)) # This will contain the new smoothed vertices,
     # which will be linked into new triangles.
     temp1 = None # temporary vertex
@@ -138,6 +234,8 @@ def subdivideTriangles(newmesh, oldmesh):
             newedge[i].triangle = ntri
             if repr(newedge[i]) not in newmesh.edges:
                 newmesh.edges[repr(newedge[i])] = newedge[i]
+        current_stats.count('edge_lookups', 3)
+    current_stats.count('edges_created', 12)
                             
     # The triangles edges need to be given proper next edge linking and
     # pair linking. Because we know how the triangle was constructed, this
@@ -189,27 +287,31 @@ def subdivideTriangles(newmesh, oldmesh):
 
     # Recursion depth limit? HA
     sys.setrecursionlimit(1000000)
-        
-    recursive_subdivide(newmesh, oldmesh, tri.edge[0].pair, 
-                        new_t[0].edge[0], new_t[1].edge[0], 
-                        new_v[0], new_v[2], new_v[1])
-    
-    recursive_subdivide(newmesh, oldmesh, tri.edge[1].pair,
-                        new_t[1].edge[1], new_t[2].edge[0],
-                        new_v[2], new_v[4], new_v[3])
 
-    recursive_subdivide(newmesh, oldmesh, tri.edge[2].pair,
-                        new_t[2].edge[1], new_t[0].edge[2],
-                        new_v[4], new_v[0], new_v[5])
+    try:
+        with current_stats.phase('walk'):
+            recursive_subdivide(newmesh, oldmesh, tri.edge[0].pair, 
+                                new_t[0].edge[0], new_t[1].edge[0], 
+                                new_v[0], new_v[2], new_v[1])
 
-    sys.setrecursionlimit(10000)
+            recursive_subdivide(newmesh, oldmesh, tri.edge[1].pair,
+                                new_t[1].edge[1], new_t[2].edge[0],
+                                new_v[2], new_v[4], new_v[3])
+
+            recursive_subdivide(newmesh, oldmesh, tri.edge[2].pair,
+                                new_t[2].edge[1], new_t[0].edge[2],
+                                new_v[4], new_v[0], new_v[5])
+    finally:
+        # also when a cancellation unwinds the walk
+        sys.setrecursionlimit(10000)
 
     return
 
  
     
     
-def recursive_subdivide(newmesh, oldmesh, startedge, e0, e1, v0, v1, midpoint):
+def recursive_subdivide(newmesh, oldmesh, startedge, e0, e1, v0, v1, midpoint,
+                        depth=1):
     """ Uses information from the previously subdivided triangle to initiate
     subdivision in the neighboring triangle.
     NEWMESH is the new mesh to add to, OLDMESH is the old mesh to subdivide.
@@ -218,7 +320,8 @@ def recursive_subdivide(newmesh, oldmesh, startedge, e0, e1, v0, v1, midpoint):
     edge that borders TRI. E0 and E1 are edges, V0, V1 and MIDPOINT are vertices.
     E0 and V0 come first in the previous triangles mesh-edge orderint (i.e, v0's
     edge's next edge contains v1 in the previous triangle prior to subdivision).
-    MIDPOINT is the subdivided midpoint vertex. """
+    MIDPOINT is the subdivided midpoint vertex. DEPTH is the depth of
+    the walk, for the max_depth counter. """
 
     if startedge == None:
         return
@@ -285,6 +388,8 @@ def recursive_subdivide(newmesh, oldmesh, startedge, e0, e1, v0, v1, midpoint):
         return
         
     tri.visited = True
+    current_stats.maximum('max_depth', depth)
+    current_meter.step() # may raise cancelled; nothing is linked yet
     new_v = list(range(6)) # This will contain the new smoothed vertices,
     # which will be linked into new triangles.
     temp1 = None # temporary vertex
@@ -379,6 +484,8 @@ def recursive_subdivide(newmesh, oldmesh, startedge, e0, e1, v0, v1, midpoint):
                 # we need to link it to the equivalent edge already in dict
                 newedge[i].pair = newmesh.edges[repr(newedge[i])]
                 newmesh.edges[repr(newedge[i])].pair = newedge[i]
+        current_stats.count('edge_lookups', 3)
+    current_stats.count('edges_created', 12)
                 
     # pair the first two triangles to the edges that were passed in
     
@@ -437,15 +544,15 @@ def recursive_subdivide(newmesh, oldmesh, startedge, e0, e1, v0, v1, midpoint):
 
     recursive_subdivide(newmesh, oldmesh, startedge.pair, 
                         new_t[0].edge[0], new_t[1].edge[0], 
-                        new_v[0], new_v[2], new_v[1])
+                        new_v[0], new_v[2], new_v[1], depth + 1)
     
     recursive_subdivide(newmesh, oldmesh, startedge.nextEdge.pair,
                         new_t[1].edge[1], new_t[2].edge[0],
-                        new_v[2], new_v[4], new_v[3])
+                        new_v[2], new_v[4], new_v[3], depth + 1)
 
     recursive_subdivide(newmesh, oldmesh, startedge.nextEdge.nextEdge.pair,
                         new_t[2].edge[1], new_t[0].edge[2],
-                        new_v[4], new_v[0], new_v[5])
+                        new_v[4], new_v[0], new_v[5], depth + 1)
 
 
     
@@ -457,9 +564,10 @@ def subdivide_vertex(vertex):
     computes and returns the smoothed vertex position. """
 
 
-    # Error check. If the vertex can't be repositioned, leave it alone
-    if len(vertex.adj_tris) == 0 or len(vertex.adj_tris) == 1:
-        return vertex
+    # Error check. If the vertex can't be repositioned, leave it alone.
+    # (A vertex with a single triangle is the corner of a boundary fan.)
+    if len(vertex.adj_tris) == 0:
+        return copyVertex(vertex)
         
      # First, determine if we are on a complete or boundary fan.
     for tri in vertex.adj_tris:
@@ -469,6 +577,7 @@ def subdivide_vertex(vertex):
                 # this could be a boundary fan. Check to see if this edge
                 # contains the vertex.
                 if vertex in e.verts:
+                    current_stats.count('boundary_vertices')
                     return subdivide_boundary_fan_vertex(vertex)
 
     # If you get through this loop, the fan shouldn't be a boundary fan.
@@ -478,22 +587,52 @@ def subdivide_vertex(vertex):
     #return vertex
 
 
-def subdivide_boundary_fan_vertex(vertex):
-    """ Repositions a boundary fan vertex VERTEX. A boundary fan is defined
+def subdivide_boundary_fan_vertex(vert):
+    """ Repositions a boundary fan vertex VERT. A boundary fan is defined
     as a fan containin a triangle that has a boundary edge conatining the
-    center vertex (i.e., it is a fan around VERTEX that is incomplete). """
+    center vertex (i.e., it is a fan around VERT that is incomplete).
+    Like copyVertex, every triangle around VERT gets the same new vertex:
+    boundary edges have no pair to share it through. """
 
     # Boundary fan vertex formula: 1/8v0 + 3/4v + 1/8vn-1
     # v is central vertex, v0 and vn-1 are the edge vertices
 
-    # First, determine v0 and vn-1
-
-    
-    
-    
-    
-    
-    return vertex
+    # First, determine v0 and vn-1, the other ends of the two boundary
+    # edges at VERT
+    ends = []
+    for tri in vert.adj_tris:
+        for e in tri.edge:
+            if e.pair == None and vert in e.verts:
+                if e.verts[0] is vert:
+                    ends.append(e.verts[1])
+                else:
+                    ends.append(e.verts[0])
+    if len(ends) != 2:
+        # several open fans meet here: leave it alone, like the array
+        # engine does for non-manifold vertices
+        return copyVertex(vert)
+
+    if vert.subdivision == None:
+        v0 = ends[0].loc
+        v1 = ends[1].loc
+        p = addPoints(scalePoint(vert.loc, 3/4),
+                      scalePoint(addPoints(v0, v1), 1/8))
+        current_stats.count('vertices_created')
+        vert.subdivision = vertex(p.x, p.y, p.z, vert.index)
+    return vert.subdivision
+
+
+def copyVertex(vert):
+    """ Returns the copy of VERT in the new mesh, making it the first
+    time. Vertices that are not moved are still copied, so the new mesh
+    never shares vertex objects (and their adj_tris) with the old one.
+    Every triangle around VERT gets the same copy. """
+
+    if vert.subdivision == None:
+        current_stats.count('vertices_created')
+        vert.subdivision = vertex(vert.loc.x, vert.loc.y, vert.loc.z,
+                                  vert.index)
+    return vert.subdivision
 
 
 def subdivide_interior_fan_vertex(vert):
@@ -550,6 +689,7 @@ def subdivide_interior_fan_vertex(vert):
     z += (k * vert.loc.z)
     
     vprime = vertex(x, y, z, vert.index)
+    current_stats.count('vertices_created')
     
     return vprime
     
@@ -581,6 +721,8 @@ def subdivide_edge(edge):
         # compute as boundary edge.
         # v' = 1/2 v0 + 1/2 v1
         p = addPoints(scalePoint(v0, 0.5), scalePoint(v1, 0.5))
+        current_stats.count('boundary_edges')
+        current_stats.count('vertices_created')
         return vertex(p.x, p.y, p.z, 0)
     
     else:
@@ -595,6 +737,7 @@ def subdivide_edge(edge):
         f1 = f1[0].loc
         p = addPoints(addPoints(scalePoint(f0, (1/8)), scalePoint(v0, (3/8))), 
                       addPoints(scalePoint(v1, (3/8)), scalePoint(f1, (1/8))))
+        current_stats.count('vertices_created')
                       
         return vertex(p.x, p.y, p.z, 0)
     
@@ -666,7 +809,7 @@ def blendColor(edge):
         c0 = edge.verts[0].color
         c1 = edge.verts[1].color
 
-        return [1/2*(c0[0] + c1[0]), 1/2*(c0[0] + c1[1]), 1/2*(c0[0] + c1[2])]
+        return [1/2*(c0[0] + c1[0]), 1/2*(c0[1] + c1[1]), 1/2*(c0[2] + c1[2])]
 
         
 
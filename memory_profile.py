@@ -0,0 +1,314 @@
+#
+# memory_profile.py
+#
+# Memory report for loading, subdividing and compiling a mesh, to find
+# out which structures dominate on deep subdivisions.
+#
+# For each phase (load, every subdivision level, compile) it records
+#
+#    peak / retained:  Python heap bytes from tracemalloc, the highest
+#                      point during the phase and what is still held
+#                      after it
+#    rss:              resident set size sampled on a background thread
+#                      (peak during the phase, and at its end)
+#    by type:          retained bytes of live objects grouped by type
+#                      (vertex, edge, triangle, point, list, dict, ...)
+#    by type at peak:  the same grouping at the phase's peak, from a
+#                      census taken over and over on a background thread
+#                      during the phase; the largest one is kept (or the
+#                      retained one, if larger). A census of millions of
+#                      objects takes a while, so this is the peak among
+#                      the samples, and phases shorter than one census
+#                      only have their end.
+#    sites:            the source lines holding the most retained bytes
+#
+# plus bytes per output triangle. The type sizes are shallow
+# (sys.getsizeof), so the floats inside a point are not included in
+# "point"; the allocation sites do include them.
+#
+# tracemalloc makes the deeply recursive walk in loop_subdivision about
+# a hundred times slower. --no-tracemalloc skips it: peak heap bytes and
+# allocation sites are then missing and "retained" is the sum of the
+# shallow type sizes.
+#
+#    python3 memory_profile.py objects/bunny.obj 3
+#    python3 memory_profile.py objects/bunny.obj 5 --engine array --json mem.json
+#    python3 memory_profile.py objects/bunny.obj 5 --engine array --precision float32
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+TYPES = ['vertex', 'edge', 'triangle', 'point', 'vector', 'list', 'dict',
+         'ndarray']
+
+
+class rss_sampler:
+    # Samples the resident set size of this process on a thread.
+
+    def __init__(self, interval=0.005):
+
+        self.interval = interval
+        self.page = os.sysconf('SC_PAGE_SIZE')
+        self.peak = 0
+        self.running = False
+
+    def rss(self):
+        """ Returns the current resident set size in bytes. """
+        try:
+            statm = open('/proc/self/statm')
+            pages = int(statm.read().split()[1])
+            statm.close()
+            return pages * self.page
+        except (OSError, IndexError, ValueError):
+            # no /proc: fall back on the peak so far
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def start(self):
+        """ Starts a new sampling interval. """
+        self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Ends the interval, returning (peak, current) RSS bytes. """
+        self.running = False
+        self.thread.join()
+        current = self.rss()
+        return max(self.peak, current), current
+
+
+def census(collect=True):
+    """ Returns {type name: [count, bytes]} for the live objects tracked
+    by the garbage collector, with numpy arrays counted by their data
+    size. Garbage is collected first if COLLECT is set. """
+
+    if collect:
+        gc.collect()
+    totals = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name == 'ndarray':
+            size = obj.nbytes if obj.base is None else 0 # views share data
+        else:
+            size = sys.getsizeof(obj)
+        entry = totals.setdefault(name, [0, 0])
+        entry[0] += 1
+        entry[1] += size
+    return totals
+
+
+def census_bytes(types):
+    """ Returns the total bytes of census TYPES. """
+    return sum(size for count, size in types.values())
+
+
+class census_sampler:
+    # Takes censuses of live objects on a thread while a phase runs,
+    # keeping the largest. After each census it waits as long as the
+    # census took, so it uses at most half the time of the thread.
+
+    def __init__(self):
+
+        self.peak = {}
+        self.running = False
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            types = census(collect=False) # collecting would change the run
+            if census_bytes(types) > census_bytes(self.peak):
+                self.peak = types
+            time.sleep(time.perf_counter() - start)
+
+    def start(self):
+        """ Starts a new sampling interval. """
+        self.peak = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, final):
+        """ Ends the interval and returns the largest census seen, or
+        census FINAL (taken at the end of the phase) if that is
+        larger. """
+        self.running = False
+        self.thread.join()
+        if census_bytes(final) >= census_bytes(self.peak):
+            return final
+        return self.peak
+
+
+def profile_phase(name, func, sampler, results, triangles=None,
+                  counter=None):
+    """ Runs FUNC as phase NAME, appending its memory record to RESULTS.
+    Returns FUNC's result. TRIANGLES(result) gives the phase's output
+    triangle count. COUNTER, a census_sampler, gives the types at the
+    peak if given. """
+
+    gc.collect()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    sampler.start()
+    if counter is not None:
+        counter.start()
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    rss_peak, rss_now = sampler.stop()
+
+    types = census()
+    peak_types = types if counter is None else counter.stop(types)
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        sites = [(str(s.traceback), s.size)
+                 for s in snapshot.statistics('lineno')[:8]]
+    else:
+        current = sum(size for count, size in types.values())
+        peak = None
+        sites = []
+
+    record = {'phase': name, 'seconds': seconds,
+              'peak_bytes': peak, 'retained_bytes': current,
+              'rss_peak_bytes': rss_peak, 'rss_bytes': rss_now,
+              'types': dict((t, types.get(t, [0, 0])) for t in TYPES),
+              'peak_types': dict((t, peak_types.get(t, [0, 0]))
+                                 for t in TYPES),
+              'sites': sites}
+    if triangles is not None:
+        record['triangles'] = triangles(value)
+        record['bytes_per_triangle'] = current / max(1, record['triangles'])
+    results.append(record)
+    return value
+
+
+def profile(filename, levels, engine='object', trace=True,
+            precision='float64', peak_types=True):
+    """ Profiles loading FILENAME, subdividing it LEVELS times with
+    ENGINE ('object' or 'array') and compiling the result, using
+    tracemalloc if TRACE is set. The array engine works in PRECISION
+    ('float64' or 'float32'). PEAK_TYPES samples the types at each
+    phase's peak (see census_sampler). Returns a list of per-phase
+    records. """
+
+    results = []
+    sampler = rss_sampler()
+    counter = census_sampler() if peak_types else None
+    if trace:
+        tracemalloc.start()
+
+    # loop_subdivision prints progress; keep it out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine == 'object':
+            from tri_mesh import mesh
+            from loop_subdivision import subdivide
+
+            def load():
+                m = mesh()
+                m.load(filename)
+                return m
+            count = lambda m: len(m.triangles)
+            step = subdivide
+        else:
+            from array_mesh import load_obj
+            from array_subdivision import loop_subdivide
+
+            load = lambda: load_obj(filename, precision)
+            count = lambda m: len(m.faces)
+            step = loop_subdivide
+
+        m = profile_phase('load', load, sampler, results, count, counter)
+        for level in range(1, levels + 1):
+            m = profile_phase('subdivide L' + str(level),
+                              lambda: step(m), sampler, results, count,
+                              counter)
+        buffers = profile_phase('compile', m.compile, sampler, results,
+                                lambda b: len(b[0]) // 9, counter)
+
+    if trace:
+        tracemalloc.stop()
+    return results
+
+
+def report(results):
+    """ Returns RESULTS as readable text. """
+
+    mb = 1.0 / 2**20
+    lines = ['%-14s %8s %10s %10s %10s %10s %10s' %
+             ('phase', 'seconds', 'peak MB', 'kept MB', 'rss pk MB',
+              'rss MB', 'B/tri')]
+    for r in results:
+        if r['peak_bytes'] is None:
+            peak = '-'
+        else:
+            peak = '%.1f' % (r['peak_bytes'] * mb)
+        lines.append('%-14s %8.3f %10s %10.1f %10.1f %10.1f %10.1f' %
+                     (r['phase'], r['seconds'], peak,
+                      r['retained_bytes'] * mb, r['rss_peak_bytes'] * mb,
+                      r['rss_bytes'] * mb, r.get('bytes_per_triangle', 0)))
+
+    for r in results:
+        lines.append('')
+        lines.append(r['phase'] + ': by type, retained and at the sampled '
+                     'peak (count, MB)')
+        for name in TYPES:
+            count, size = r['types'][name]
+            peak_count, peak_size = r['peak_types'][name]
+            if count or peak_count:
+                lines.append('    %-10s %10d %10.1f %10d %10.1f' %
+                             (name, count, size * mb, peak_count,
+                              peak_size * mb))
+        if r['sites']:
+            lines.append('  top allocation sites (MB)')
+        for site, size in r['sites']:
+            lines.append('    %8.1f  %s' % (size * mb, site))
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Memory report for load, subdivide and compile.')
+    parser.add_argument('filename', help='.obj file to load')
+    parser.add_argument('levels', type=int, nargs='?', default=1,
+                        help='number of subdivisions')
+    parser.add_argument('--engine', default='object',
+                        choices=['object', 'array'])
+    parser.add_argument('--precision', default='float64',
+                        choices=['float64', 'float32'],
+                        help='positions and colors of the array engine')
+    parser.add_argument('--no-tracemalloc', action='store_true',
+                        help='only sample RSS and count live objects')
+    parser.add_argument('--no-peak-types', action='store_true',
+                        help='do not sample the types at each peak')
+    parser.add_argument('--json', help='also write the records here')
+    args = parser.parse_args(argv[1:])
+
+    results = profile(args.filename, args.levels, args.engine,
+                      not args.no_tracemalloc, args.precision,
+                      not args.no_peak_types)
+    print(report(results))
+    if args.json:
+        out = open(args.json, 'w')
+        json.dump(results, out, indent=1)
+        out.close()
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,363 @@
+#
+# mesh_codec.py
+#
+# A compact encoding of array meshes for caching and shipping subdivided
+# levels, which get large from level 4 on (the bunny's is 25 MB as the
+# float32 / uint32 buffers the viewer uploads).
+#
+#    positions:  quantized to BITS (11 to 16) bits per axis within the
+#                mesh's bounding box, bit-packed
+#    normals:    octahedral encoding, two NORMAL_BITS values per normal
+#                (optional; decoders can also recompute them)
+#    colors:     one RGB for the whole mesh if they are all the same,
+#                otherwise 8 bits per channel
+#    faces:      each face's first corner as the difference from the
+#                previous face's, the other two as differences from its
+#                first corner, zigzag and varint (LEB128) coded
+#
+# Differences are small when nearby faces use nearby vertices, so
+# meshes renumbered along a space-filling curve (spatial_order.py) code
+# to fewer bytes. Encoding and decoding work on whole arrays at once.
+#
+#    data = encode(m, bits=14)
+#    m, normals = decode(data)
+#
+# From the command line, reports size and decode speed against the raw
+# buffers:
+#
+#    python3 mesh_codec.py                      levels 0 to 4, all objects
+#    python3 mesh_codec.py 5 objects/bunny.obj --bits 12
+
+import argparse
+import glob
+import struct
+import sys
+import time
+import numpy as np
+from array_mesh import array_mesh
+
+
+MAGIC = b'QMSH'
+VERSION = 1
+HEADER = struct.Struct('<4sBBBBII6f') # magic, version, bits, normal bits,
+                                      # color mode, vertices, faces,
+                                      # bounding box low and extent
+NO_COLORS = 0
+UNIFORM_COLORS = 1
+BYTE_COLORS = 2
+
+
+def pack_bits(values, bits):
+    """ Packs unsigned integer array VALUES, each below 2^BITS (BITS at
+    most 16), into BITS bits apiece. Returns bytes. """
+
+    big = np.ascontiguousarray(values, dtype='>u2')
+    planes = np.unpackbits(big.view(np.uint8)).reshape(-1, 16)
+    return np.packbits(planes[:, 16 - bits:]).tobytes()
+
+
+def unpack_bits(data, bits, count):
+    """ Returns COUNT BITS-bit values packed into DATA by pack_bits, as
+    a uint32 array. """
+
+    planes = np.unpackbits(np.frombuffer(data, dtype=np.uint8),
+                           count=count * bits).reshape(count, bits)
+    padded = np.zeros((count, 16), dtype=np.uint8)
+    padded[:, 16 - bits:] = planes
+    return np.packbits(padded).view('>u2').astype(np.uint32)
+
+
+def zigzag(values):
+    """ Maps signed int64 VALUES to unsigned ones, small magnitudes to
+    small numbers: 0, -1, 1, -2 ... become 0, 1, 2, 3 ... """
+
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values):
+    """ Inverse of zigzag. """
+
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).view(np.int64) ^ \
+           -(values & np.uint64(1)).view(np.int64)
+
+
+def varint_encode(values):
+    """ Encodes uint64 VALUES as LEB128 varints: seven bits per byte,
+    low bits first, the top bit set on every byte but a value's last.
+    Returns bytes. """
+
+    values = np.asarray(values, dtype=np.uint64)
+    length = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        length += values >= np.uint64(1) << np.uint64(7 * k)
+    starts = np.cumsum(length) - length
+
+    out = np.empty(int(length.sum()), dtype=np.uint8)
+    for k in range(int(length.max()) if len(values) else 0):
+        part = np.nonzero(length > k)[0]
+        byte = (values[part] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (length[part] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[part] + k] = byte | more
+    return out.tobytes()
+
+
+def varint_decode(data):
+    """ Decodes bytes DATA made by varint_encode. Returns a uint64
+    array. """
+
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    length = ends - starts + 1
+
+    # byte k of every value at least k+1 bytes long, one k at a time
+    values = (data[starts] & 0x7f).astype(np.uint64)
+    for k in range(1, int(length.max())):
+        part = np.flatnonzero(length > k)
+        byte = (data[starts[part] + k] & 0x7f).astype(np.uint64)
+        values[part] |= byte << np.uint64(7 * k)
+    return values
+
+
+def octahedral_encode(normals, bits):
+    """ Maps unit NORMALS onto the octahedron |x|+|y|+|z| = 1, unfolds
+    its lower half over the upper one, and quantizes the resulting
+    square to BITS bits per axis. Returns an (N,2) uint32 array. """
+
+    n = np.asarray(normals, dtype=np.float64)
+    n = n / np.maximum(np.abs(n).sum(axis=1), 1e-30)[:, None]
+    x, y, z = n[:, 0], n[:, 1], n[:, 2]
+    sx = np.where(x >= 0.0, 1.0, -1.0)
+    sy = np.where(y >= 0.0, 1.0, -1.0)
+    lower = z < 0.0
+    u = np.where(lower, (1.0 - np.abs(y)) * sx, x)
+    v = np.where(lower, (1.0 - np.abs(x)) * sy, y)
+    top = (1 << bits) - 1
+    uv = np.stack([u, v], axis=1)
+    return np.rint((uv * 0.5 + 0.5) * top).astype(np.uint32)
+
+
+def octahedral_decode(uv, bits):
+    """ Inverse of octahedral_encode: returns (N,3) float32 unit
+    normals. """
+
+    uv = np.asarray(uv, dtype=np.float32) * (2.0 / ((1 << bits) - 1)) - 1.0
+    x, y = uv[:, 0], uv[:, 1]
+    z = 1.0 - np.abs(x) - np.abs(y)
+    fold = np.maximum(-z, 0.0)
+    x = x - np.where(x >= 0.0, fold, -fold)
+    y = y - np.where(y >= 0.0, fold, -fold)
+    n = np.stack([x, y, z], axis=1)
+    return n / np.sqrt((n * n).sum(axis=1))[:, None]
+
+
+def encode_faces(faces):
+    """ Returns triangles FACES delta, zigzag and varint coded. """
+
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    deltas = np.empty_like(faces)
+    deltas[:, 0] = np.diff(faces[:, 0], prepend=0)
+    deltas[:, 1:] = faces[:, 1:] - faces[:, :1]
+    return varint_encode(zigzag(deltas.reshape(-1)))
+
+
+def decode_faces(data):
+    """ Inverse of encode_faces: returns an (F,3) int64 array. """
+
+    deltas = unzigzag(varint_decode(data)).reshape(-1, 3)
+    first = np.cumsum(deltas[:, 0])
+    return np.concatenate([first[:, None], deltas[:, 1:] + first[:, None]],
+                          axis=1)
+
+
+def encode(m, bits=14, normal_bits=10, normals=True, colors=True):
+    """ Returns array_mesh M encoded as bytes, with positions quantized
+    to BITS bits per axis and, if NORMALS is set, its vertex normals in
+    NORMAL_BITS bits per octahedral coordinate. COLORS=False leaves the
+    colors out. """
+
+    if not 11 <= bits <= 16:
+        raise ValueError('position bits must be between 11 and 16')
+    if normals and not 4 <= normal_bits <= 16:
+        raise ValueError('normal bits must be between 4 and 16')
+
+    verts = np.asarray(m.verts, dtype=np.float64)
+    nverts = len(verts)
+    # the box is stored as float32, so quantize against the stored one
+    low = verts.min(axis=0) if nverts else np.zeros(3)
+    extent = verts.max(axis=0) - low if nverts else np.zeros(3)
+    low = low.astype(np.float32).astype(np.float64)
+    extent = extent.astype(np.float32).astype(np.float64)
+    top = (1 << bits) - 1
+    scale = np.where(extent > 0.0, top / np.where(extent > 0.0, extent, 1.0),
+                     0.0)
+    q = np.clip(np.rint((verts - low) * scale), 0, top).astype(np.uint32)
+    sections = [pack_bits(q.reshape(-1), bits)]
+
+    if normals:
+        uv = octahedral_encode(m.normals(), normal_bits)
+        sections.append(pack_bits(uv.reshape(-1), normal_bits))
+    else:
+        normal_bits = 0
+
+    if not colors or nverts == 0:
+        color_mode = NO_COLORS
+    elif np.all(m.colors == m.colors[0]):
+        color_mode = UNIFORM_COLORS
+        sections.append(np.asarray(m.colors[0], dtype='<f4').tobytes())
+    else:
+        color_mode = BYTE_COLORS
+        rgb = np.rint(np.clip(m.colors, 0.0, 1.0) * 255.0)
+        sections.append(rgb.astype(np.uint8).tobytes())
+
+    sections.append(encode_faces(m.faces))
+    header = HEADER.pack(MAGIC, VERSION, bits, normal_bits, color_mode,
+                         nverts, len(m.faces), *(list(low) + list(extent)))
+    return header + b''.join(sections)
+
+
+def decode(data, dtype=np.float32):
+    """ Decodes bytes DATA made by encode. Returns (M, NORMALS): an
+    array_mesh with positions and colors of type DTYPE, and its stored
+    (N,3) float32 unit normals, or None if none were stored. """
+
+    (magic, version, bits, normal_bits, color_mode, nverts, nfaces,
+     lx, ly, lz, ex, ey, ez) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a version %d mesh_codec stream' % VERSION)
+    data = memoryview(data)
+    at = HEADER.size
+
+    size = (nverts * 3 * bits + 7) // 8
+    q = unpack_bits(data[at:at + size], bits, nverts * 3).reshape(-1, 3)
+    at += size
+    step = np.array([ex, ey, ez]) / ((1 << bits) - 1)
+    verts = q.astype(dtype) * step.astype(dtype) + \
+            np.array([lx, ly, lz], dtype=dtype)
+
+    normals = None
+    if normal_bits:
+        size = (nverts * 2 * normal_bits + 7) // 8
+        uv = unpack_bits(data[at:at + size], normal_bits, nverts * 2)
+        normals = octahedral_decode(uv.reshape(-1, 2), normal_bits)
+        at += size
+
+    colors = None
+    if color_mode == UNIFORM_COLORS:
+        rgb = np.frombuffer(data[at:at + 12], dtype='<f4')
+        colors = np.broadcast_to(rgb, (nverts, 3))
+        at += 12
+    elif color_mode == BYTE_COLORS:
+        rgb = np.frombuffer(data[at:at + 3 * nverts], dtype=np.uint8)
+        colors = rgb.reshape(-1, 3) * (1.0 / 255.0)
+        at += 3 * nverts
+
+    faces = decode_faces(data[at:])
+    if len(faces) != nfaces:
+        raise ValueError('truncated mesh_codec stream')
+    return array_mesh(verts, faces, colors, dtype), normals
+
+
+def save(filename, m, **options):
+    """ Writes array_mesh M to FILENAME with encode(M, **OPTIONS). """
+
+    with open(filename, 'wb') as out:
+        out.write(encode(m, **options))
+
+
+def load(filename, dtype=np.float32):
+    """ Reads a file written by save. Returns (M, NORMALS) as decode
+    does. """
+
+    with open(filename, 'rb') as src:
+        return decode(src.read(), dtype)
+
+
+def raw_bytes(m):
+    """ Returns the float32 positions, normals and colors and uint32
+    indices of array_mesh M concatenated, as uploaded for an indexed
+    draw: what the encoding is compared with. """
+
+    return b''.join(buf.tobytes() for buf in m.compileIndexed())
+
+
+def report(filenames, levels, bits=14, normal_bits=10, repeat=3):
+    """ Returns one record per .obj file in FILENAMES and level in
+    LEVELS with the raw and encoded sizes (also after Hilbert curve
+    reordering), the largest position and normal errors, and the best
+    of REPEAT decode times, against copying the raw buffers. """
+
+    from array_mesh import load_obj
+    from array_subdivision import loop_subdivide
+    from spatial_order import reorder
+
+    records = []
+    for filename in filenames:
+        coarse = load_obj(filename)
+        for level in levels:
+            m = loop_subdivide(coarse, level)
+            raw = raw_bytes(m)
+            data = encode(m, bits, normal_bits)
+            ordered = encode(reorder(m), bits, normal_bits)
+
+            decode_s = copy_s = float('inf')
+            for i in range(repeat):
+                start = time.perf_counter()
+                out, normals = decode(data)
+                decode_s = min(decode_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                np.frombuffer(raw, dtype=np.uint8).copy()
+                copy_s = min(copy_s, time.perf_counter() - start)
+
+            extent = float((m.verts.max(axis=0) - m.verts.min(axis=0)).max())
+            error = np.abs(out.verts - m.verts).max() / (extent or 1.0)
+            cosine = (normals * m.normals()).sum(axis=1)
+            angle = np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0))).max()
+            records.append({
+                'object': filename, 'level': level,
+                'triangles': len(m.faces), 'raw_bytes': len(raw),
+                'bytes': len(data), 'ordered_bytes': len(ordered),
+                'position_error': float(error),
+                'normal_error_degrees': float(angle),
+                'decode_s': decode_s, 'copy_s': copy_s})
+    return records
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Size and decode speed of the compact mesh encoding.')
+    parser.add_argument('levels', type=int, nargs='?', default=4,
+                        help='report levels 0 to LEVELS')
+    parser.add_argument('filenames', nargs='*',
+                        help='.obj files (default: objects/*.obj)')
+    parser.add_argument('--bits', type=int, default=14,
+                        help='bits per position axis, 11 to 16')
+    parser.add_argument('--normal-bits', type=int, default=10)
+    args = parser.parse_args(argv[1:])
+
+    filenames = args.filenames or sorted(glob.glob('objects/*.obj'))
+    print('%d bit positions, %d bit normals; raw is float32 vertices, '
+          'normals, colors and uint32 indices' %
+          (args.bits, args.normal_bits))
+    print('%-24s %3s %8s %8s %7s %6s %6s %8s %6s %8s %8s %7s' %
+          ('object', 'lvl', 'tris', 'raw MB', 'MB', 'ratio', 'curve',
+           'pos err', 'nrm', 'dec ms', 'Mtri/s', 'copy ms'))
+    for r in report(filenames, range(args.levels + 1), args.bits,
+                    args.normal_bits):
+        print('%-24s %3d %8d %8.2f %7.2f %6.1f %6.1f %8.1e %6.2f %8.1f '
+              '%8.1f %7.2f' %
+              (r['object'], r['level'], r['triangles'],
+               r['raw_bytes'] / 2.0**20, r['bytes'] / 2.0**20,
+               r['raw_bytes'] / float(r['bytes']),
+               r['raw_bytes'] / float(r['ordered_bytes']),
+               r['position_error'], r['normal_error_degrees'],
+               1000 * r['decode_s'],
+               r['triangles'] / r['decode_s'] / 1e6, 1000 * r['copy_s']))
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,178 @@
+#
+# mesh_generators.py
+#
+# Synthetic meshes of any size, for benchmarks and stress tests. The
+# bundled objects top out at about 5K faces (bunny.obj); these go from
+# a few hundred faces to tens of millions.
+#
+#    icosphere:    closed, almost all valence 6 (subdivided icosahedron)
+#    torus:        closed, genus one, regular valence 6 grid
+#    grid_patch:   open square patch, so it has boundary edges/corners
+#    noisy_sphere: closed, jittered, with two very high valence poles
+#                  and randomly flipped diagonals (valence 4 to 8)
+#
+# Each generator takes a target number of FACES and returns an
+# array_mesh with roughly that many (icospheres come in steps of 4x).
+# to_tri_mesh in array_mesh.py turns them into winged half-edge meshes.
+#
+# From the command line, writes a generated mesh to an .obj file:
+#
+#    python3 mesh_generators.py torus 1000000 torus-1M.obj
+
+import numpy as np
+from math import log, sqrt
+import sys
+from array_mesh import array_mesh, unique_edges, write_obj
+
+
+def icosahedron():
+    """ Returns the unit icosahedron as an array_mesh. """
+
+    t = (1.0 + sqrt(5.0)) / 2.0
+    verts = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                      [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                      [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]],
+                     dtype=np.float64)
+    verts /= sqrt(1.0 + t*t)
+    faces = [[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+             [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+             [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+             [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]]
+    return array_mesh(verts, faces)
+
+
+def icosphere(faces=None, level=None):
+    """ Returns a unit sphere made by splitting each face of an
+    icosahedron into four LEVEL times and pushing the new vertices out
+    to the sphere. If LEVEL is not given it is chosen so the sphere has
+    about FACES faces (20 * 4^level). """
+
+    if level is None:
+        level = max(0, int(round(log(max(faces, 20) / 20.0, 4))))
+
+    m = icosahedron()
+    verts, tris = m.verts, m.faces
+    for i in range(level):
+        nverts = len(verts)
+        edges, face_edges, counts = unique_edges(tris, nverts)
+        mid = verts[edges[:, 0]] + verts[edges[:, 1]]
+        mid /= np.sqrt((mid * mid).sum(axis=1))[:, None]
+        verts = np.concatenate([verts, mid])
+
+        a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+        ab, bc, ca = (face_edges + nverts).T
+        tris = np.stack([np.stack([a, ab, ca], axis=1),
+                         np.stack([ab, b, bc], axis=1),
+                         np.stack([ca, bc, c], axis=1),
+                         np.stack([ab, bc, ca], axis=1)],
+                        axis=1).reshape(-1, 3)
+
+    return array_mesh(verts, tris)
+
+
+def grid_faces(nu, nv, wrap_u, wrap_v, flip=None):
+    """ Returns the triangles of a grid of NU by NV quads whose vertex
+    (i, j) has index i*columns + j. WRAP_U / WRAP_V join the last row /
+    column of quads back to the first. Each quad is split along one
+    diagonal, or the other where the (NU, NV) bool array FLIP is set. """
+
+    rows = nu if wrap_u else nu + 1
+    cols = nv if wrap_v else nv + 1
+    i, j = np.meshgrid(np.arange(nu), np.arange(nv), indexing='ij')
+    i1 = (i + 1) % rows
+    j1 = (j + 1) % cols
+    v00 = (i * cols + j).reshape(-1)
+    v10 = (i1 * cols + j).reshape(-1)
+    v01 = (i * cols + j1).reshape(-1)
+    v11 = (i1 * cols + j1).reshape(-1)
+
+    first = np.stack([np.stack([v00, v10, v11], axis=1),
+                      np.stack([v00, v11, v01], axis=1)], axis=1)
+    if flip is not None:
+        other = np.stack([np.stack([v00, v10, v01], axis=1),
+                          np.stack([v10, v11, v01], axis=1)], axis=1)
+        first = np.where(flip.reshape(-1, 1, 1), other, first)
+    return first.reshape(-1, 3)
+
+
+def torus(faces, major=1.0, minor=0.35):
+    """ Returns a torus with about FACES faces, tube radius MINOR around
+    a circle of radius MAJOR. The quads are kept roughly square. """
+
+    nv = max(3, int(round(sqrt(faces / 2.0 * minor / major))))
+    nu = max(3, int(round(faces / (2.0 * nv))))
+    u = np.arange(nu) * (2 * np.pi / nu)
+    v = np.arange(nv) * (2 * np.pi / nv)
+    u, v = np.meshgrid(u, v, indexing='ij')
+
+    r = major + minor * np.cos(v)
+    verts = np.stack([r * np.cos(u), minor * np.sin(v), r * np.sin(u)],
+                     axis=-1).reshape(-1, 3)
+    return array_mesh(verts, grid_faces(nu, nv, True, True)[:, ::-1])
+
+
+def grid_patch(faces, size=2.0, height=0.2):
+    """ Returns an open, gently curved SIZE by SIZE square patch with
+    about FACES faces. Its border gives boundary edges and four corner
+    vertices. """
+
+    n = max(1, int(round(sqrt(faces / 2.0))))
+    x = np.linspace(-size / 2, size / 2, n + 1)
+    x, z = np.meshgrid(x, x, indexing='ij')
+    y = height * np.cos(np.pi * x / size) * np.cos(np.pi * z / size)
+    verts = np.stack([x, y, z], axis=-1).reshape(-1, 3)
+    return array_mesh(verts, grid_faces(n, n, False, False)[:, ::-1])
+
+
+def noisy_sphere(faces, valence=64, noise=0.05, seed=0):
+    """ Returns a jittered latitude / longitude sphere with about FACES
+    faces. The two poles have VALENCE neighbours, every quad is split
+    along a random diagonal, and each vertex is moved by up to NOISE
+    times the local edge length. SEED makes it reproducible. """
+
+    rng = np.random.default_rng(seed)
+    valence = max(3, int(valence))
+    rings = max(2, int(round(faces / (2.0 * valence))) + 1) # rings of faces
+
+    # rings-1 circles of vertices between the poles
+    theta = np.arange(1, rings) * (np.pi / rings)
+    phi = np.arange(valence) * (2 * np.pi / valence)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    body = np.stack([np.sin(theta) * np.cos(phi), np.cos(theta),
+                     np.sin(theta) * np.sin(phi)], axis=-1).reshape(-1, 3)
+    top = len(body)
+    bottom = top + 1
+    verts = np.concatenate([body, [[0.0, 1.0, 0.0], [0.0, -1.0, 0.0]]])
+
+    flip = rng.random((rings - 2, valence)) < 0.5
+    middle = grid_faces(rings - 2, valence, False, True, flip)[:, ::-1]
+    j = np.arange(valence)
+    j1 = (j + 1) % valence
+    last = (rings - 2) * valence
+    caps = np.concatenate([
+        np.stack([np.full(valence, top), j1, j], axis=1),
+        np.stack([np.full(valence, bottom), last + j, last + j1], axis=1)])
+    tris = np.concatenate([middle, caps])
+
+    step = np.pi / max(rings, valence / 2.0)
+    verts += rng.uniform(-noise * step, noise * step, verts.shape)
+    return array_mesh(verts, tris)
+
+
+GENERATORS = {'icosphere': icosphere, 'torus': torus,
+              'grid': grid_patch, 'noisy': noisy_sphere}
+
+
+def main(argc, argv):
+    if argc < 4 or argv[1] not in GENERATORS:
+        print("Use: python3 mesh_generators.py <" + '|'.join(GENERATORS) +
+              "> <FACES> <OUTPUT .obj>")
+        return 1
+
+    m = GENERATORS[argv[1]](int(float(argv[2])))
+    print(repr(m))
+    write_obj(argv[3], m)
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(len(sys.argv), sys.argv))
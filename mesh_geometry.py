@@ -237,6 +237,8 @@ class vertex:
         self.color = [1.0, 0.0, 1.0] # bright purple!!!!
         self.normal = None
         self.subdivided = False # flag whether this edge has been subdivided yet
+        self.subdivision = None # copy of this vertex in the subdivided
+        # mesh, if subdivision leaves it in place
 
     def __repr__(self):
         return(repr(self.loc) + " index: " + str(self.index) + "\n Adjacent tris: " + ' '.join(str(self.adj_tris[e].index) for e in range(0, len(self.adj_tris))))
@@ -0,0 +1,109 @@
+#
+# mesh_stats.py
+#
+# Counters and phase timings for mesh loading and subdivision.
+#
+# mesh.load and loop_subdivision.subdivide fill in a mesh_stats object
+# and leave it on the mesh they produce (mesh.stats). Phases are timed
+# intervals ("parse", "spins", "walk", ...), counters are plain totals
+# ("edge_lookups", "boundary_vertices", ...) or maxima ("max_depth").
+# The whole record can be written as Chrome trace-event JSON, which
+# chrome://tracing and Perfetto can open.
+
+import json
+import os
+import threading
+import time
+
+
+class mesh_stats:
+    # Phase timings and counters collected during load / subdivide.
+
+    def __init__(self):
+
+        self.phases = [] # (name, start, end, args), times in seconds
+        self.counters = {}
+        self.origin = time.perf_counter() # trace time zero
+
+    def __repr__(self):
+        return self.report()
+
+    def phase(self, name, **args):
+        """ Returns a context manager timing the phase NAME. Keyword
+        ARGS are stored with the phase (e.g. the subdivision level). """
+        return _phase(self, name, args)
+
+    def count(self, name, n=1):
+        """ Adds N to counter NAME. """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def maximum(self, name, value):
+        """ Raises counter NAME to VALUE if it is smaller. """
+        if value > self.counters.get(name, 0):
+            self.counters[name] = value
+
+    def timings(self):
+        """ Returns a dictionary of the total seconds spent in each
+        phase name. """
+
+        totals = {}
+        for name, start, end, args in self.phases:
+            totals[name] = totals.get(name, 0.0) + (end - start)
+        return totals
+
+    def report(self):
+        """ Returns the timings and counters as readable text. """
+
+        lines = []
+        for name, seconds in self.timings().items():
+            lines.append('%-24s %10.4f s' % (name, seconds))
+        for name in sorted(self.counters):
+            lines.append('%-24s %10d' % (name, self.counters[name]))
+        return '\n'.join(lines)
+
+    def trace_events(self):
+        """ Returns the phases as Chrome trace "complete" events, followed
+        by one counter event per counter. """
+
+        pid = os.getpid()
+        tid = threading.get_ident()
+        events = []
+        end_us = 0.0
+        for name, start, end, args in self.phases:
+            ts = 1.0e6 * (start - self.origin)
+            dur = 1.0e6 * (end - start)
+            events.append({'name': name, 'cat': 'mesh', 'ph': 'X',
+                           'ts': ts, 'dur': dur, 'pid': pid, 'tid': tid,
+                           'args': args})
+            end_us = max(end_us, ts + dur)
+        for name in sorted(self.counters):
+            events.append({'name': name, 'cat': 'mesh', 'ph': 'C',
+                           'ts': end_us, 'pid': pid, 'tid': tid,
+                           'args': {name: self.counters[name]}})
+        return events
+
+    def write_trace(self, filename):
+        """ Writes the trace events to FILENAME as Chrome trace JSON. """
+
+        trace_file = open(filename, 'w')
+        json.dump({'traceEvents': self.trace_events(),
+                   'displayTimeUnit': 'ms'}, trace_file)
+        trace_file.close()
+
+
+class _phase:
+    # Context manager recording one phase of a mesh_stats object.
+
+    def __init__(self, stats, name, args):
+        self.stats = stats
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.phases.append((self.name, self.start,
+                                  time.perf_counter(), self.args))
+        return False
@@ -20,6 +20,14 @@ from random import random
 from math import sin, cos, acos, asin, pi, sqrt
 from ctypes import *
 from loop_subdivision import *
+from array_mesh import from_tri_mesh
+from array_subdivision import loop_stencil, edge_midpoints
+from threading import Thread
+from queue import Queue, Empty
+from frame_stats import frame_stats
+import profiling
+import numpy as np
+import time
 
 from OpenGL.GL import *
 from OpenGL.GLUT import *
@@ -47,9 +55,47 @@ width = 512
 height = 512
 scale = 1.0/min(width,height)
 surf = mesh()
+triangle_count = 0 # number of triangles in the buffers being drawn
 
 wireframe = False
 
+# Progressive subdivision: finer levels are computed on a worker thread
+# and handed to the GLUT idle callback through this queue.
+level_queue = Queue()
+shown_level = 0
+target_level = 0
+
+# Level of detail: every finished level keeps its own buffers, stored as
+# level -> dictionary of buffers, vertex arrays, triangle count and
+# colors, and draw() picks one from the projected size of the object.
+level_buffers = {}
+forced_level = None # set from the keyboard, None means automatic
+MIN_TRIANGLE_PIXELS = 8.0
+
+# Render loop state. Shader locations are looked up once in init(), and
+# mouse motion is collected until the next frame is drawn.
+phong_locs = {}
+shadow_locs = {}
+pending_motion = None
+redisplay_posted = False
+
+# Frame timing. The overlay is toggled with 't', --frame-log prints the
+# same numbers once a second, and --bench-frames N renders N frames
+# along a fixed trackball path and prints percentile frame times.
+stats = frame_stats()
+show_overlay = False
+frame_log = False
+last_log = 0.0
+timer_queries = None # two [surface, shadow] query pairs, used in turn
+query_frame = 0
+bench_frames = 0
+bench_done = 0
+BENCH_AXIS = vector(0.3, 1.0, 0.0)
+BENCH_STEP = pi/90.0 # radians per benchmark frame
+profile_prefix = None # set by --profile
+precision = 'float64' # of the subdivided levels, set by --precision
+weld = None # vertex welding tolerance for loading, set by --weld
+
 def init_shaders(v_name, f_name):
     """Compile the vertex and fragment shaders from source.
     v_name is the name of the vertex shader, f_name is the name
@@ -91,7 +137,10 @@ def draw():
     global trackball, flashlight, \
            vertex_buffer, normal_buffer, \
            colors, color_buffer, selected_face, add_face, \
-           phong_shader, shadow_shader, wireframe
+           phong_shader, shadow_shader, wireframe, redisplay_posted
+
+    redisplay_posted = False
+    frame_start = time.perf_counter()
 
     ## TEST SECTION ##
 
@@ -105,6 +154,8 @@ def draw():
 
     glPushMatrix()
 
+    apply_motion()
+    use_level(choose_level())
     
     # Transform the objects drawn below by a rotation.
     trackball.glRotate()
@@ -114,83 +165,61 @@ def draw():
     # * * * * * * * * * * * * * * * *
         # Draw all the triangular facets.
     glUseProgram(phong_shader)
-        
-    h_vertex = glGetAttribLocation(phong_shader, 'vertex')
-    h_normal = glGetAttribLocation(phong_shader,'normal')
-    h_color = glGetAttribLocation(phong_shader,'color')
-    h_eye =    glGetUniformLocation(phong_shader,'eye')
-    h_light =  glGetUniformLocation(phong_shader,'light')
-
-    if True:
-        # all the vertex positions
-        glEnableVertexAttribArray(h_vertex)
-        glBindBuffer (GL_ARRAY_BUFFER, vertex_buffer)
-        glVertexAttribPointer(h_vertex, 3, GL_FLOAT, GL_FALSE, 0, None)
-        
-        # all the vertex normals
-        glEnableVertexAttribArray(h_normal)
-        glBindBuffer (GL_ARRAY_BUFFER, normal_buffer)
-        glVertexAttribPointer(h_normal, 3, GL_FLOAT, GL_FALSE, 0, None)
+    glBindVertexArray(level_buffers[shown_level]['phong_vao'])
 
-        # all the face vertex colors
-        glEnableVertexAttribArray(h_color)
-        glBindBuffer (GL_ARRAY_BUFFER, color_buffer)
-
-        if selected_face and add_face:
-            # paint that face's vertices ORANGE
-            rgb_selected = [0.95,0.2,0.2] # ORANGE
+    if selected_face and add_face:
+        # paint that face's vertices ORANGE
+        rgb_selected = [0.95,0.2,0.2] # ORANGE
         #rgb_selected = [1.0, 1.0, 0.0] # BRIGHT YELLOW!!
-            
-            for change in range(9):
-                colors[selected_face.index * 9 + change] = rgb_selected[change % 3]
-                # update the color buffer
-                glBufferData (GL_ARRAY_BUFFER, len(colors)*4, 
-                              (c_float*len(colors))(*colors), GL_STATIC_DRAW)
-                add_face = False
-
-    glVertexAttribPointer(h_color, 3, GL_FLOAT, GL_FALSE, 0, None)
+
+        for change in range(9):
+            colors[selected_face.index * 9 + change] = rgb_selected[change % 3]
+        # update the color buffer
+        glBindBuffer (GL_ARRAY_BUFFER, color_buffer)
+        glBufferData (GL_ARRAY_BUFFER, len(colors)*4,
+                      (c_float*len(colors))(*colors), GL_STATIC_DRAW)
+        add_face = False
         
     # position of the flashlight
     light = flashlight.rotate(vector(0.0,0.0,1.0));
-    glUniform3fv(h_light, 1, (2.0*radius*light).components())
+    glUniform3fv(phong_locs['light'], 1, (2.0*radius*light).components())
 
     # position of the viewer's eye
     eye = trackball.recip().rotate(vector(0.0,0.0,1.0))
-    glUniform3fv(h_eye, 1, eye.components())
+    glUniform3fv(phong_locs['eye'], 1, eye.components())
 
     # WIREFRAME MODE
     if wireframe == True:
         glPolygonMode( GL_FRONT_AND_BACK, GL_LINE )
-            
-    glDrawArrays (GL_TRIANGLES, 0, len(surf.triangles) * 3 + 18)
 
-            
-    glDisableVertexAttribArray(h_vertex)
-    glDisableVertexAttribArray(h_normal)
-    glDisableVertexAttribArray(h_color)
+    queries = begin_timing(0)
+    glDrawArrays (GL_TRIANGLES, 0, triangle_count * 3)
+    end_timing(queries)
 
     # ---- Draw the shadow ---- 
+    begin_timing(1)
     glUseProgram(shadow_shader)
-    h_vertex = glGetAttribLocation(shadow_shader, 'vertex')
-    h_normal = glGetUniformLocation(shadow_shader, 'normal')
-    h_plane = glGetUniformLocation(shadow_shader, 'plane')
-    h_light = glGetUniformLocation(shadow_shader, 'light')
-
-    glEnableVertexAttribArray(h_vertex)
-    glBindBuffer(GL_ARRAY_BUFFER, vertex_buffer)
-    glVertexAttribPointer(h_vertex, 3, GL_FLOAT, GL_FALSE, 0, None)
+    glBindVertexArray(level_buffers[shown_level]['shadow_vao'])
 
     # Uniform variables - light, plane, and plane's normal
     light = flashlight.rotate(vector(0.0,0.0,1.0));
-    glUniform3fv(h_light, 1, (4.0*light).components())
-    glUniform3fv(h_plane, 1, [0.0, 0.0, 0.0]) # point on the plane
-    glUniform3fv(h_normal, 1, [0.0, +1.0, 0.0]) # plane's normal vec
+    glUniform3fv(shadow_locs['light'], 1, (4.0*light).components())
+    glUniform3fv(shadow_locs['plane'], 1, [0.0, 0.0, 0.0]) # point on the plane
+    glUniform3fv(shadow_locs['normal'], 1, [0.0, +1.0, 0.0]) # plane's normal vec
 
-    glDrawArrays(GL_TRIANGLES, 0, len(surf.triangles)*3)
+    glDrawArrays(GL_TRIANGLES, 0, triangle_count * 3)
+    end_timing(queries)
 
-    glDisableVertexAttribArray(h_vertex)
+    glBindVertexArray(0)
 
     glPopMatrix()
+
+    read_timing()
+    stats.triangles = triangle_count
+    if show_overlay:
+        draw_overlay()
+    stats.addCpu(1000.0 * (time.perf_counter() - frame_start))
+    log_timing()
     
 
     
@@ -208,6 +237,128 @@ def draw():
 
     glutSwapBuffers()
 
+def begin_timing(i):
+    """ Starts the GPU timer query for pass I (0 = surface, 1 = shadow)
+    of this frame, returning the query list. """
+
+    if timer_queries is None:
+        return None
+    queries = timer_queries[query_frame % 2]
+    glBeginQuery(GL_TIME_ELAPSED, queries[i])
+    return queries
+
+def end_timing(queries):
+    """ Ends the running GPU timer query, if timing is available. """
+    if queries is not None:
+        glEndQuery(GL_TIME_ELAPSED)
+
+def read_timing():
+    """ Collects the GPU times of the previous frame. Queries alternate
+    between two sets so the results are read a frame late, without
+    waiting for the GPU. """
+    global query_frame
+
+    if timer_queries is None:
+        return
+    query_frame += 1
+    if query_frame < 2:
+        return
+    queries = timer_queries[query_frame % 2]
+    if not glGetQueryObjectiv(queries[1], GL_QUERY_RESULT_AVAILABLE):
+        return
+    surface = glGetQueryObjectui64v(queries[0], GL_QUERY_RESULT)
+    shadow = glGetQueryObjectui64v(queries[1], GL_QUERY_RESULT)
+    stats.addGpu(surface / 1.0e6, shadow / 1.0e6)
+
+def draw_overlay():
+    """ Prints the recent frame statistics in the window corner. """
+
+    glUseProgram(0)
+    glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+    glDisable(GL_DEPTH_TEST)
+    glColor3f(1.0, 1.0, 1.0)
+    glWindowPos2i(8, height - 16)
+    glutBitmapString(GLUT_BITMAP_8_BY_13, stats.summary().encode())
+    glEnable(GL_DEPTH_TEST)
+
+def log_timing():
+    """ With --frame-log, prints the frame statistics once a second. """
+    global last_log
+
+    now = time.perf_counter()
+    if frame_log and now - last_log >= 1.0:
+        print("level " + str(shown_level) + ": " + stats.summary())
+        last_log = now
+
+def init_timing():
+    """ Creates the GPU timer queries. Leaves timer_queries as None if
+    the GL implementation has no timer queries. """
+    global timer_queries
+
+    try:
+        ids = glGenQueries(4)
+    except Exception:
+        print("GPU timer queries not available.")
+        return
+    timer_queries = [[ids[0], ids[1]], [ids[2], ids[3]]]
+
+def bench_step():
+    """ Advances a --bench-frames run by one frame along the fixed
+    trackball path, and prints the results after the last one. """
+    global trackball, bench_done, redisplay_posted, stats, forced_level
+
+    if redisplay_posted:
+        return # previous frame not drawn yet
+
+    if bench_done == 0:
+        # start from a fresh view and fresh statistics
+        trackball = quat.for_rotation(0.0,vector(1.0,0.0,0.0))
+        forced_level = target_level
+        buffer_bytes = stats.buffer_bytes
+        stats = frame_stats()
+        stats.buffer_bytes = buffer_bytes
+
+    if bench_done == bench_frames:
+        print("Rendered " + str(bench_frames) + " frames at level " +
+              str(shown_level) + ", " + str(triangle_count) + " triangles.")
+        print(stats.percentiles())
+        sys.exit(0)
+
+    trackball = quat.for_rotation(BENCH_STEP, BENCH_AXIS) * trackball
+    bench_done += 1
+    redisplay_posted = True
+    glutPostRedisplay()
+
+def parse_options(argv):
+    """ Removes the --bench-frames N, --frame-log, --precision
+    float32|float64, --weld TOLERANCE and --profile[=PREFIX] options
+    from ARGV, setting the matching globals, and returns the remaining
+    arguments. """
+    global bench_frames, frame_log, profile_prefix, precision, weld
+
+    profile_prefix, argv = profiling.parse_profile_option(argv, 'newview')
+    rest = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--bench-frames':
+            bench_frames = int(argv[i+1])
+            i += 1
+        elif argv[i] == '--frame-log':
+            frame_log = True
+        elif argv[i] == '--precision':
+            precision = argv[i+1]
+            if precision not in ('float32', 'float64'):
+                print("--precision must be float32 or float64")
+                sys.exit(1)
+            i += 1
+        elif argv[i] == '--weld':
+            weld = float(argv[i+1])
+            i += 1
+        else:
+            rest.append(argv[i])
+        i += 1
+    return rest
+
 def move_face(dir):
     global last_selected_face, selected_face, add_face
 
@@ -231,6 +382,7 @@ def move_face(dir):
 
 def keyboard(key, x, y):
     """ Handle a "normal" keypress. """
+    global forced_level, show_overlay
 
     # Handle ESC key.
     if key == b'\033':	
@@ -243,6 +395,23 @@ def keyboard(key, x, y):
     if key == b'.' and selected_face:
         move_face('RIGHT')
 
+    # Number keys force a subdivision level, 'a' goes back to choosing
+    # one from the object's size on screen.
+    if key.isdigit():
+        forced_level = int(key)
+        set_title()
+        glutPostRedisplay()
+
+    if key == b'a':
+        forced_level = None
+        set_title()
+        glutPostRedisplay()
+
+    # 't' toggles the frame timing overlay
+    if key == b't':
+        show_overlay = not show_overlay
+        glutPostRedisplay()
+
 
 def arrow(key, x, y):
     """ Handle a "special" keypress. """
@@ -267,6 +436,7 @@ def arrow(key, x, y):
 
 def mouse(button, state, x, y):
     global xStart, yStart, trackball, selected_face, add_face
+    apply_motion() # finish any drag before moving the start point
     xStart = (x - width/2) * scale
     yStart = (height/2 - y) * scale
 
@@ -277,7 +447,25 @@ def mouse(button, state, x, y):
     glutPostRedisplay()
 
 def motion(x, y):
-    global trackball, xStart, yStart
+    """ Records the mouse position. The trackball is only rotated in
+    draw(), so a burst of motion events costs one redraw. """
+    global pending_motion, redisplay_posted
+
+    pending_motion = (x, y)
+    if not redisplay_posted:
+        redisplay_posted = True
+        glutPostRedisplay()
+
+def apply_motion():
+    """ Rotates the trackball by the mouse motion recorded since the last
+    frame. """
+    global trackball, xStart, yStart, pending_motion
+
+    if pending_motion is None:
+        return
+    x, y = pending_motion
+    pending_motion = None
+
     xNow = (x - width/2) * scale
     yNow = (height/2 - y) * scale
     change = point(xNow,yNow,0.0) - point(xStart,yStart,0.0)
@@ -288,11 +476,138 @@ def motion(x, y):
     trackball = quat.for_rotation(angle,axis) * trackball
     xStart,yStart = xNow, yNow
 
-    glutPostRedisplay()
+def subdivide_levels(coarse, levels):
+    """ Worker thread body. Subdivides tri_mesh COARSE LEVELS times
+    using the array subdivision code, in the chosen precision, and puts
+    each finished level's compiled buffers on level_queue as (level,
+    vertices, normals, colors). """
+
+    m = from_tri_mesh(coarse, precision)
+    verts = m.verts
+    faces = m.faces
+    cols = m.colors
+    for level in range(1, levels + 1):
+        st, faces, edges = loop_stencil(faces, len(verts))
+        verts = st.apply(verts)
+        cols = edge_midpoints(cols, edges)
+        m.verts, m.faces, m.colors = verts, faces, cols
+        level_queue.put((level,) + m.compile())
+
+def upload_buffers(level, vertices, normals, colors):
+    """ Copies VERTICES, NORMALS and COLORS of subdivision level LEVEL
+    into a new set of VBOs, and builds the vertex array objects that
+    draw() uses for them. The result is kept in level_buffers. """
+
+    buffers = {}
+    for name, data in (('vertex', vertices), ('normal', normals),
+                       ('color', colors)):
+        data = np.asarray(data, dtype=np.float32)
+        buf = glGenBuffers(1)
+        glBindBuffer (GL_ARRAY_BUFFER, buf)
+        glBufferData (GL_ARRAY_BUFFER, data.nbytes, data, GL_STATIC_DRAW)
+        buffers[name] = buf
+
+    buffers['phong_vao'] = build_vao(buffers, phong_locs,
+                                     ('vertex', 'normal', 'color'))
+    buffers['shadow_vao'] = build_vao(buffers, shadow_locs, ('vertex',))
+    buffers['triangles'] = len(vertices) // 9
+    buffers['colors'] = colors
+    buffers['bytes'] = 4 * (len(vertices) + len(normals) + len(colors))
+    level_buffers[level] = buffers
+    stats.buffer_bytes = sum(b['bytes'] for b in level_buffers.values())
+
+def build_vao(buffers, locs, attributes):
+    """ Returns a vertex array object binding each of ATTRIBUTES (at
+    locations LOCS) to the matching buffer in BUFFERS. """
+
+    vao = glGenVertexArrays(1)
+    glBindVertexArray(vao)
+    for name in attributes:
+        if locs[name] < 0:
+            continue # attribute optimized out of the shader
+        glEnableVertexAttribArray(locs[name])
+        glBindBuffer (GL_ARRAY_BUFFER, buffers[name])
+        glVertexAttribPointer(locs[name], 3, GL_FLOAT, GL_FALSE, 0, None)
+    glBindVertexArray(0)
+    return vao
+
+def cache_locations():
+    """ Looks up the attribute and uniform locations of both shaders. """
+
+    for name in ('vertex', 'normal', 'color'):
+        phong_locs[name] = glGetAttribLocation(phong_shader, name)
+    for name in ('eye', 'light'):
+        phong_locs[name] = glGetUniformLocation(phong_shader, name)
+
+    shadow_locs['vertex'] = glGetAttribLocation(shadow_shader, 'vertex')
+    for name in ('normal', 'plane', 'light'):
+        shadow_locs[name] = glGetUniformLocation(shadow_shader, name)
+
+def choose_level():
+    """ Picks the subdivision level to draw. Uses the level forced from
+    the keyboard if there is one, otherwise the finest level whose
+    triangles still cover about MIN_TRIANGLE_PIXELS pixels each at the
+    object's projected size. """
+
+    levels = sorted(level_buffers)
+    if forced_level is not None:
+        return max([l for l in levels if l <= forced_level] or levels[:1])
+
+    size = 2.0 * radius / scale # object diameter in pixels
+    best = levels[0]
+    for level in levels:
+        if size * size / level_buffers[level]['triangles'] >= \
+           MIN_TRIANGLE_PIXELS:
+            best = level
+    return best
+
+def use_level(level):
+    """ Makes the buffers of subdivision level LEVEL the ones drawn. """
+    global vertex_buffer, normal_buffer, color_buffer, triangle_count, \
+           colors, shown_level
+
+    buffers = level_buffers[level]
+    vertex_buffer = buffers['vertex']
+    normal_buffer = buffers['normal']
+    color_buffer = buffers['color']
+    triangle_count = buffers['triangles']
+    colors = buffers['colors']
+    if level != shown_level:
+        shown_level = level
+        set_title()
+
+def set_title():
+    """ Shows the displayed subdivision level in the window title. """
+    computed = max(level_buffers)
+    title = 'object-view.py - level ' + str(shown_level)
+    if forced_level is None:
+        title += ' (auto)'
+    title += ', ' + str(computed) + '/' + str(target_level) + ' computed'
+    glutSetWindowTitle((title + ' - Press ESC to quit').encode())
+
+def idle():
+    """ Uploads the buffers of newly finished subdivision levels, and
+    drives --bench-frames runs once the last level is in. """
+
+    try:
+        level, vertices, normals, level_colors = level_queue.get_nowait()
+    except Empty:
+        level = None
+
+    if level is not None:
+        upload_buffers(level, vertices, normals, level_colors)
+        set_title()
+        glutPostRedisplay()
+
+    if max(level_buffers) == target_level:
+        if bench_frames > 0:
+            bench_step()
+        else:
+            glutIdleFunc(None) # nothing left to wait for
 
 def init(argc, argv):
     """ Initialize aspects of the GL scene rendering.  """
-    global trackball, flashlight, vertex_buffer, normal_buffer, color_buffer, colors, vertices, normals, surf, radius, phong_shader, shadow_shader, wireframe
+    global trackball, flashlight, vertex_buffer, normal_buffer, color_buffer, colors, vertices, normals, surf, radius, phong_shader, shadow_shader, wireframe, target_level
 
     # initialize quaternions for the light and trackball
     flashlight = quat.for_rotation(0.0,vector(1.0,0.0,0.0))
@@ -322,12 +637,15 @@ def init(argc, argv):
         # read the .OBJ file into VBOs
         if(filename != None):
             print("Subdividing " + str(subdivisions) + " times.")
-            surf.load(filename)
-            if subdivisions > 0:
-                for i in range(subdivisions):
-                    surf = subdivide(surf)
-                
+            surf.load(filename, weld=weld)
+
+            # Show the coarse mesh right away, the finer levels are
+            # swapped in by idle() as the worker finishes them.
             vertices,normals,colors = surf.compile()
+            target_level = subdivisions
+            if subdivisions > 0:
+                Thread(target=profiling.profiled(subdivide_levels),
+                       args=(surf, subdivisions), daemon=True).start()
         
         else:
             print("No file! \n")
@@ -336,22 +654,6 @@ def init(argc, argv):
             colors = []
             shadows =  []
         
-    vertex_buffer = glGenBuffers(1)
-    glBindBuffer (GL_ARRAY_BUFFER, vertex_buffer)
-    glBufferData (GL_ARRAY_BUFFER, len(vertices)*4, 
-                  (c_float*len(vertices))(*vertices), GL_STATIC_DRAW)
-
-    normal_buffer = glGenBuffers(1)
-    glBindBuffer (GL_ARRAY_BUFFER, normal_buffer)
-    glBufferData (GL_ARRAY_BUFFER, len(normals)*4, 
-                  (c_float*len(normals))(*normals), GL_STATIC_DRAW)
-
-    color_buffer = glGenBuffers(1)
-    glBindBuffer (GL_ARRAY_BUFFER, color_buffer)
-    glBufferData (GL_ARRAY_BUFFER, len(colors)*4, 
-                  (c_float*len(colors))(*colors), GL_STATIC_DRAW)
-    
-    
     radius = surf.radius
 
     # set up the object shaders
@@ -359,6 +661,11 @@ def init(argc, argv):
                  'fs-phong-interp.c')
     shadow_shader = init_shaders('vs-shadow.c',
                  'fs-shadow.c')
+    cache_locations()
+    init_timing()
+
+    upload_buffers(0, vertices, normals, colors)
+    use_level(0)
     
 
     glEnable (GL_DEPTH_TEST)
@@ -386,6 +693,11 @@ def resize(w, h):
 def main(argc, argv):
     """ The main procedure, sets up GL and GLUT. """
 
+    argv = parse_options(argv)
+    argc = len(argv)
+    if profile_prefix != None:
+        profiling.start(profile_prefix)
+
     glutInit(argv)
     glutInitDisplayMode(GLUT_DOUBLE | GLUT_RGB | GLUT_DEPTH)
     glutInitWindowPosition(0, 20)
@@ -404,14 +716,24 @@ def main(argc, argv):
     glutDisplayFunc(draw)
     glutMouseFunc(mouse)
     glutMotionFunc(motion)
+    if argc > 1:
+        set_title()
+        if target_level > 0 or bench_frames > 0:
+            glutIdleFunc(idle)
 
     print()
     print('Press the arrow keys move the flashlight.')
+    print('Press t to show frame timing.')
     print('Press ESC to quit.\n')
     print()
 
+    # return from glutMainLoop when the window is closed, so a running
+    # profile still gets written
+    glutSetOption(GLUT_ACTION_ON_WINDOW_CLOSE,
+                  GLUT_ACTION_GLUTMAINLOOP_RETURNS)
     glutMainLoop()
 
+    profiling.stop()
     return 0
 
 
@@ -0,0 +1,360 @@
+#
+# parallel_obj.py
+#
+# Reads very large .obj files with several worker processes.
+#
+# The file is split into byte ranges that start and end on line
+# boundaries, and each worker parses the 'v', 'vt' and 'f' records of
+# its ranges into arrays. Face indices in an .obj file are global
+# (counted from the first vertex of the file), except negative ones,
+# which count back from the last vertex read so far; the workers keep
+# those relative to their own range, and they are offset by the number
+# of vertices in earlier ranges once every range is back. The result is
+# exactly what array_mesh.load_obj gives for the same file.
+#
+# Ranges made only of "v x y z" and "f a b c" lines (what write_obj and
+# most scanners produce) are parsed in bulk with np.fromstring; anything
+# else (polygons, texture coordinates, negative indices, "f 1/1/1")
+# falls back to reading line by line, like load_obj.
+#
+# Compressed files (see compressed_io) cannot be cut into byte ranges
+# without decompressing them, so this process decompresses them in
+# blocks of whole lines, which the workers parse while it decompresses
+# the next ones.
+#
+#    m = load_obj_parallel('scan.obj', workers=8)
+#
+# The command line reports throughput at several worker counts:
+#
+#    python3 parallel_obj.py scan.obj --workers 1 2 4 8 16
+
+import argparse
+import os
+import sys
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from array_mesh import array_mesh, weld_mesh
+from compressed_io import open_file, compression
+
+
+RANGE_BYTES = 32 * 2**20 # largest byte range handed to one task
+RANGES_PER_WORKER = 4 # so a slow range does not hold up the others
+STREAM_BYTES = 8 * 2**20 # decompressed bytes per block of a compressed file
+
+
+def line_ranges(filename, count):
+    """ Splits file FILENAME into about COUNT byte ranges (START, END),
+    each starting at the beginning of a line and ending just after a
+    newline (or at the end of the file). """
+
+    size = os.path.getsize(filename)
+    cuts = [0]
+    with open(filename, 'rb') as obj_file:
+        for k in range(1, count):
+            at = max(size * k // count, cuts[-1])
+            obj_file.seek(at)
+            obj_file.readline() # to the end of the line holding AT
+            at = obj_file.tell()
+            if at >= size:
+                break
+            if at > cuts[-1]:
+                cuts.append(at)
+    cuts.append(size)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+class obj_range:
+    # The records of one byte range of an .obj file. Vertex indices are
+    # counted from 0 over the whole file, except where RELATIVE is set:
+    # those were negative in the file and are counted from the range's
+    # first vertex (and texture coordinate) instead.
+
+    def __init__(self):
+        self.verts = np.zeros((0, 3))
+        self.faces = np.zeros((0, 3), dtype=np.int64)
+        self.faces_relative = None # (F,3) bool, or None if none are
+        self.uvs = np.zeros((0, 2))
+        # one entry per face corner with a texture index
+        self.corner_verts = np.zeros(0, dtype=np.int64)
+        self.corner_uvs = np.zeros(0, dtype=np.int64)
+        self.corner_verts_relative = None
+        self.corner_uvs_relative = None
+
+
+def parse_bulk(lines):
+    """ Parses LINES, a list of byte strings, if they hold nothing but
+    "v x y z" and "f a b c" records with positive indices (and lines
+    without records, such as comments and normals). Returns an obj_range,
+    or None if some line needs parse_lines. """
+
+    verts = [l[2:] for l in lines if l[:2] == b'v ']
+    faces = [l[2:] for l in lines if l[:2] == b'f ']
+    if len(verts) + len(faces) < len(lines):
+        for l in lines:
+            if l[:2] not in (b'v ', b'f '):
+                head = l.split(None, 1)[:1]
+                if head in ([b'v'], [b'vt'], [b'f']):
+                    return None
+    nverts = len(verts)
+    nfaces = len(faces)
+    verts = b' '.join(verts)
+    faces = b' '.join(faces)
+    if b'/' in faces or b'-' in faces:
+        return None
+
+    # a number np.fromstring cannot read ends the array early, with a
+    # DeprecationWarning; make that an error, and check the counts
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            v = np.fromstring(verts, dtype=np.float64, sep=' ')
+            f = np.fromstring(faces, dtype=np.int64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return None
+    if v.size != 3 * nverts or f.size != 3 * nfaces:
+        return None # some line has more (or fewer) than three numbers
+    r = obj_range()
+    r.verts = v.reshape(-1, 3)
+    r.faces = f.reshape(-1, 3) - 1
+    return r
+
+
+def parse_lines(lines):
+    """ Parses LINES, a list of byte strings, one record at a time, by
+    the same rules as array_mesh.parse_obj. Returns an obj_range. """
+
+    verts = []
+    faces = []
+    relative = []
+    uvs = []
+    corner_verts = []
+    corner_uvs = []
+    corner_verts_relative = []
+    corner_uvs_relative = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) > 0:
+            if parts[0] == b'v':
+                verts.append((float(parts[1]), float(parts[2]),
+                              float(parts[3])))
+            elif parts[0] == b'vt':
+                uvs.append((float(parts[1]), float(parts[2])))
+            elif parts[0] == b'f':
+                corners = [p.split(b'/') for p in parts[1:]]
+                idx = [int(c[0]) for c in corners]
+                rel = [i < 0 for i in idx]
+                idx = [i - 1 if i > 0 else len(verts) + i for i in idx]
+                for k in range(1, len(idx) - 1):
+                    faces.append((idx[0], idx[k], idx[k+1]))
+                    relative.append((rel[0], rel[k], rel[k+1]))
+                for i, r, c in zip(idx, rel, corners):
+                    if len(c) > 1 and c[1]:
+                        t = int(c[1])
+                        corner_verts.append(i)
+                        corner_verts_relative.append(r)
+                        corner_uvs.append(t - 1 if t > 0 else len(uvs) + t)
+                        corner_uvs_relative.append(t < 0)
+
+    r = obj_range()
+    if verts:
+        r.verts = np.array(verts)
+    if faces:
+        r.faces = np.array(faces, dtype=np.int64)
+        r.faces_relative = np.array(relative, dtype=bool)
+    if uvs:
+        r.uvs = np.array(uvs)
+    if corner_verts:
+        r.corner_verts = np.array(corner_verts, dtype=np.int64)
+        r.corner_uvs = np.array(corner_uvs, dtype=np.int64)
+        r.corner_verts_relative = np.array(corner_verts_relative, dtype=bool)
+        r.corner_uvs_relative = np.array(corner_uvs_relative, dtype=bool)
+    return r
+
+
+def parse_block(data):
+    """ Parses DATA, whole lines of an .obj file as bytes. Returns an
+    obj_range. """
+
+    lines = data.splitlines()
+    r = parse_bulk(lines)
+    if r is None:
+        r = parse_lines(lines)
+    return r
+
+
+def parse_range(task):
+    """ Reads and parses byte range TASK = (FILENAME, START, END) of an
+    .obj file. Returns an obj_range. """
+
+    filename, start, end = task
+    with open(filename, 'rb') as obj_file:
+        obj_file.seek(start)
+        return parse_block(obj_file.read(end - start))
+
+
+def stream_blocks(filename, size=STREAM_BYTES):
+    """ Yields the lines of compressed .obj file FILENAME, decompressed,
+    in blocks of about SIZE bytes ending on a line boundary. """
+
+    with open_file(filename, 'rb') as obj_file:
+        rest = b''
+        while True:
+            data = obj_file.read(size)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            if cut:
+                yield data[:cut]
+        if rest:
+            yield rest
+
+
+def map_in_order(pool, function, items, window):
+    """ Yields FUNCTION(ITEM) for each of ITEMS, in order, computed in
+    executor POOL with at most WINDOW of them submitted at a time, so a
+    long stream of ITEMS is not all held in memory. """
+
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def join_ranges(ranges, dtype=np.float64):
+    """ Concatenates the obj_ranges RANGES, in file order, resolving
+    their relative indices, into an array_mesh with positions of type
+    DTYPE (with a 'uv' attribute under the same rules as parse_obj). """
+
+    if not ranges:
+        ranges = [obj_range()] # an empty file, streamed in no blocks
+    vert_offsets = np.cumsum([0] + [len(r.verts) for r in ranges])
+    uv_offsets = np.cumsum([0] + [len(r.uvs) for r in ranges])
+
+    def resolve(values, relative, offset):
+        if relative is not None:
+            values = values + relative * offset
+        return values
+
+    faces = [resolve(r.faces, r.faces_relative, vert_offsets[k])
+             for k, r in enumerate(ranges)]
+    corner_verts = np.concatenate(
+        [resolve(r.corner_verts, r.corner_verts_relative, vert_offsets[k])
+         for k, r in enumerate(ranges)])
+    corner_uvs = np.concatenate(
+        [resolve(r.corner_uvs, r.corner_uvs_relative, uv_offsets[k])
+         for k, r in enumerate(ranges)])
+
+    m = array_mesh(np.concatenate([r.verts for r in ranges]),
+                   np.concatenate(faces), dtype=dtype)
+
+    # parse_obj gives every vertex the texture coordinate of its first
+    # corner, and keeps none if any vertex has two (a seam)
+    if len(corner_verts):
+        order = np.argsort(corner_verts, kind='stable')
+        by_vert = corner_verts[order]
+        start = np.empty(len(order), dtype=bool)
+        start[0] = True
+        start[1:] = by_vert[1:] != by_vert[:-1]
+        group = np.cumsum(start) - 1
+        first_uv = corner_uvs[order][start]
+        if (corner_uvs[order] == first_uv[group]).all():
+            uv = np.zeros((len(m.verts), 2))
+            uv[by_vert[start]] = np.concatenate(
+                [r.uvs for r in ranges])[first_uv]
+            m.addAttribute('uv', uv, 'linear')
+    return m
+
+
+def load_obj_parallel(filename, workers=None, dtype=np.float64, weld=None):
+    """ Loads .obj file FILENAME like array_mesh.load_obj (taking the
+    same DTYPE and WELD, and compressed files), parsing its byte ranges
+    in WORKERS processes (default: one per CPU). With one worker
+    everything runs in this process. """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if compression(filename) is not None:
+        blocks = stream_blocks(filename)
+        if workers == 1:
+            ranges = [parse_block(data) for data in blocks]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                ranges = list(map_in_order(pool, parse_block, blocks,
+                                           2 * workers))
+    else:
+        size = os.path.getsize(filename)
+        count = max(-(-size // RANGE_BYTES), 1)
+        if workers > 1:
+            count = max(count, workers * RANGES_PER_WORKER)
+        tasks = [(filename, start, end)
+                 for start, end in line_ranges(filename, count)]
+        if workers == 1:
+            ranges = [parse_range(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                ranges = list(pool.map(parse_range, tasks))
+
+    m = join_ranges(ranges, dtype)
+    if weld is not None:
+        m = weld_mesh(m, weld)
+    return m
+
+
+def same_mesh(a, b):
+    """ Returns True if array_meshes A and B hold exactly the same
+    arrays. """
+
+    if not (np.array_equal(a.verts, b.verts) and
+            np.array_equal(a.faces, b.faces) and
+            np.array_equal(a.colors, b.colors) and
+            sorted(a.attributes) == sorted(b.attributes)):
+        return False
+    return all(np.array_equal(a.attributes[name], b.attributes[name])
+               for name in a.attributes)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Parse an .obj file with several processes.')
+    parser.add_argument('filename', help='.obj file')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--check', action='store_true',
+                        help='compare with the single-threaded load_obj')
+    args = parser.parse_args(argv[1:])
+
+    from array_mesh import load_obj
+    size = os.path.getsize(args.filename) / 2.0**20
+    reference = None
+    if args.check:
+        start = time.perf_counter()
+        reference = load_obj(args.filename)
+        seconds = time.perf_counter() - start
+        print('%-12s %8.2f s %8.1f MB/s' % ('load_obj:', seconds,
+                                             size / seconds))
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        m = load_obj_parallel(args.filename, workers)
+        seconds = time.perf_counter() - start
+        line = '%-12s %8.2f s %8.1f MB/s' % ('%d workers:' % workers,
+                                             seconds, size / seconds)
+        if reference is not None:
+            line += '  ' + ('same' if same_mesh(m, reference)
+                            else 'DIFFERENT')
+        print(line)
+    print('%s: %.1f MB, %d vertices, %d triangles, %d CPUs' %
+          (args.filename, size, len(m.verts), len(m.faces),
+           os.cpu_count() or 1))
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,119 @@
+#
+# precision_report.py
+#
+# How much accuracy the float32 precision mode (see array_mesh.py)
+# gives up. Every object is loaded and subdivided twice, in float64 and
+# in float32, and for each level the report lists
+#
+#    position:  max and RMS distance between the float32 and float64
+#               vertices of that level
+#    limit:     the same for their Loop limit positions (where the
+#               surface converges to), the positions that matter
+#    normal:    largest angle between float32 and float64 vertex normals
+#    MB:        vertex and color memory of the level in each precision
+#    kept:      whether reordering the float32 level (spatial_order and
+#               vertex_cache) still gives float32 meshes
+#
+# Distances are relative to the object's radius, so 1e-7 means one part
+# in ten million of the object's size. float32 has a 24 bit mantissa
+# (about 6e-8 relative), so values of a few 1e-7 are rounding noise.
+#
+#    python3 precision_report.py                 levels 0 to 3, all objects
+#    python3 precision_report.py 5 objects/bunny.obj
+
+import argparse
+import glob
+import sys
+import numpy as np
+from array_mesh import load_obj
+from array_subdivision import loop_subdivide, limit_positions
+from spatial_order import reorder, shuffle
+from vertex_cache import optimize
+
+
+def distances(a, b):
+    """ Returns the distance between each pair of rows of A and B,
+    computed in float64. """
+
+    d = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    return np.sqrt((d * d).sum(axis=1))
+
+
+def reorder_keeps_precision(m):
+    """ Returns True if every way of reordering array_mesh M returns a
+    mesh of M's precision. """
+
+    reordered = [reorder(m), shuffle(m), optimize(m)]
+    return all(r.verts.dtype == m.verts.dtype and
+               r.colors.dtype == m.verts.dtype for r in reordered)
+
+
+def compare(filename, levels):
+    """ Returns one record per level in LEVELS comparing float32 and
+    float64 subdivision of .obj file FILENAME. """
+
+    records = []
+    m64 = load_obj(filename, np.float64)
+    m32 = load_obj(filename, np.float32)
+    scale = m64.radius or 1.0
+    done = 0
+    for level in levels:
+        m64 = loop_subdivide(m64, level - done)
+        m32 = loop_subdivide(m32, level - done)
+        done = level
+
+        position = distances(m32.verts, m64.verts) / scale
+        limit = distances(limit_positions(m32), limit_positions(m64)) / scale
+        cosine = (m32.normals().astype(np.float64) * m64.normals()).sum(axis=1)
+        angle = np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0)))
+
+        records.append({
+            'object': filename, 'level': level, 'vertices': len(m64.verts),
+            'position_max': float(position.max()),
+            'position_rms': float(np.sqrt((position ** 2).mean())),
+            'limit_max': float(limit.max()),
+            'limit_rms': float(np.sqrt((limit ** 2).mean())),
+            'normal_max_degrees': float(angle.max()),
+            'mb64': (m64.verts.nbytes + m64.colors.nbytes) / 2.0**20,
+            'mb32': (m32.verts.nbytes + m32.colors.nbytes) / 2.0**20,
+            'reorder_keeps_float32': reorder_keeps_precision(m32)})
+    return records
+
+
+def report(records):
+    """ Returns RECORDS as a text table. """
+
+    lines = ['%-24s %3s %8s %9s %9s %9s %9s %8s %7s %7s %4s' %
+             ('object', 'lvl', 'verts', 'pos max', 'pos rms', 'lim max',
+              'lim rms', 'nrm deg', 'MB f64', 'MB f32', 'kept')]
+    for r in records:
+        lines.append('%-24s %3d %8d %9.2e %9.2e %9.2e %9.2e %8.1e %7.2f %7.2f'
+                     ' %4s'
+                     % (r['object'], r['level'], r['vertices'],
+                        r['position_max'], r['position_rms'],
+                        r['limit_max'], r['limit_rms'],
+                        r['normal_max_degrees'], r['mb64'], r['mb32'],
+                        'yes' if r['reorder_keeps_float32'] else 'NO'))
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Accuracy of float32 against float64 subdivision.')
+    parser.add_argument('levels', type=int, nargs='?', default=3,
+                        help='report levels 0 to LEVELS')
+    parser.add_argument('filenames', nargs='*',
+                        help='.obj files (default: objects/*.obj)')
+    args = parser.parse_args(argv[1:])
+
+    records = []
+    for filename in args.filenames or sorted(glob.glob('objects/*.obj')):
+        records += compare(filename, range(args.levels + 1))
+    print(report(records))
+    if not all(r['reorder_keeps_float32'] for r in records):
+        print('reordering lost float32 precision')
+        return 1
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,176 @@
+#
+# profiling.py
+#
+# Built-in cProfile support for the command line entry points
+# (newview.py and tri_mesh.py take a --profile option).
+#
+# A profiled run writes two files:
+#
+#    PREFIX.pstats     the raw profile, for pstats / snakeviz
+#    PREFIX.collapsed  "frame;frame;frame microseconds" lines, the input
+#                      format of flamegraph.pl and speedscope
+#
+# cProfile only records caller -> callee totals, not whole stacks, so
+# the collapsed stacks are rebuilt by splitting each function's time
+# among its callers in proportion to the time each caller spent in it.
+# Recursive calls are folded into the outermost call.
+#
+# Up to Python 3.11 a Profile only sees the thread that enabled it, so
+# every profiled() thread gets its own and stop() merges them. From 3.12
+# cProfile runs on sys.monitoring, which allows one profiler at a time
+# and shows it every thread, so the Profile from start() covers them all.
+
+import atexit
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+
+profilers = [] # every Profile started, one per profiled thread
+PER_THREAD = sys.version_info < (3, 12) # see the top of this file
+prefix = None # output file prefix while a profile is running
+lock = threading.Lock()
+
+
+def parse_profile_option(argv, default):
+    """ Removes a --profile or --profile=PREFIX option from ARGV.
+    Returns (PREFIX, remaining arguments); PREFIX is DEFAULT for a bare
+    --profile and None without the option. """
+
+    rest = []
+    chosen = None
+    for arg in argv:
+        if arg == '--profile':
+            chosen = default
+        elif arg.startswith('--profile='):
+            chosen = arg[len('--profile='):]
+        else:
+            rest.append(arg)
+    return chosen, rest
+
+
+def start(output_prefix):
+    """ Starts profiling the calling thread. The results are written to
+    OUTPUT_PREFIX.pstats and .collapsed by stop(), or at exit. """
+    global prefix
+
+    prefix = output_prefix
+    profiler = cProfile.Profile()
+    profiler.enable()
+    with lock:
+        profilers.append(profiler)
+    atexit.register(stop)
+
+
+def profiled(func):
+    """ Returns FUNC wrapped so that, while a profile is running, calls
+    to it (e.g. the body of a worker thread) are profiled too. """
+
+    def wrapper(*args, **kwargs):
+        if prefix is None or not PER_THREAD:
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        with lock:
+            profilers.append(profiler) # only once it is running
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+    return wrapper
+
+
+def stop():
+    """ Stops profiling and writes the output files. Does nothing if no
+    profile is running. """
+    global prefix
+
+    if prefix is None:
+        return
+    output_prefix = prefix
+    prefix = None
+
+    with lock:
+        recorded = []
+        for profiler in profilers:
+            profiler.disable()
+            profiler.create_stats()
+            if profiler.stats: # a thread may not have run anything yet
+                recorded.append(profiler)
+        del profilers[:]
+    if not recorded:
+        print("Nothing was profiled")
+        return
+    stats = pstats.Stats(recorded[0])
+    for profiler in recorded[1:]:
+        stats.add(profiler)
+
+    stats.dump_stats(output_prefix + '.pstats')
+    write_collapsed(stats, output_prefix + '.collapsed')
+    print("Profile written to " + output_prefix + ".pstats and " +
+          output_prefix + ".collapsed")
+
+
+def frame_name(func):
+    """ Returns a flame graph frame name for pstats function key FUNC. """
+
+    filename, line, name = func
+    if filename == '~':
+        return name # built-in, e.g. <built-in method ...>
+    return name + ' (' + os.path.basename(filename) + ':' + str(line) + ')'
+
+
+def collapsed_stacks(stats, min_us=1):
+    """ Returns {stack: microseconds} for pstats.Stats STATS, each stack
+    a ';' separated string of frame names from the root down. Stacks
+    under MIN_US microseconds are dropped. """
+
+    table = stats.stats # func -> (cc, nc, tt, ct, callers)
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in table.items():
+        for caller, edge in callers.items():
+            if caller != func:
+                callees.setdefault(caller, []).append((func, edge[3]))
+
+    stacks = {}
+
+    def visit(func, path, names, fraction):
+        cc, nc, tt, ct, callers = table[func]
+        names = names + [frame_name(func).replace(';', ',')]
+        us = tt * fraction * 1.0e6
+        if us >= min_us:
+            key = ';'.join(names)
+            stacks[key] = stacks.get(key, 0) + int(round(us))
+        for callee, edge_ct in callees.get(func, []):
+            total = table[callee][3]
+            if callee in path or total <= 0.0:
+                continue # recursion, folded into the outer call
+            share = fraction * edge_ct / total
+            if share * total * 1.0e6 >= min_us:
+                visit(callee, path | {callee}, names, share)
+
+    # Roots are the time a function spent on calls its recorded callers
+    # do not account for: all of it for functions called from frames
+    # already running when profiling started (the module that called
+    # start(), a thread begun before it), and on Python 3.12+, where one
+    # profiler sees every thread, calls whose caller edges are missing.
+    for func, (cc, nc, tt, ct, callers) in table.items():
+        inside = sum(edge[3] for c, edge in callers.items()
+                     if c != func and c in table)
+        if ct <= 0.0:
+            if inside <= 0.0:
+                visit(func, {func}, [], 1.0)
+        elif ct - inside > 1.0e-9:
+            visit(func, {func}, [], (ct - inside) / ct)
+    return stacks
+
+
+def write_collapsed(stats, filename):
+    """ Writes the collapsed stacks of STATS to FILENAME. """
+
+    out = open(filename, 'w')
+    for stack, us in sorted(collapsed_stacks(stats).items()):
+        out.write(stack + ' ' + str(us) + '\n')
+    out.close()
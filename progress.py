@@ -0,0 +1,93 @@
+#
+# progress.py
+#
+# Progress reports and cooperative cancellation for long mesh work.
+#
+# mesh.load (and build) and loop_subdivision.subdivide take
+#
+#    progress:  a function called as progress(level, done, total) every
+#               CHUNK triangles and once at the end of each level: DONE
+#               of the level's TOTAL triangles have been processed.
+#               Level 0 is the mesh being loaded, whose total is None
+#               until the whole file has been read.
+#    cancel:    a cancel_token. Once it is cancelled, from any thread,
+#               the work stops at the next chunk boundary, undoes what
+#               it had half built, and raises cancelled.
+#
+# A cancelled subdivide leaves the mesh it was given as it was, and a
+# cancelled load leaves the mesh empty.
+
+import threading
+
+
+CHUNK = 4096 # triangles between progress reports / cancellation checks
+
+
+class cancelled(Exception):
+    # Raised by mesh work that was stopped through its cancel_token.
+    pass
+
+
+class cancel_token:
+    # A flag that one thread sets to stop mesh work running in another.
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        """ Asks the work using this token to stop. """
+        self.event.set()
+
+    def cancelled(self):
+        """ Returns True once cancel() has been called. """
+        return self.event.is_set()
+
+    def check(self):
+        """ Raises cancelled if cancel() has been called. """
+        if self.event.is_set():
+            raise cancelled()
+
+
+class progress_meter:
+    # Counts the triangles done at one level, reporting and checking for
+    # cancellation every CHUNK of them.
+
+    def __init__(self, level, total, progress=None, cancel=None,
+                 chunk=CHUNK):
+
+        self.level = level
+        self.total = total
+        self.progress = progress
+        self.cancel = cancel
+        self.chunk = chunk
+        self.done = 0
+        # with nothing to report to, step() never calls boundary()
+        if progress is None and cancel is None:
+            self.next = float('inf')
+        else:
+            self.next = chunk
+
+    def step(self, n=1):
+        """ Counts N more triangles done. """
+
+        self.done += n
+        if self.done >= self.next:
+            self.next += self.chunk
+            self.boundary()
+
+    def boundary(self):
+        """ Reports progress, then raises cancelled if the work has been
+        cancelled. """
+
+        if self.progress is not None:
+            self.progress(self.level, self.done, self.total)
+        if self.cancel is not None:
+            self.cancel.check()
+
+    def finish(self, total=None):
+        """ Reports the level as finished, with TOTAL triangles if the
+        total was not known up front. """
+
+        if total is not None:
+            self.total = total
+        self.boundary()
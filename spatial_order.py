@@ -0,0 +1,220 @@
+#
+# spatial_order.py
+#
+# Renumbers the vertices and faces of a mesh along a space-filling curve
+# through their positions.
+#
+# .obj files, scans especially, often list vertices and faces in no
+# useful order, so the gathers in subdivision (verts[faces], the one-ring
+# sums, the object engine's edge and fan walks) jump all over memory.
+# Sorting vertices by their position along a Morton (Z-order) or Hilbert
+# curve puts vertices that are close in space close in memory, and
+# faces are then sorted by their first vertex so they follow along.
+#
+#    reorder(m, curve):  array_mesh copy in curve order; its vertex_order
+#                        and face_order give the old index of each new
+#                        vertex / face
+#    restore(m):         undoes reorder
+#
+# From the command line, times subdivision of large meshes in their own
+# order, shuffled (like a scan), and in Morton and Hilbert order:
+#
+#    python3 spatial_order.py                     generated meshes
+#    python3 spatial_order.py scan.obj noisy:2000000 --levels 2
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+import numpy as np
+from array_mesh import array_mesh, load_obj
+
+
+BITS = 21 # bits per axis; three of them fill a 64 bit code
+
+
+def quantize(points, bits=BITS):
+    """ Returns (N,3) POINTS scaled onto a grid of 2^BITS cells per axis,
+    as uint64. All axes share one scale so the grid cells are cubes. """
+
+    points = np.asarray(points, dtype=np.float64)
+    low = points.min(axis=0)
+    size = float((points.max(axis=0) - low).max()) or 1.0
+    cells = (points - low) * (((1 << bits) - 1) / size)
+    return np.clip(np.rint(cells), 0, (1 << bits) - 1).astype(np.uint64)
+
+
+def spread_bits(x):
+    """ Spreads the low 21 bits of uint64 array X out to every third
+    bit. """
+
+    x = x & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def morton_codes(points, bits=BITS):
+    """ Returns the Morton (Z-order) code of each of the (N,3) POINTS:
+    the bits of the three grid coordinates interleaved. """
+
+    q = quantize(points, bits)
+    return (spread_bits(q[:, 0]) << np.uint64(2) |
+            spread_bits(q[:, 1]) << np.uint64(1) |
+            spread_bits(q[:, 2]))
+
+
+def hilbert_codes(points, bits=BITS):
+    """ Returns the position of each of the (N,3) POINTS along a 3D
+    Hilbert curve. Unlike the Z-order curve, consecutive cells of the
+    Hilbert curve always share a face. Uses Skilling's transpose
+    algorithm ("Programming the Hilbert curve", 2004) on all points at
+    once. """
+
+    x = [c.copy() for c in quantize(points, bits).T]
+    one = np.uint64(1)
+
+    # undo the excess work of the Gray code, one bit at a time
+    q = one << np.uint64(bits - 1)
+    while q > one:
+        p = q - one
+        for i in range(3):
+            high = (x[i] & q) != 0
+            x[0] = np.where(high, x[0] ^ p, x[0]) # invert
+            t = np.where(high, np.uint64(0), (x[0] ^ x[i]) & p)
+            x[0] ^= t # or exchange
+            x[i] ^= t
+        q >>= one
+
+    # Gray encode
+    x[1] ^= x[0]
+    x[2] ^= x[1]
+    t = np.zeros_like(x[0])
+    q = one << np.uint64(bits - 1)
+    while q > one:
+        t = np.where((x[2] & q) != 0, t ^ (q - one), t)
+        q >>= one
+    for i in range(3):
+        x[i] ^= t
+
+    return (spread_bits(x[0]) << np.uint64(2) |
+            spread_bits(x[1]) << np.uint64(1) |
+            spread_bits(x[2]))
+
+
+CURVES = {'morton': morton_codes, 'hilbert': hilbert_codes}
+
+
+def renumber(m, vertex_order, face_order):
+    """ Returns a copy of array_mesh M whose vertex i is M's vertex
+    VERTEX_ORDER[i] and whose face j is M's face FACE_ORDER[j]. """
+
+    remap = np.empty(len(vertex_order), dtype=np.int64)
+    remap[vertex_order] = np.arange(len(vertex_order), dtype=np.int64)
+    out = array_mesh(m.verts[vertex_order], remap[m.faces[face_order]],
+                     m.colors[vertex_order], m.verts.dtype)
+    out.copyAttributes(m, vertex_order)
+    out.vertex_order = vertex_order
+    out.face_order = face_order
+    return out
+
+
+def reorder(m, curve='hilbert', bits=BITS):
+    """ Returns a copy of array_mesh M with its vertices sorted along
+    CURVE ('hilbert' or 'morton'), and its faces sorted by their lowest
+    new vertex index. The copy's vertex_order and face_order map new
+    positions to the old ones (see restore). """
+
+    codes = CURVES[curve](m.verts, bits)
+    vertex_order = np.argsort(codes, kind='stable')
+    remap = np.empty(len(vertex_order), dtype=np.int64)
+    remap[vertex_order] = np.arange(len(vertex_order), dtype=np.int64)
+    face_order = np.argsort(remap[m.faces].min(axis=1), kind='stable')
+    return renumber(m, vertex_order, face_order)
+
+
+def restore(m):
+    """ Returns array_mesh M, made by reorder, back in its original
+    order. """
+
+    return renumber(m, np.argsort(m.vertex_order),
+                    np.argsort(m.face_order))
+
+
+def shuffle(m, seed=0):
+    """ Returns a copy of array_mesh M with its vertices and faces in a
+    random order, like an unsorted scan. """
+
+    rng = np.random.default_rng(seed)
+    return renumber(m, rng.permutation(len(m.verts)),
+                    rng.permutation(len(m.faces)))
+
+
+def time_subdivision(m, levels, engine, repeat):
+    """ Returns the fastest of REPEAT runs of LEVELS levels of
+    subdivision of array_mesh M with ENGINE ('array' or 'object'). """
+
+    best = float('inf')
+    for i in range(repeat):
+        if engine == 'array':
+            from array_subdivision import loop_subdivide
+            start = time.perf_counter()
+            loop_subdivide(m, levels)
+        else:
+            from array_mesh import to_tri_mesh
+            from loop_subdivision import subdivide
+            with contextlib.redirect_stdout(io.StringIO()):
+                surf = to_tri_mesh(m)
+                start = time.perf_counter()
+                subdivide(surf, levels)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def load_input(name):
+    """ Loads an .obj file NAME, or generates a mesh for a NAME of the
+    form KIND:FACES (see mesh_generators.py). """
+
+    if ':' in name and not name.endswith('.obj'):
+        from mesh_generators import GENERATORS
+        kind, faces = name.split(':')
+        return GENERATORS[kind](int(float(faces)))
+    return load_obj(name)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Subdivision time in file, shuffled and curve order.')
+    parser.add_argument('inputs', nargs='*',
+                        default=['noisy:500000', 'torus:500000'],
+                        help='.obj files or KIND:FACES generated meshes')
+    parser.add_argument('--levels', type=int, default=1)
+    parser.add_argument('--engine', default='array',
+                        choices=['array', 'object'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv[1:])
+
+    print('%-24s %9s %9s %9s %9s %9s %9s' %
+          ('mesh', 'faces', 'file', 'shuffled', 'morton', 'hilbert',
+           'sort'))
+    for name in args.inputs:
+        m = load_input(name)
+        scan = shuffle(m)
+        start = time.perf_counter()
+        ordered = dict((curve, reorder(scan, curve)) for curve in CURVES)
+        sort = (time.perf_counter() - start) / len(CURVES)
+
+        times = [time_subdivision(mesh, args.levels, args.engine,
+                                  args.repeat)
+                 for mesh in (m, scan, ordered['morton'],
+                              ordered['hilbert'])]
+        print('%-24s %9d %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs' %
+              ((name, len(m.faces)) + tuple(times) + (sort,)))
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,295 @@
+#
+# stream_subdivision.py
+#
+# Produces the triangles of a deep subdivision level a few coarse faces
+# at a time, for writers and rasterisers that consume triangles as they
+# come, so the whole level never has to exist at once.
+#
+# The level-k triangles inside a coarse face only depend on the coarse
+# vertices of the faces around its corners (every vertex of the fine
+# mesh is a weighted sum over a one-ring, and the rings halve in size
+# with each level). So each block of coarse faces is subdivided together
+# with that neighbourhood, the rest of the mesh left out, and after
+# every level the patch is trimmed again to the faces around the
+# block's own fine triangles. Memory stays at the coarse mesh plus one
+# patch, whatever the level.
+#
+# Every level-k vertex also gets a global id, the same in every block
+# that uses it: coarse vertices keep their index, then come the 2^k - 1
+# new vertices of each coarse edge, then the interior vertices of each
+# coarse face. That numbering covers the whole level, so blocks can be
+# welded back together or written to indexed formats.
+#
+#    for block in stream_triangles(m, 4):
+#        block.verts, block.faces, block.colors, block.vertex_ids,
+#        block.coarse_faces
+#
+# Every block has a fixed cost, so blocks of a single face are slow;
+# a few dozen faces per block (GROUP) cost little memory and run several
+# times faster. The command line compares time and peak memory with
+# subdividing the whole mesh:
+#
+#    python3 stream_subdivision.py objects/bunny.obj 4 --group 16
+#    python3 stream_subdivision.py objects/bunny.obj 4 --stl bunny.stl
+
+import argparse
+import struct
+import sys
+import time
+import numpy as np
+from array_mesh import array_mesh, one_ring, csr_positions, STL_RECORD
+from array_subdivision import loop_stencil, stack_channels, \
+     split_channels, edge_midpoints
+
+
+NO_VERTEX = np.iinfo(np.int64).max # unused slot of a vertex's location
+
+
+def merge_locations(ids0, w0, ids1, w1):
+    """ Returns the locations (IDS, WEIGHTS) of the midpoints of two
+    lists of vertices with locations (IDS0, W0) and (IDS1, W1). A
+    location is up to three coarse vertex ids, ascending and padded with
+    NO_VERTEX, with integer weights. Both vertices of each pair lie in
+    one coarse face, so the midpoint needs no more than three either;
+    its weights sum to twice theirs. """
+
+    ids = np.concatenate([ids0, ids1], axis=1)
+    w = np.concatenate([w0, w1], axis=1)
+    order = np.argsort(ids, axis=1, kind='stable')
+    ids = np.take_along_axis(ids, order, axis=1)
+    w = np.take_along_axis(w, order, axis=1)
+
+    # each id appears at most twice, once from each side: fold the
+    # second into the first
+    for j in range(1, 6):
+        same = (ids[:, j] == ids[:, j - 1]) & (ids[:, j] != NO_VERTEX)
+        w[same, j - 1] += w[same, j]
+        ids[same, j] = NO_VERTEX
+        w[same, j] = 0
+
+    order = np.argsort(ids, axis=1, kind='stable')[:, :3]
+    return (np.take_along_axis(ids, order, axis=1),
+            np.take_along_axis(w, order, axis=1))
+
+
+class stream_numbering:
+    # The global vertex numbering of one subdivision level of a coarse
+    # mesh (see the top of this file).
+
+    def __init__(self, faces, nverts, level):
+
+        self.nverts = nverts
+        self.n = 2 ** level # segments per coarse edge
+        ring = one_ring(faces, nverts)
+        self.ring = ring
+        self.edge_keys = ring.edges[:, 0] * nverts + ring.edges[:, 1]
+        self.nedges = len(ring.edges)
+
+        # faces by their sorted corners: edge (a, b), then c
+        corners = np.sort(faces, axis=1)
+        keys = self.edge_index(corners[:, 0], corners[:, 1]) * nverts + \
+               corners[:, 2]
+        self.face_order = np.argsort(keys, kind='stable')
+        self.face_keys = keys[self.face_order]
+
+    def __len__(self):
+        n = self.n
+        return (self.nverts + self.nedges * (n - 1) +
+                len(self.face_keys) * (n - 1) * (n - 2) // 2)
+
+    def edge_index(self, a, b):
+        """ Returns the index of coarse edge (A, B), A < B. """
+        return np.searchsorted(self.edge_keys, a * self.nverts + b)
+
+    def ids(self, loc_ids, loc_w):
+        """ Returns the global ids of vertices at locations (LOC_IDS,
+        LOC_W), whose weights sum to n. """
+
+        n = self.n
+        used = (loc_ids != NO_VERTEX).sum(axis=1)
+        gid = loc_ids[:, 0].copy()
+
+        on_edge = np.nonzero(used == 2)[0]
+        e = self.edge_index(loc_ids[on_edge, 0], loc_ids[on_edge, 1])
+        gid[on_edge] = self.nverts + e * (n - 1) + loc_w[on_edge, 1] - 1
+
+        inside = np.nonzero(used == 3)[0]
+        a, b, c = loc_ids[inside, 0], loc_ids[inside, 1], loc_ids[inside, 2]
+        f = self.face_order[np.searchsorted(
+            self.face_keys, self.edge_index(a, b) * self.nverts + c)]
+        i = loc_w[inside, 0] - 1
+        j = loc_w[inside, 1] - 1
+        m = n - 2
+        gid[inside] = (self.nverts + self.nedges * (n - 1) +
+                       f * ((n - 1) * (n - 2) // 2) +
+                       i * m - i * (i - 1) // 2 + j)
+        return gid
+
+
+def neighbourhood(faces, nverts, block, ring=None):
+    """ Returns the faces of triangles FACES (over NVERTS vertices) that
+    share a vertex with the faces listed in BLOCK: BLOCK first, in its
+    order, then the others ascending. RING is FACES' one_ring, if
+    already built. """
+
+    if ring is None:
+        ring = one_ring(faces, nverts)
+    offsets, incident = ring.incident()
+    corners = np.unique(faces[block].reshape(-1))
+    positions, starts = csr_positions(offsets, corners)
+    around = np.unique(incident[positions])
+    rest = np.setdiff1d(around, block, assume_unique=True)
+    return np.concatenate([block, rest])
+
+
+def compact(faces, *per_vertex):
+    """ Renumbers the vertices used by FACES from 0 and returns (FACES,
+    ARRAYS), ARRAYS being each of PER_VERTEX cut down to those
+    vertices. """
+
+    used, remap = np.unique(faces.reshape(-1), return_inverse=True)
+    return (remap.reshape(-1, 3).astype(np.int64),
+            [a[used] for a in per_vertex])
+
+
+def subdivide_patch(verts, faces, colors, loc_ids, loc_w, nblock, level):
+    """ Subdivides the patch VERTS, FACES, COLORS (with vertex locations
+    LOC_IDS, LOC_W) LEVEL times, keeping only what the descendants of its
+    first NBLOCK faces need. Returns those descendants as (VERTS, FACES,
+    COLORS, LOC_IDS, LOC_W). """
+
+    if level == 0:
+        faces, (verts, colors, loc_ids, loc_w) = compact(
+            faces[:nblock], verts, colors, loc_ids, loc_w)
+    for l in range(level):
+        st, faces, edges = loop_stencil(faces, len(verts))
+        verts = st.apply(verts)
+        colors = edge_midpoints(colors, edges)
+        mid_ids, mid_w = merge_locations(loc_ids[edges[:, 0]],
+                                         loc_w[edges[:, 0]],
+                                         loc_ids[edges[:, 1]],
+                                         loc_w[edges[:, 1]])
+        loc_ids = np.concatenate([loc_ids, mid_ids])
+        loc_w = np.concatenate([2 * loc_w, mid_w])
+
+        # the block's faces are the first 4^(l+1); the next level only
+        # needs the faces around their corners
+        nblock *= 4
+        if l + 1 < level:
+            corner = np.zeros(len(verts), dtype=bool)
+            corner[faces[:nblock]] = True
+            faces = faces[corner[faces].any(axis=1)] # block stays first
+        else:
+            faces = faces[:nblock]
+        faces, (verts, colors, loc_ids, loc_w) = compact(
+            faces, verts, colors, loc_ids, loc_w)
+    return verts, faces, colors, loc_ids, loc_w
+
+
+def stream_triangles(m, level, group=1):
+    """ Yields the triangles of LEVEL levels of Loop subdivision of M (a
+    tri_mesh.mesh or an array_mesh), GROUP coarse faces at a time, as
+    array_meshes. Each one also has
+
+       vertex_ids:    the global id of each of its vertices (see above)
+       coarse_faces:  the coarse faces it covers
+
+    Together the blocks hold exactly the triangles of
+    array_subdivision.loop_subdivide(M, LEVEL), attributes included. """
+
+    if not isinstance(m, array_mesh):
+        from array_mesh import from_tri_mesh
+        m = from_tri_mesh(m)
+    faces = m.faces
+    nverts = len(m.verts)
+    # the patches carry M's attributes as extra columns of the positions
+    # and colors
+    smooth, linear, names = stack_channels(m)
+    numbering = stream_numbering(faces, nverts, level)
+
+    for start in range(0, len(faces), group):
+        block = np.arange(start, min(start + group, len(faces)),
+                          dtype=np.int64)
+        patch = neighbourhood(faces, nverts, block, numbering.ring)
+        pfaces, (verts, colors, loc_ids) = compact(
+            faces[patch], smooth, linear, np.arange(nverts))
+        loc_ids = np.stack([loc_ids, np.full_like(loc_ids, NO_VERTEX),
+                            np.full_like(loc_ids, NO_VERTEX)], axis=1)
+        loc_w = np.zeros_like(loc_ids)
+        loc_w[:, 0] = 1
+
+        verts, pfaces, colors, loc_ids, loc_w = subdivide_patch(
+            verts, pfaces, colors, loc_ids, loc_w, len(block), level)
+        out = split_channels(verts, colors, names, pfaces, m.verts.dtype)
+        out.vertex_ids = numbering.ids(loc_ids, loc_w)
+        out.coarse_faces = block
+        yield out
+
+
+def write_stl(filename, blocks):
+    """ Writes the triangles of BLOCKS, any iterable of array_meshes, to
+    binary STL file FILENAME as they arrive. Returns the number of
+    triangles written. """
+
+    count = 0
+    with open(filename, 'wb') as out:
+        out.write(b'stream_subdivision'.ljust(80, b' '))
+        out.write(struct.pack('<I', 0)) # filled in at the end
+        for block in blocks:
+            tris = block.verts[block.faces]
+            rows = np.zeros(len(tris), dtype=STL_RECORD)
+            normal = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+            length = np.sqrt((normal * normal).sum(axis=1))
+            length[length == 0.0] = 1.0
+            rows['normal'] = normal / length[:, None]
+            rows['corners'] = tris
+            out.write(rows.tobytes())
+            count += len(tris)
+        out.seek(80)
+        out.write(struct.pack('<I', count))
+    return count
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Stream a subdivision level block by block.')
+    parser.add_argument('filename', help='.obj file')
+    parser.add_argument('level', type=int)
+    parser.add_argument('--group', type=int, default=1,
+                        help='coarse faces per block')
+    parser.add_argument('--stl', help='write the triangles to this file')
+    args = parser.parse_args(argv[1:])
+
+    import tracemalloc
+    from array_mesh import load_obj
+    from array_subdivision import loop_subdivide
+
+    def run(stream):
+        if not stream:
+            return len(loop_subdivide(coarse, args.level).faces)
+        blocks = stream_triangles(coarse, args.level, args.group)
+        if args.stl:
+            return write_stl(args.stl, blocks)
+        return sum(len(block.faces) for block in blocks)
+
+    # timed without tracemalloc, which slows down small allocations
+    coarse = load_obj(args.filename)
+    seconds = []
+    peak = []
+    for stream in (True, False):
+        start = time.perf_counter()
+        triangles = run(stream)
+        seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        run(stream)
+        peak.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    print('%d triangles at level %d, %d coarse faces per block' %
+          (triangles, args.level, args.group))
+    for name, t, p in zip(('streamed', 'whole'), seconds, peak):
+        print('%-10s %8.2f s  peak %8.1f MB' % (name + ':', t, p / 2.0**20))
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,479 @@
+#
+# subdivision_server.py
+#
+# A local subdivision service, so that tools which all need the same
+# subdivided assets can share one copy of the work instead of each
+# importing this code and subdividing on their own.
+#
+# The server listens on a Unix socket or a localhost TCP port. Each
+# request carries a mesh, as .obj text or as raw arrays, and a level; the
+# reply carries the subdivided arrays, or their mesh_codec encoding.
+#
+#    - identical requests arriving while one is being computed wait for
+#      that computation instead of starting their own
+#    - finished results are kept in a cache bounded in bytes, least
+#      recently used first out
+#    - subdivision runs in a process pool, so the event loop only moves
+#      bytes and stays responsive
+#
+# Every message, both ways, is a frame: a 4 byte big-endian header
+# length, a JSON header, and header['payload_bytes'] bytes of payload.
+# The server takes headers of up to MAX_HEADER bytes and payloads of up
+# to MAX_PAYLOAD; a frame it cannot read gets an error reply, and the
+# connection is closed, since the next frame cannot be found after it.
+#
+#    request header:  level, format ('obj' or 'arrays'), nverts and
+#                     nfaces (arrays only), precision ('float64' or
+#                     'float32'), reply ('arrays' or 'codec'), bits
+#                     (codec only). A header {'stats': true} asks for
+#                     the server's counters instead.
+#    arrays payload:  little-endian float64 vertices (V,3), int64 faces
+#                     (F,3)
+#    reply header:    nverts, nfaces, dtype, index (the faces' type),
+#                     cached, coalesced, seconds; or error
+#    reply payload:   vertices (V,3) of type dtype, faces (F,3) of type
+#                     index, colors (V,3) of type dtype; or the
+#                     mesh_codec encoding
+#
+#    python3 subdivision_server.py serve [--address unix:/tmp/sub.sock]
+#    python3 subdivision_server.py load --spawn --clients 8 objects/*.obj
+#
+# The load test sends requests from several concurrent clients and
+# reports throughput, latency percentiles and the server's counters.
+# subdivide(address, m, level) is the blocking call for other tools.
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import struct
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+DEFAULT_ADDRESS = 'unix:' + os.path.join(tempfile.gettempdir(),
+                                         'loop_subdivision.sock')
+CACHE_BYTES = 256 * 2**20
+MAX_LEVEL = 6 # a level 7 bunny does not fit in most machines' memory
+LENGTH = struct.Struct('>I')
+MAX_HEADER = 2**16
+MAX_PAYLOAD = 2**30
+
+# request header fields that affect the result
+KEY_FIELDS = ('format', 'nverts', 'nfaces', 'level', 'precision', 'reply',
+              'bits')
+
+
+async def read_frame(reader, max_header=None, max_payload=None):
+    """ Reads one frame from asyncio stream READER. Returns (HEADER,
+    PAYLOAD), or (None, None) at end of stream. Raises ValueError for a
+    frame that is malformed, or larger than MAX_HEADER or MAX_PAYLOAD
+    bytes when given. """
+
+    try:
+        size, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    except asyncio.IncompleteReadError:
+        return None, None
+    if max_header is not None and size > max_header:
+        raise ValueError('header of %d bytes is over the limit of %d' %
+                         (size, max_header))
+    header = json.loads(await reader.readexactly(size))
+    if not isinstance(header, dict):
+        raise ValueError('header is not a JSON object')
+    payload_bytes = header.get('payload_bytes', 0)
+    if type(payload_bytes) is not int or payload_bytes < 0:
+        raise ValueError('payload_bytes must be a non-negative integer')
+    if max_payload is not None and payload_bytes > max_payload:
+        raise ValueError('payload of %d bytes is over the limit of %d' %
+                         (payload_bytes, max_payload))
+    payload = await reader.readexactly(payload_bytes)
+    return header, payload
+
+
+def write_frame(writer, header, payload=b''):
+    """ Writes one frame with dict HEADER and bytes PAYLOAD to asyncio
+    stream WRITER. """
+
+    header = dict(header, payload_bytes=len(payload))
+    text = json.dumps(header).encode()
+    writer.write(LENGTH.pack(len(text)) + text)
+    if payload:
+        writer.write(payload)
+
+
+def mesh_request(m, level, precision='float64', reply='arrays', bits=14):
+    """ Returns (HEADER, PAYLOAD) asking for LEVEL levels of subdivision
+    of M: an array_mesh, or the bytes of an .obj file. """
+
+    header = {'level': level, 'precision': precision, 'reply': reply,
+              'bits': bits}
+    if isinstance(m, bytes):
+        header['format'] = 'obj'
+        return header, m
+    header.update(format='arrays', nverts=len(m.verts), nfaces=len(m.faces))
+    payload = (np.ascontiguousarray(m.verts, dtype='<f8').tobytes() +
+               np.ascontiguousarray(m.faces, dtype='<i8').tobytes())
+    return header, payload
+
+
+def request_mesh(header, payload):
+    """ Returns the array_mesh sent in a request HEADER and PAYLOAD. """
+
+    from array_mesh import array_mesh, parse_obj
+
+    dtype = np.dtype(header.get('precision', 'float64'))
+    if header['format'] == 'obj':
+        return parse_obj(payload.decode().splitlines(), dtype)
+    if header['format'] != 'arrays':
+        raise ValueError('unknown mesh format %r' % header['format'])
+    nverts = header['nverts']
+    verts = np.frombuffer(payload, dtype='<f8', count=3 * nverts)
+    faces = np.frombuffer(payload, dtype='<i8', offset=24 * nverts)
+    if len(faces) != 3 * header['nfaces']:
+        raise ValueError('payload does not match nverts and nfaces')
+    if len(faces) and (faces.min() < 0 or faces.max() >= nverts):
+        raise ValueError('face index out of range')
+    return array_mesh(verts, faces, dtype=dtype)
+
+
+def reply_mesh(header, payload):
+    """ Returns the array_mesh in a reply HEADER and PAYLOAD. """
+
+    from array_mesh import array_mesh
+
+    if 'encoding' in header:
+        from mesh_codec import decode
+        return decode(payload, np.dtype(header['dtype']))[0]
+    dtype = np.dtype(header['dtype']).newbyteorder('<')
+    index = np.dtype(header['index']).newbyteorder('<')
+    nverts, nfaces = header['nverts'], header['nfaces']
+    at = 3 * nverts * dtype.itemsize
+    verts = np.frombuffer(payload, dtype=dtype, count=3 * nverts)
+    faces = np.frombuffer(payload, dtype=index, count=3 * nfaces, offset=at)
+    at += 3 * nfaces * index.itemsize
+    colors = np.frombuffer(payload, dtype=dtype, count=3 * nverts, offset=at)
+    return array_mesh(verts, faces, colors, dtype)
+
+
+def compute(header, payload):
+    """ Process pool worker: subdivides the mesh of a request HEADER and
+    PAYLOAD. Returns (REPLY HEADER, REPLY PAYLOAD). """
+
+    from array_subdivision import loop_subdivide
+
+    start = time.perf_counter()
+    level = int(header['level'])
+    if not 0 <= level <= MAX_LEVEL:
+        raise ValueError('level must be between 0 and %d' % MAX_LEVEL)
+    m = loop_subdivide(request_mesh(header, payload), level)
+
+    reply = {'nverts': len(m.verts), 'nfaces': len(m.faces),
+             'dtype': m.verts.dtype.name}
+    if header.get('reply', 'arrays') == 'codec':
+        from mesh_codec import encode
+        body = encode(m, header.get('bits', 14))
+        reply['encoding'] = 'mesh_codec'
+    else:
+        index = np.dtype('<u4') if len(m.verts) < 2**32 else np.dtype('<i8')
+        reply['index'] = index.name
+        dtype = m.verts.dtype.newbyteorder('<')
+        body = b''.join([m.verts.astype(dtype).tobytes(),
+                         m.faces.astype(index).tobytes(),
+                         m.colors.astype(dtype).tobytes()])
+    reply['seconds'] = time.perf_counter() - start
+    return reply, body
+
+
+class subdivision_server:
+    # Answers subdivision requests, sharing in-flight computations and
+    # cached results between clients.
+
+    def __init__(self, workers=None, cache_bytes=CACHE_BYTES,
+                 max_payload=MAX_PAYLOAD):
+
+        # forked workers would inherit the listening socket and keep it
+        # open if the server died; forkserver workers start clean
+        self.pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.cache = OrderedDict() # key -> (reply header, payload)
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.max_payload = max_payload
+        self.pending = {} # key -> future of a computation in progress
+        self.counts = {'requests': 0, 'computed': 0, 'cache_hits': 0,
+                       'coalesced': 0, 'errors': 0, 'evicted': 0}
+
+    def key(self, header, payload):
+        """ Returns the cache key of a request HEADER and PAYLOAD. """
+
+        fields = json.dumps([header.get(k) for k in KEY_FIELDS]).encode()
+        return hashlib.sha256(fields + b'\0' + payload).hexdigest()
+
+    def remember(self, key, result):
+        """ Caches RESULT under KEY, evicting the least recently used
+        entries to stay within cache_bytes. """
+
+        size = len(result[1])
+        if size > self.cache_bytes:
+            return
+        self.cache[key] = result
+        self.cached_bytes += size
+        while self.cached_bytes > self.cache_bytes:
+            old, (header, payload) = self.cache.popitem(last=False)
+            self.cached_bytes -= len(payload)
+            self.counts['evicted'] += 1
+
+    async def result(self, header, payload):
+        """ Returns (REPLY HEADER, PAYLOAD) for a request, from the
+        cache, from an identical request in progress, or by computing
+        it in the process pool. """
+
+        key = self.key(header, payload)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.counts['cache_hits'] += 1
+            reply, body = self.cache[key]
+            return dict(reply, cached=True), body
+        if key in self.pending:
+            self.counts['coalesced'] += 1
+            reply, body = await asyncio.shield(self.pending[key])
+            return dict(reply, coalesced=True), body
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.pool, compute, header, payload)
+        self.pending[key] = future
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            del self.pending[key]
+        self.counts['computed'] += 1
+        self.remember(key, result)
+        return result
+
+    async def handle(self, reader, writer):
+        """ Serves the requests of one connection until it closes. """
+
+        try:
+            while True:
+                try:
+                    header, payload = await read_frame(
+                        reader, MAX_HEADER, self.max_payload)
+                except ValueError as e:
+                    self.counts['errors'] += 1
+                    write_frame(writer, {'error': 'bad frame: %s' % e})
+                    await writer.drain()
+                    break
+                if header is None:
+                    break
+                if header.get('stats'):
+                    write_frame(writer, dict(self.counts,
+                                             cached_bytes=self.cached_bytes,
+                                             cache_entries=len(self.cache)))
+                else:
+                    self.counts['requests'] += 1
+                    try:
+                        reply, body = await self.result(header, payload)
+                    except Exception as e:
+                        self.counts['errors'] += 1
+                        reply, body = {'error': '%s: %s' % (
+                            type(e).__name__, e)}, b''
+                    write_frame(writer, reply, body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, address=DEFAULT_ADDRESS):
+        """ Listens on ADDRESS ('unix:PATH' or 'HOST:PORT') until
+        cancelled or sent SIGTERM, then stops the worker processes. """
+
+        # without this a terminated server leaves its workers running
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel)
+        path = None
+        if address.startswith('unix:'):
+            path = address[len('unix:'):]
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle, host, int(port))
+        print('serving on ' + address)
+        sys.stdout.flush()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+
+
+async def connect(address=DEFAULT_ADDRESS):
+    """ Opens a connection to the server at ADDRESS. Returns (READER,
+    WRITER). """
+
+    if address.startswith('unix:'):
+        return await asyncio.open_unix_connection(address[len('unix:'):])
+    host, port = address.rsplit(':', 1)
+    return await asyncio.open_connection(host, int(port))
+
+
+async def call(reader, writer, header, payload=b''):
+    """ Sends one request over a connection and returns the reply's
+    (HEADER, PAYLOAD), raising RuntimeError for an error reply. """
+
+    write_frame(writer, header, payload)
+    await writer.drain()
+    reply, body = await read_frame(reader)
+    if reply is None:
+        raise ConnectionError('server closed the connection')
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return reply, body
+
+
+def subdivide(address, m, level, precision='float64'):
+    """ Asks the server at ADDRESS for LEVEL levels of subdivision of M
+    (an array_mesh, or .obj file bytes). Returns the subdivided
+    array_mesh. """
+
+    async def run():
+        reader, writer = await connect(address)
+        try:
+            return await call(reader, writer,
+                              *mesh_request(m, level, precision))
+        finally:
+            writer.close()
+
+    return reply_mesh(*asyncio.run(run()))
+
+
+async def load_test(address, requests, clients, total):
+    """ Sends TOTAL requests, taken in turn from the list of (HEADER,
+    PAYLOAD) REQUESTS, from CLIENTS concurrent connections. Returns
+    (latencies in seconds, reply bytes, wall seconds, server counts). """
+
+    latencies = []
+    received = [0]
+    turn = iter(range(total))
+
+    async def client():
+        reader, writer = await connect(address)
+        try:
+            for i in turn:
+                start = time.perf_counter()
+                reply, body = await call(reader, writer,
+                                         *requests[i % len(requests)])
+                latencies.append(time.perf_counter() - start)
+                received[0] += len(body)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(clients)])
+    wall = time.perf_counter() - start
+
+    reader, writer = await connect(address)
+    counts, body = await call(reader, writer, {'stats': True})
+    writer.close()
+    return latencies, received[0], wall, counts
+
+
+async def wait_for_server(address, seconds=30.0):
+    """ Waits until the server at ADDRESS accepts connections. """
+
+    deadline = time.perf_counter() + seconds
+    while True:
+        try:
+            reader, writer = await connect(address)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Local subdivision server, and a load test for it.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run the server')
+    serve.add_argument('--address', default=DEFAULT_ADDRESS,
+                       help='unix:PATH or HOST:PORT')
+    serve.add_argument('--workers', type=int, default=None,
+                       help='worker processes (default: one per core)')
+    serve.add_argument('--cache-mb', type=float, default=CACHE_BYTES / 2**20)
+    serve.add_argument('--max-payload-mb', type=float,
+                       default=MAX_PAYLOAD / 2**20,
+                       help='largest request payload to accept')
+
+    load = commands.add_parser('load', help='run the load test client')
+    load.add_argument('filenames', nargs='*',
+                      help='.obj files (default: objects/*.obj)')
+    load.add_argument('--address', default=DEFAULT_ADDRESS)
+    load.add_argument('--levels', default='2,3',
+                      help='comma separated levels to ask for')
+    load.add_argument('--clients', type=int, default=8)
+    load.add_argument('--requests', type=int, default=200)
+    load.add_argument('--reply', default='arrays',
+                      choices=['arrays', 'codec'])
+    load.add_argument('--spawn', action='store_true',
+                      help='start a server for the test, and stop it after')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'serve':
+        server = subdivision_server(args.workers,
+                                    int(args.cache_mb * 2**20),
+                                    int(args.max_payload_mb * 2**20))
+        try:
+            asyncio.run(server.serve(args.address))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        return 0
+
+    requests = []
+    for filename in args.filenames or sorted(glob.glob('objects/*.obj')):
+        with open(filename, 'rb') as obj_file:
+            text = obj_file.read()
+        for level in [int(l) for l in args.levels.split(',')]:
+            requests.append(mesh_request(text, level, reply=args.reply))
+
+    process = None
+    if args.spawn:
+        import subprocess
+        process = subprocess.Popen([sys.executable, __file__, 'serve',
+                                    '--address', args.address])
+        asyncio.run(wait_for_server(args.address))
+    try:
+        latencies, received, wall, counts = asyncio.run(
+            load_test(args.address, requests, args.clients, args.requests))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    ms = np.percentile(np.array(latencies) * 1000.0, [50, 90, 99, 100])
+    print('%d requests (%d distinct), %d clients, %.2f s' %
+          (len(latencies), len(requests), args.clients, wall))
+    print('throughput: %.1f requests/s, %.1f MB/s' %
+          (len(latencies) / wall, received / 2.0**20 / wall))
+    print('latency ms: p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(ms))
+    print('server: ' + '  '.join('%s %s' % (k, counts[k]) for k in
+                                 ('requests', 'computed', 'coalesced',
+                                  'cache_hits', 'evicted', 'errors')))
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -13,6 +13,11 @@ from math import sqrt
 from numpy import matrix, dot, array, ndarray
 from numpy.linalg import inv, solve
 from mesh_geometry import *
+from mesh_stats import mesh_stats
+from progress import progress_meter, cancelled
+from array_mesh import orient_faces, load_obj, load_stl
+from compressed_io import open_file, plain_extension
+import profiling
 import sys
 
 
@@ -34,18 +39,69 @@ class mesh:
         self.p1 = point(10.0, -0.001, 10.0) # point on floor
         self.p2 = point(-10.0, -0.001, -10.0) # another point on the floor
         self.p3 = point(-10.0, -0.001, 10.0) # third point on floor
+        self.stats = None # mesh_stats from loading / subdividing
+        self.orientable = True # False if assignSpins found a piece
+        # that cannot be oriented
         
         
 
     
-    def load(self, filename):
-        """ Loads a list of triangles from a .obj file FILENAME """
+    def load(self, filename, stats=None, trace=None, progress=None,
+             cancel=None, weld=None):
+        """ Loads a list of triangles from a .obj or binary .stl file
+        FILENAME, which may be compressed (see compressed_io).
+        Timings and counters are recorded in STATS (a new mesh_stats
+        if not given), which is kept as self.stats. If TRACE is given,
+        a Chrome trace of the load is written to that file. PROGRESS
+        and CANCEL are a progress callback and a cancel_token (see
+        progress.py); a cancelled load empties the mesh and raises
+        cancelled. If WELD is given, vertices closer than that tolerance
+        are merged first (see array_mesh.weld_mesh): edges are paired by
+        their vertices, so a triangle soup with its own copy of every
+        vertex would otherwise come out all boundary. STL files are
+        always welded, at tolerance 0 unless WELD says otherwise. """
         global vindex, tindex
         vindex = 0
         tindex = 0
-        newedge = [None, None, None]
-         #dictionary of edges, each should appear only once
-        obj_file = open(filename, 'r')
+        if stats is None:
+            stats = mesh_stats()
+        self.stats = stats
+        stl = plain_extension(filename) == '.stl'
+        if weld is not None or stl:
+            with stats.phase('parse', file=filename):
+                if stl:
+                    m = load_stl(filename, weld=weld or 0.0)
+                else:
+                    m = load_obj(filename, weld=weld)
+            stats.count('welded_vertices', len(m.vertex_remap) - len(m.verts))
+            self.build(m.verts.tolist(), m.faces.tolist(), stats, progress,
+                       cancel)
+            if trace != None:
+                stats.write_trace(trace)
+            return
+
+        meter = progress_meter(0, None, progress, cancel)
+
+        with stats.phase('parse', file=filename):
+            obj_file = open_file(filename)
+            try:
+                max = self.parseObj(obj_file, meter, stats)
+            except cancelled:
+                self.abandon()
+                raise
+            finally:
+                obj_file.close()
+
+        self.finishLoad(max, stats, meter)
+
+        if trace != None:
+            stats.write_trace(trace)
+
+    def parseObj(self, obj_file, meter, stats):
+        """ Reads the vertices and triangles of open .obj file OBJ_FILE
+        into the mesh, counting triangles on METER. Returns the largest
+        squared vertex distance from the origin. """
+        global vindex, tindex
         max = 0.0
 
         for line in obj_file:
@@ -59,11 +115,11 @@ class mesh:
                     d2 = (p.loc - ORIGIN).norm2()
                     if d2 > max:
                         max = d2
-                
+
                     vindex = vindex + 1
                     self.verts.append(p)
 
-                    
+
                 elif parts[0] == 'f':
                     i0 = int(parts[1])
                     if len(parts) < 5:
@@ -74,114 +130,156 @@ class mesh:
                         # -1)
                         i3 = int(parts[3])-1
                         #print("Adding triangle: " + str(tindex))
-                        newtri = triangle(self.verts[i1], self.verts[i2], self.verts[i3], tindex)
-
-                        # Add the triangles edges and check for pairing
-                        newedge[0] = edge(self.verts[i1], self.verts[i2])
-                        newedge[1] = edge(self.verts[i2], self.verts[i3])
-                        newedge[2] = edge(self.verts[i3], self.verts[i1])
-
-                        for i in range(0,3):
-                            newedge[i].triangle = newtri
-                            if repr(newedge[i]) not in self.edges:
-                                #print("Adding edge: " + repr(newedge[i]))
-                                self.edges[repr(newedge[i])] = newedge[i]
-                            else:
-                                #print("DUPLICATE: " + repr(newedge[i]))
-                                newedge[i].pair = self.edges[repr(newedge[i])]
-                                # connect the edges
-                                self.edges[repr(newedge[i])].pair = newedge[i]
-                            #add the edge to the triangle
-                            newtri.edge[i] = newedge[i]
-
-                        # Try adding the new edges to the dictionary. If
-                        # already there, link the edges.
-                        self.triangles.append(newtri) # add to triangles list
+                        self.addTriangle(i1, i2, i3, stats)
                         tindex = tindex + 1
+                        meter.step()
 
                         # next, we need to go through and recursively
                         # assign triangle "spins".
+        return max
+
+    def build(self, positions, faces, stats=None, progress=None,
+              cancel=None):
+        """ Builds the mesh from POSITIONS, a sequence of (x, y, z)
+        vertex positions, and FACES, a sequence of vertex index triples
+        counted from 0 - for example the arrays of an array_mesh. Does
+        the same linking as load(), and takes the same PROGRESS and
+        CANCEL. """
+
+        if stats is None:
+            stats = mesh_stats()
+        self.stats = stats
+        max = 0.0
+        meter = progress_meter(0, len(faces), progress, cancel)
+
+        with stats.phase('build'):
+            for x, y, z in positions:
+                p = vertex(float(x), float(y), float(z), len(self.verts))
+                d2 = (p.loc - ORIGIN).norm2()
+                if d2 > max:
+                    max = d2
+                self.verts.append(p)
+
+            try:
+                for i1, i2, i3 in faces:
+                    self.addTriangle(int(i1), int(i2), int(i3), stats)
+                    meter.step()
+            except cancelled:
+                self.abandon()
+                raise
+
+        self.finishLoad(max, stats, meter)
+
+    def addTriangle(self, i1, i2, i3, stats):
+        """ Adds the triangle between vertices I1, I2 and I3, creating its
+        edges and pairing them with edges already in the mesh. """
 
-        self.radius = sqrt(max)
-        self.tindex = tindex
-        self.vindex = vindex
-        self.projectShadows()
-       
-        self.assignSpins()
-    
-    def assignSpins(self):
-        """ Recursively assign "spin" - internal linking of each triangle
-        edge - to each triangle in the surface. """
+        newedge = [None, None, None]
+        newtri = triangle(self.verts[i1], self.verts[i2], self.verts[i3],
+                          len(self.triangles))
+
+        # Add the triangles edges and check for pairing
+        newedge[0] = edge(self.verts[i1], self.verts[i2])
+        newedge[1] = edge(self.verts[i2], self.verts[i3])
+        newedge[2] = edge(self.verts[i3], self.verts[i1])
 
-        sys.setrecursionlimit(5000)
-        # first, assign edges for the first triangle
+        # Try adding the new edges to the dictionary. If
+        # already there, link the edges.
         for i in range(0,3):
-            self.triangles[0].edge[i].nextEdge = self.triangles[0].edge[(i+1) % 3]
-            
-        self.triangles[0].visited = True
-        for i in range (0,3):
-            self.recAssignSpin(self.triangles[0].edge[i])
-            
-    def recAssignSpin(self,startEdge):
-        """ Takes startEdge, the connected edge in a triangle that
-        already has assigned spins. Uses this to set spin in the
-        current triangle, and recursively goes to all neightbors. """
-
-        if startEdge == None:
-            return # No paired triangle to this edge
-        if startEdge.pair == None:
-            return
-            
-        currentTri = startEdge.pair.triangle
-        pairedEdge = startEdge.pair
-        
-        if currentTri.visited == True:
-            return # triangle already set
+            newedge[i].triangle = newtri
+            key = repr(newedge[i])
+            if key not in self.edges:
+                #print("Adding edge: " + repr(newedge[i]))
+                self.edges[key] = newedge[i]
+            else:
+                #print("DUPLICATE: " + repr(newedge[i]))
+                newedge[i].pair = self.edges[key]
+                # connect the edges
+                self.edges[key].pair = newedge[i]
+                stats.count('paired_edges')
+            #add the edge to the triangle
+            newtri.edge[i] = newedge[i]
+        stats.count('edge_lookups', 3)
+
+        self.triangles.append(newtri) # add to triangles list
+
+    def finishLoad(self, max, stats, meter=None):
+        """ Finishes loading once all vertices and triangles are in: sets
+        the radius from MAX, the largest squared vertex distance, then
+        projects shadows and assigns spins. METER, the load's
+        progress_meter, gets a last report (and cancellation check)
+        first. """
+
+        if meter is not None:
+            try:
+                meter.finish(len(self.triangles))
+            except cancelled:
+                self.abandon()
+                raise
+
+        stats.count('vertices_created', len(self.verts))
+        stats.count('triangles_created', len(self.triangles))
+        stats.count('edges_created', 3*len(self.triangles))
+        stats.count('boundary_edges', sum(1 for e in self.edges.values()
+                                          if e.pair == None))
 
-        # find the "second vertex" of the edge - determines
-        # its direction
-        currentTri.visited = True
-        secondVertex = startEdge.sharedVertex(startEdge.nextEdge)
+        self.radius = sqrt(max)
+        self.tindex = len(self.triangles)
+        self.vindex = len(self.verts)
+        with stats.phase('shadows'):
+            self.projectShadows()
 
-        # find the edge in the new triangle that does not share
-        # this vertex
+        with stats.phase('spins'):
+            self.assignSpins()
+    
+    def abandon(self):
+        """ Empties a mesh whose loading was cancelled, breaking the links
+        between its edges and triangles. """
 
-        # This ugly code connects each edge to the appropriate next
-        # edge. The logic is that the next edge should not
-        # share the vertex shared with the preceeding edge.
-        
-        for i in range(0,3):
-            if currentTri.edge[i].containsVertex(secondVertex) == False:
-                secondEdge = currentTri.edge[i]
-                pairedEdge.nextEdge = secondEdge
-                break
-        # Do the same thing (bascially) for the third edge:
+        for tri in self.triangles:
+            for e in tri.edge:
+                if e != None:
+                    e.pair = None
+                    e.triangle = None
+            tri.edge = [None, None, None]
+        self.triangles = []
+        self.verts = []
+        self.edges = {}
+        self.stats.count('cancelled')
 
-        secondVertex = pairedEdge.sharedVertex(secondEdge)
-        for i in range(0,3):
-            if currentTri.edge[i].containsVertex(secondVertex) == False:
-                thirdEdge = currentTri.edge[i]
-                secondEdge.nextEdge = thirdEdge
-                thirdEdge.nextEdge = pairedEdge
-                break
-
-        # now all triangle edge are connected! Go to neighboring triangles
-        # and set them.
-
-        #for edge in currentTri.edge:
-                #self.recAssignSpin(edge)
-
-        if secondEdge.pair != None:
-            if secondEdge.pair.triangle.visited != True:
-                self.recAssignSpin(secondEdge)
-
-        if thirdEdge.pair != None:
-            if thirdEdge.pair.triangle.visited != True:
-                self.recAssignSpin(thirdEdge)
-              
-                
-            
-        return
+    def assignSpins(self):
+        """ Assigns "spin" - internal linking of each triangle edge - to
+        each triangle in the surface, so that triangles sharing an edge
+        run along it in opposite directions. Every connected piece of
+        the surface is oriented (see array_mesh.orient_faces), keeping
+        the direction most of its triangles already have. Sets
+        self.orientable to False if some piece cannot be oriented. """
+
+        position = {}
+        for v in self.verts:
+            position[id(v)] = len(position)
+        faces = array([[position[id(v)] for v in tri.verts]
+                       for tri in self.triangles], dtype=int).reshape(-1, 3)
+        oriented, flipped, component, orientable = \
+            orient_faces(faces, len(position))
+
+        for tri, flip in zip(self.triangles, flipped.tolist()):
+            # edge i runs from corner i to corner i+1; a flipped triangle
+            # goes round the other way
+            step = 2 if flip else 1
+            for i in range(0,3):
+                tri.edge[i].nextEdge = tri.edge[(i + step) % 3]
+            tri.visited = True
+
+        self.orientable = bool(orientable.all())
+        if not self.orientable:
+            print("Warning: " + str(int((~orientable).sum())) +
+                  " piece(s) of the mesh cannot be oriented.")
+        if self.stats != None:
+            self.stats.count('components', len(orientable))
+            self.stats.count('nonorientable_components',
+                             int((~orientable).sum()))
+            self.stats.count('flipped_triangles', int(flipped.sum()))
 
     def projectShadows(self):
         """ Projects each triangle onto the FLOOR to create a shadow.
@@ -304,6 +402,12 @@ class mesh:
                         
 
 def main(argc, argv):
+    # --profile[=PREFIX] runs the whole thing under cProfile
+    prefix, argv = profiling.parse_profile_option(argv, 'tri_mesh')
+    argc = len(argv)
+    if prefix != None:
+        profiling.start(prefix)
+
     #t1 = triangle(point(0,0,0), point(1,1,1), point(2,2,2))
     print("hello")
     #print(repr(t1))
@@ -334,6 +438,7 @@ def main(argc, argv):
         #print("\n")
     
     
+    profiling.stop()
 
     return 0
     
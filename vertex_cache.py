@@ -0,0 +1,248 @@
+#
+# vertex_cache.py
+#
+# Triangle and vertex ordering for indexed drawing.
+#
+# When triangles are drawn from an index buffer, the GPU keeps the last
+# few transformed vertices in a small post-transform cache, and a vertex
+# used again while it is still there is not shaded a second time. The
+# triangle order that comes out of subdivision (the recursive walk in
+# loop_subdivision.py, or edge order in array_subdivision.py) makes poor
+# use of it. This module
+#
+#    forsyth_order:    reorders triangles with Tom Forsyth's "Linear-speed
+#                      vertex cache optimisation" scoring
+#    first_use_order:  renumbers vertices in the order the triangles first
+#                      use them, so vertex fetches walk through memory
+#    optimize:         does both to an array_mesh
+#    acmr:             the average cache miss ratio of a triangle order -
+#                      transformed vertices per triangle, from 0.5 (ideal,
+#                      large meshes) to 3.0 (no reuse at all) - for a FIFO
+#                      cache like the ones in hardware
+#
+# From the command line, prints the ACMR of the bundled objects at a few
+# levels of subdivision, before and after optimizing:
+#
+#    python3 vertex_cache.py              levels 0 to 2, all objects
+#    python3 vertex_cache.py 3 objects/bunny.obj --cache 16
+
+import argparse
+import contextlib
+import glob
+import io
+import sys
+import time
+from collections import deque
+import numpy as np
+from array_mesh import array_mesh, one_ring
+
+
+CACHE_SIZE = 32
+
+# Forsyth's scoring constants
+CACHE_DECAY_POWER = 1.5
+LAST_TRIANGLE_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+
+def acmr(faces, cache_size=CACHE_SIZE):
+    """ Returns the average cache miss ratio of drawing triangles FACES
+    in order through a FIFO vertex cache of CACHE_SIZE entries. """
+
+    faces = np.asarray(faces, dtype=np.int64)
+    if len(faces) == 0:
+        return 0.0
+    cached = set()
+    fifo = deque()
+    misses = 0
+    for v in faces.reshape(-1).tolist():
+        if v not in cached:
+            misses += 1
+            cached.add(v)
+            fifo.append(v)
+            if len(fifo) > cache_size:
+                cached.discard(fifo.popleft())
+    return misses / float(len(faces))
+
+
+def forsyth_order(faces, nverts, cache_size=CACHE_SIZE):
+    """ Returns an order for triangles FACES over NVERTS vertices that
+    makes good use of a vertex cache of CACHE_SIZE entries: an array
+    of face indices, faces[order] being the reordered triangles.
+
+    Each vertex is scored by how recently it entered a simulated LRU
+    cache, plus a bonus for having few triangles left (so lone
+    triangles are not stranded), and the next triangle drawn is the
+    best scoring one around the cached vertices. """
+
+    faces = np.asarray(faces, dtype=np.int64)
+    nfaces = len(faces)
+    if nfaces == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ring = one_ring(faces, nverts)
+    offsets, incident = ring.incident()
+    offsets = offsets.tolist()
+    incident = incident.tolist()
+    tris = faces.tolist()
+
+    # score tables, by position in the cache and by triangles left
+    position_score = [LAST_TRIANGLE_SCORE] * 3 + \
+        [(1.0 - (p - 3) / float(cache_size - 3)) ** CACHE_DECAY_POWER
+         for p in range(3, cache_size)]
+    most = int(ring.face_count.max())
+    valence_score = [0.0] + [VALENCE_BOOST_SCALE * n ** -VALENCE_BOOST_POWER
+                             for n in range(1, most + 1)]
+
+    remaining = ring.face_count.tolist()
+    vertex_score = [valence_score[n] for n in remaining]
+    drawn = [False] * nfaces
+    cache = []
+
+    order = []
+    best = int(np.argmax(np.array(vertex_score)[faces].sum(axis=1)))
+    scan = 0 # faces before this one are all drawn
+    while True:
+        order.append(best)
+        drawn[best] = True
+        a, b, c = tris[best]
+
+        # move the triangle's vertices to the front of the cache
+        for v in (a, b, c):
+            remaining[v] -= 1
+        new_cache = [a, b, c] + [v for v in cache
+                                 if v != a and v != b and v != c]
+        for v in new_cache[cache_size:]:
+            vertex_score[v] = valence_score[remaining[v]] \
+                if remaining[v] else 0.0
+        touched = new_cache
+        cache = new_cache[:cache_size]
+
+        # rescore the cached vertices and the triangles around them
+        for p, v in enumerate(touched):
+            if remaining[v] == 0:
+                vertex_score[v] = -1.0 # finished, never chosen again
+            elif p < cache_size:
+                vertex_score[v] = position_score[p] + \
+                                  valence_score[remaining[v]]
+        best = -1
+        best_score = -1.0
+        for v in touched:
+            for i in range(offsets[v], offsets[v + 1]):
+                f = incident[i]
+                if drawn[f]:
+                    continue
+                x, y, z = tris[f]
+                score = vertex_score[x] + vertex_score[y] + vertex_score[z]
+                if score > best_score:
+                    best_score = score
+                    best = f
+
+        if best < 0:
+            # nothing left around the cache: start on the next undrawn
+            # triangle
+            while scan < nfaces and drawn[scan]:
+                scan += 1
+            if scan == nfaces:
+                break
+            best = scan
+
+    return np.array(order, dtype=np.int64)
+
+
+def first_use_order(faces, nverts):
+    """ Returns (ORDER, REMAP) for triangles FACES over NVERTS vertices:
+    ORDER lists the vertices in the order FACES first use them (unused
+    vertices last), and REMAP[old index] is the new index, so
+    REMAP[faces] are the renumbered triangles. """
+
+    corners = np.asarray(faces, dtype=np.int64).reshape(-1)
+    used, first = np.unique(corners, return_index=True)
+    unused = np.setdiff1d(np.arange(nverts, dtype=np.int64), used)
+    order = np.concatenate([used[np.argsort(first)], unused])
+    remap = np.empty(nverts, dtype=np.int64)
+    remap[order] = np.arange(nverts, dtype=np.int64)
+    return order, remap
+
+
+def optimize(m, cache_size=CACHE_SIZE):
+    """ Returns a copy of array_mesh M with its triangles reordered for a
+    vertex cache of CACHE_SIZE entries and its vertices renumbered in
+    order of first use. The copy's face_order and vertex_order map new
+    positions to the old ones. On small meshes the greedy order can
+    lose to the one M already has; M's is kept then. """
+
+    face_order = forsyth_order(m.faces, len(m.verts), cache_size)
+    if acmr(m.faces[face_order], cache_size) > acmr(m.faces, cache_size):
+        face_order = np.arange(len(m.faces), dtype=np.int64)
+    faces = m.faces[face_order]
+    vertex_order, remap = first_use_order(faces, len(m.verts))
+
+    out = array_mesh(m.verts[vertex_order], remap[faces],
+                     m.colors[vertex_order], m.verts.dtype)
+    out.copyAttributes(m, vertex_order)
+    out.face_order = face_order
+    out.vertex_order = vertex_order
+    return out
+
+
+def report(filenames, levels, cache_size=CACHE_SIZE):
+    """ Returns rows of (object, level, triangles, ACMR of the object
+    subdivision walk, of array subdivision, after optimizing, seconds
+    spent optimizing) for .obj FILENAMES at each of LEVELS. The walk's
+    ACMR is None where the object engine fails. """
+
+    from array_mesh import from_tri_mesh, load_obj
+    from array_subdivision import loop_subdivide
+
+    rows = []
+    for filename in filenames:
+        coarse = load_obj(filename)
+        for level in levels:
+            walk = None
+            try:
+                from tri_mesh import mesh
+                from loop_subdivision import subdivide
+                with contextlib.redirect_stdout(io.StringIO()):
+                    m = mesh()
+                    m.load(filename)
+                    m = subdivide(m, level)
+                walk = acmr(from_tri_mesh(m).faces, cache_size)
+            except Exception:
+                pass # the object engine is not needed for the rest
+
+            m = loop_subdivide(coarse, level)
+            start = time.perf_counter()
+            better = optimize(m, cache_size)
+            seconds = time.perf_counter() - start
+            rows.append((filename, level, len(m.faces), walk,
+                         acmr(m.faces, cache_size),
+                         acmr(better.faces, cache_size), seconds))
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Vertex cache miss ratios before and after reordering.')
+    parser.add_argument('levels', type=int, nargs='?', default=2,
+                        help='report levels 0 to LEVELS')
+    parser.add_argument('filenames', nargs='*',
+                        help='.obj files (default: objects/*.obj)')
+    parser.add_argument('--cache', type=int, default=CACHE_SIZE,
+                        help='cache entries (default %d)' % CACHE_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    filenames = args.filenames or sorted(glob.glob('objects/*.obj'))
+    print('ACMR with a %d entry FIFO cache' % args.cache)
+    print('%-24s %5s %9s %8s %8s %9s %8s' %
+          ('object', 'level', 'tris', 'walk', 'array', 'optimized', 'secs'))
+    for row in report(filenames, range(args.levels + 1), args.cache):
+        name, level, tris, walk, before, after, seconds = row
+        walk = '-' if walk is None else '%.3f' % walk
+        print('%-24s %5d %9d %8s %8.3f %9.3f %8.2f' %
+              (name, level, tris, walk, before, after, seconds))
+    return 0
+
+
+if __name__ == '__main__': sys.exit(main(sys.argv))